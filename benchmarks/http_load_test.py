@@ -0,0 +1,291 @@
+#!/usr/bin/python
+# vim:set ts=4 sw=4 et:
+"""Load test of the HTTP API.
+
+Starts the site of the daemon in-process on a loopback port with dummy
+sprinklers and lets a number of concurrent clients fire a mixed read/write
+workload at it.  Clients and server share one reactor, just like the
+site shares it with the timers of the job queue, so the reported reactor
+lag is what a job timer would experience under that load.  The results
+are printed as JSON.
+"""
+from __future__ import (absolute_import, division, print_function,
+        unicode_literals)
+import argparse
+import bisect
+import json
+import os
+import os.path
+import random
+import resource
+import sys
+from timeit import default_timer
+
+BASE_PATH = os.path.abspath(os.path.join(os.path.dirname(sys.argv[0]), b'..'))
+sys.path.insert(0, os.path.join(BASE_PATH, b'src'))
+
+from ConfigParser import SafeConfigParser
+from twisted.internet import defer, reactor, task
+from twisted.web.client import Agent, FileBodyProducer, HTTPConnectionPool, \
+    readBody
+from twisted.web.http_headers import Headers
+from io import BytesIO
+from pba.core import daemon
+from pba.client.web import create_site
+
+LATENCY_BUCKETS_MS = [0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000]
+
+
+class LatencyHistogram(object):
+    def __init__(self):
+        self.latencies = []
+        self.counts = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+
+    def observe(self, seconds):
+        self.latencies.append(seconds)
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS_MS, seconds * 1000)] += 1
+
+    def report(self):
+        latencies = sorted(self.latencies)
+        report = {'count': len(latencies)}
+        if latencies:
+            report['latency_ms'] = dict(('p{}'.format(percentile),
+                    latencies[int(round(percentile / 100 \
+                            * (len(latencies) - 1)))] * 1000) \
+                    for percentile in (50, 90, 99))
+            report['latency_ms']['max'] = latencies[-1] * 1000
+        report['histogram_ms'] = dict(('le_{}'.format(bound), count) \
+                for bound, count in zip(LATENCY_BUCKETS_MS + ['inf'],
+                        self.counts))
+        return report
+
+
+class ReactorLagMonitor(object):
+    """Measures by how much a periodic call is delayed."""
+    def __init__(self, interval):
+        self._interval = interval
+        self._loop = task.LoopingCall(self._tick)
+        self._last_tick = None
+        self.histogram = LatencyHistogram()
+
+    def start(self):
+        self._loop.start(self._interval)
+
+    def stop(self):
+        self._loop.stop()
+
+    def _tick(self):
+        now = default_timer()
+        if self._last_tick is not None:
+            self.histogram.observe(max(0, now - self._last_tick \
+                    - self._interval))
+        self._last_tick = now
+
+
+class LoadGenerator(object):
+    def __init__(self, args, base_url, sprinkler_ids):
+        self._args = args
+        self._base_url = base_url
+        self._sprinkler_ids = sprinkler_ids
+        self._rnd = random.Random(args.seed)
+        pool = HTTPConnectionPool(reactor, persistent=True)
+        pool.maxPersistentPerHost = args.concurrency
+        self._agent = Agent(reactor, pool=pool)
+        self._pool = pool
+        self._job_ids = []
+        self.histograms = {}
+        self.errors = 0
+        self.num_requests = 0
+
+        read_requests = [
+            (self._get, '/jobs'),
+            (self._get, '/jobs/active'),
+            (self._get, '/jobs/waiting'),
+            (self._get, '/courts'),
+            (self._get_court, '/courts/<id>'),
+            (self._get, '/status'),
+        ]
+        write_requests = [
+            (self._add_job, 'POST /jobs'),
+            (self._add_court_job, 'POST /courts/<id>'),
+            (self._cancel_job, 'DELETE /jobs/<id>'),
+        ]
+        self._requests = [(args.read_weight / len(read_requests), request) \
+                for request in read_requests] \
+                + [(args.write_weight / len(write_requests), request) \
+                for request in write_requests]
+
+    @defer.inlineCallbacks
+    def run(self):
+        self._deadline = default_timer() + self._args.duration
+        yield defer.DeferredList([self._run_client() \
+                for _ in range(self._args.concurrency)])
+        yield self._pool.closeCachedConnections()
+
+    @defer.inlineCallbacks
+    def _run_client(self):
+        while default_timer() < self._deadline:
+            func, name = self._choose_request()
+            start = default_timer()
+            try:
+                yield func(name)
+            except Exception as e:
+                self.errors += 1
+                print('request {} failed: {}'.format(name, e),
+                        file=sys.stderr)
+            self.histograms.setdefault(name, LatencyHistogram()).observe(
+                    default_timer() - start)
+            self.num_requests += 1
+
+    def _choose_request(self):
+        choice = self._rnd.random() * sum(weight \
+                for weight, _ in self._requests)
+        for weight, request in self._requests:
+            choice -= weight
+            if choice < 0:
+                return request
+        return self._requests[-1][1]
+
+    @defer.inlineCallbacks
+    def _request(self, method, path, data=None):
+        body = None
+        if data is not None:
+            body = FileBodyProducer(BytesIO(json.dumps(data).encode('utf-8')))
+        response = yield self._agent.request(method,
+                (self._base_url + path).encode('ascii'),
+                Headers({b'Content-Type': [b'application/json']}), body)
+        content = yield readBody(response)
+        if response.code >= 400:
+            raise RuntimeError('HTTP status {}'.format(response.code))
+        defer.returnValue(content)
+
+    def _get(self, path):
+        return self._request(b'GET', path)
+
+    def _get_court(self, _):
+        return self._request(b'GET', '/courts/{}'.format(
+                self._rnd.choice(self._sprinkler_ids)))
+
+    def _new_job(self):
+        return {
+            'duration': self._rnd.randint(self._args.min_duration,
+                    self._args.max_duration),
+            'high_priority': self._rnd.random() < 0.2,
+        }
+
+    @defer.inlineCallbacks
+    def _add_job(self, _):
+        job = self._new_job()
+        job['sprinkler_id'] = self._rnd.choice(self._sprinkler_ids)
+        content = yield self._request(b'POST', '/jobs', job)
+        self._job_ids.append(json.loads(content)['job_id'])
+
+    def _add_court_job(self, _):
+        return self._request(b'POST', '/courts/{}'.format(
+                self._rnd.choice(self._sprinkler_ids)), self._new_job())
+
+    def _cancel_job(self, _):
+        if not self._job_ids:
+            return self._add_job(_)
+        idx = self._rnd.randrange(len(self._job_ids))
+        self._job_ids[idx], self._job_ids[-1] = \
+                self._job_ids[-1], self._job_ids[idx]
+        # The job may already have finished, which is answered with an
+        # error and still counts as a request.
+        d = self._request(b'DELETE', '/jobs/{}'.format(self._job_ids.pop()))
+        d.addErrback(lambda _: None)
+        return d
+
+
+def create_config(zones):
+    config = SafeConfigParser()
+    config.add_section('sprinklers')
+    for zone in range(zones):
+        config.set('sprinklers', 'court{}'.format(zone + 1), 'dummy')
+    return config
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--zones', type=int, default=6)
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--duration', type=float, default=10,
+            help='seconds to run the load test')
+    parser.add_argument('--read-weight', type=float, default=0.9)
+    parser.add_argument('--write-weight', type=float, default=0.1)
+    parser.add_argument('--min-duration', type=int, default=1,
+            help='minimum duration of the generated jobs')
+    parser.add_argument('--max-duration', type=int, default=5,
+            help='maximum duration of the generated jobs')
+    parser.add_argument('--lag-interval', type=float, default=0.01,
+            help='interval of the reactor lag probe')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the results to this file')
+    return parser.parse_args()
+
+
+@defer.inlineCallbacks
+def run(args):
+    os.chdir(BASE_PATH)
+    job_queue, sprinkler_ctrl, _ = daemon.main(create_config(args.zones))
+    port = reactor.listenTCP(0, create_site(job_queue, sprinkler_ctrl),
+            interface='127.0.0.1')
+    base_url = 'http://127.0.0.1:{}'.format(port.getHost().port)
+
+    generator = LoadGenerator(args, base_url,
+            sorted(sprinkler_ctrl.sprinkler_ids))
+    lag_monitor = ReactorLagMonitor(args.lag_interval)
+    lag_monitor.start()
+    start = default_timer()
+    yield generator.run()
+    duration = default_timer() - start
+    lag_monitor.stop()
+    yield port.stopListening()
+    job_queue.remove_all_jobs()
+
+    defer.returnValue({
+        'parameters': vars(args),
+        'total_seconds': duration,
+        'requests': generator.num_requests,
+        'requests_per_sec': generator.num_requests / duration,
+        'errors': generator.errors,
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'reactor_lag': lag_monitor.histogram.report(),
+        'endpoints': dict((name, histogram.report()) \
+                for name, histogram in generator.histograms.items()),
+    })
+
+
+def main():
+    args = parse_args()
+    results = {}
+
+    def on_done(result):
+        results.update(result)
+        reactor.stop()
+
+    def on_failure(failure):
+        failure.printTraceback()
+        reactor.stop()
+
+    # The job queue reports every job start on stdout.
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        reactor.callWhenRunning(
+                lambda: run(args).addCallbacks(on_done, on_failure))
+        reactor.run()
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as fp:
+            fp.write(output)
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
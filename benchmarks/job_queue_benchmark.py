@@ -0,0 +1,188 @@
+#!/usr/bin/python
+# vim:set ts=4 sw=4 et:
+"""Benchmarks the job queue and the interceptor chain on a virtual clock.
+
+Builds a SprinklerJobQueue with dummy sprinklers and the interceptors of
+the daemon on top of twisted.internet.task.Clock, drives a random but
+reproducible workload through it and prints the results as JSON.
+"""
+from __future__ import (absolute_import, division, print_function,
+        unicode_literals)
+import argparse
+import json
+import os
+import os.path
+import random
+import resource
+import sys
+import time
+from timeit import default_timer
+
+PYTHON_BASE_PATH = os.path.join(
+        os.path.abspath(os.path.dirname(sys.argv[0])), b'..', b'src')
+sys.path.insert(0, PYTHON_BASE_PATH)
+
+from twisted.internet import task
+from pba.core import daemon
+from pba.core.controller import SprinklerController
+from pba.core.job_queue import MaxActiveSprinklerJobPolicy, SprinklerJobQueue
+from pba.core.scheduler import TimerScheduler
+from pba.core.sprinkler_config import TestSprinkler
+
+
+class LatencyRecorder(object):
+    def __init__(self):
+        self._latencies = {}
+
+    def measure(self, operation, func, *args, **kwargs):
+        start = default_timer()
+        result = func(*args, **kwargs)
+        self._latencies.setdefault(operation, []).append(
+                default_timer() - start)
+        return result
+
+    def report(self):
+        report = {}
+        for operation, latencies in sorted(self._latencies.items()):
+            latencies.sort()
+            total = sum(latencies)
+            report[operation] = {
+                'count': len(latencies),
+                'ops_per_sec': len(latencies) / total if total else None,
+                'latency_us': dict(('p{}'.format(percentile),
+                        percentile_of(latencies, percentile) * 1e6) \
+                        for percentile in (50, 90, 99, 99.9)),
+            }
+            report[operation]['latency_us']['max'] = latencies[-1] * 1e6
+        return report
+
+
+def percentile_of(sorted_values, percentile):
+    idx = int(round(percentile / 100 * (len(sorted_values) - 1)))
+    return sorted_values[idx]
+
+
+def create_job_queue(args, clock):
+    scheduler = TimerScheduler(clock)
+    sprinkler_ctrl = SprinklerController()
+    for zone in range(args.zones):
+        sprinkler_id = 'zone{}'.format(zone)
+        sprinkler_ctrl.add_sprinkler(sprinkler_id, TestSprinkler(sprinkler_id))
+    daemon.load_sprinkler_interceptors(sprinkler_ctrl, scheduler=scheduler,
+            max_active_sprinklers=args.max_active)
+    queue_policy = MaxActiveSprinklerJobPolicy(max_total=args.max_active,
+            max_low_priority=args.max_active)
+    return SprinklerJobQueue(clock, sprinkler_ctrl, queue_policy,
+            scheduler=scheduler)
+
+
+def run_workload(args, clock, job_queue, recorder):
+    rnd = random.Random(args.seed)
+    job_ids = []
+
+    def add_job():
+        job = recorder.measure('add', job_queue.add,
+                'zone{}'.format(rnd.randrange(args.zones)),
+                rnd.randint(args.min_duration, args.max_duration),
+                rnd.random() < args.high_priority_ratio)
+        job_ids.append(job.job_id)
+
+    def pick_job():
+        while job_ids:
+            idx = rnd.randrange(len(job_ids))
+            job_ids[idx], job_ids[-1] = job_ids[-1], job_ids[idx]
+            job = job_queue.get_job(job_ids[-1])
+            if job is not None:
+                return job
+            job_ids.pop()
+        return None
+
+    for _ in range(args.initial_jobs):
+        add_job()
+
+    for _ in range(args.operations):
+        choice = rnd.random()
+        if choice < args.cancel_ratio:
+            job = pick_job()
+            if job is None:
+                continue
+            job_ids.pop()
+            if job_queue.is_job_active(job.job_id):
+                recorder.measure('cancel_active', job_queue.remove_active_job,
+                        job.job_id)
+            else:
+                recorder.measure('cancel_waiting',
+                        job_queue.remove_waiting_job, job.job_id)
+        elif choice < args.cancel_ratio + args.edit_ratio:
+            job = pick_job()
+            if job is None:
+                continue
+            recorder.measure('change_duration', setattr, job, 'duration',
+                    rnd.randint(args.min_duration, args.max_duration))
+        elif choice < args.cancel_ratio + args.edit_ratio + args.lookup_ratio:
+            recorder.measure('court_lookup', job_queue.get_job_for_sprinkler,
+                    'zone{}'.format(rnd.randrange(args.zones)))
+        else:
+            add_job()
+        recorder.measure('advance_clock', clock.advance, args.tick)
+
+    while job_queue.list_jobs() and args.drain:
+        recorder.measure('advance_clock', clock.advance, args.max_duration)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--zones', type=int, default=1000)
+    parser.add_argument('--initial-jobs', type=int, default=100000)
+    parser.add_argument('--operations', type=int, default=100000)
+    parser.add_argument('--max-active', type=int, default=2)
+    parser.add_argument('--min-duration', type=int, default=10)
+    parser.add_argument('--max-duration', type=int, default=300)
+    parser.add_argument('--high-priority-ratio', type=float, default=0.2)
+    parser.add_argument('--cancel-ratio', type=float, default=0.2)
+    parser.add_argument('--edit-ratio', type=float, default=0.2)
+    parser.add_argument('--lookup-ratio', type=float, default=0.2)
+    parser.add_argument('--tick', type=float, default=1.0,
+            help='virtual seconds that pass after each operation')
+    parser.add_argument('--drain', action='store_true',
+            help='keep advancing the clock until all jobs are done')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the results to this file')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    clock = task.Clock()
+    clock.advance(time.time())
+    job_queue = create_job_queue(args, clock)
+    recorder = LatencyRecorder()
+
+    # The job queue reports every job start on stdout.
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    start = default_timer()
+    try:
+        run_workload(args, clock, job_queue, recorder)
+    finally:
+        duration = default_timer() - start
+        sys.stdout.close()
+        sys.stdout = stdout
+
+    results = {
+        'parameters': vars(args),
+        'total_seconds': duration,
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'remaining_jobs': len(job_queue.list_jobs()),
+        'operations': recorder.report(),
+    }
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as fp:
+            fp.write(output)
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
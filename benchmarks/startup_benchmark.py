@@ -0,0 +1,209 @@
+#!/usr/bin/python
+# vim:set ts=4 sw=4 et:
+"""Cold start benchmark.
+
+Emulates the sysfs GPIO tree in a temporary directory, in which the files
+of an exported port only appear after `--export-latency` seconds, like
+they do once the kernel and udev are done with it.  Measures how long
+setting up the GPIO sprinklers takes one port at a time and with all
+ports exported at once, and how long it takes from starting the daemon
+until it answers its first request.  The results are printed as JSON.
+"""
+from __future__ import (absolute_import, division, print_function,
+        unicode_literals)
+import argparse
+import httplib
+import json
+import os
+import os.path
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from timeit import default_timer
+
+BASE_PATH = os.path.abspath(os.path.join(os.path.dirname(sys.argv[0]), b'..'))
+sys.path.insert(0, os.path.join(BASE_PATH, b'src'))
+
+from ConfigParser import SafeConfigParser
+from pba.core.gpio import GpioController
+from pba.core.sprinkler_config import load_sprinklers, setup_sprinklers
+
+FIRST_PORT = 10
+
+
+class FakeSysfs(object):
+    """A sysfs GPIO directory whose `export` file is a FIFO, read by a
+    thread that creates the port directories after `export_latency`."""
+    def __init__(self, export_latency):
+        self.base_path = tempfile.mkdtemp(prefix='pba-gpio-')
+        self._export_latency = export_latency
+        self._export_path = os.path.join(self.base_path, 'export')
+        os.mkfifo(self._export_path)
+        self._running = True
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while self._running:
+            with open(self._export_path, 'rb') as fp:
+                data = fp.read()
+            for port_id in data.split():
+                timer = threading.Timer(self._export_latency,
+                        self._create_port, [int(port_id)])
+                timer.daemon = True
+                timer.start()
+
+    def _create_port(self, port_id):
+        # The port appears at once, as if it was created by the kernel.
+        tmp_path = os.path.join(self.base_path, '.gpio{}'.format(port_id))
+        os.mkdir(tmp_path)
+        for name, value in (('direction', 'in'), ('active_low', '0'),
+                ('value', '0')):
+            with open(os.path.join(tmp_path, name), 'w') as fp:
+                fp.write(value)
+        os.rename(tmp_path, os.path.join(self.base_path,
+                'gpio{}'.format(port_id)))
+
+    def unexport_all(self):
+        for name in os.listdir(self.base_path):
+            if name.startswith('gpio'):
+                shutil.rmtree(os.path.join(self.base_path, name))
+
+    def close(self):
+        self._running = False
+        # Unblocks the reader.
+        with open(self._export_path, 'wb'):
+            pass
+        self._thread.join()
+        shutil.rmtree(self.base_path)
+
+
+def write_config(path, base_path, zones):
+    config = SafeConfigParser()
+    config.read(os.path.join(BASE_PATH, 'test-example.conf'))
+    config.remove_section('sprinklers')
+    config.add_section('sprinklers')
+    for zone in range(zones):
+        config.set('sprinklers', 'court{}'.format(zone + 1),
+                'gpio {} false'.format(FIRST_PORT + zone))
+    config.add_section('gpio')
+    config.set('gpio', 'base_path', base_path)
+    with open(path, 'w') as fp:
+        config.write(fp)
+    return config
+
+
+def time_setup(config, fake_sysfs, batched):
+    fake_sysfs.unexport_all()
+    gpio_ctrl = GpioController(base_path=fake_sysfs.base_path)
+    sprinklers = []
+    load_sprinklers(config, gpio_ctrl,
+            lambda sprinkler_name, sprinkler: sprinklers.append(sprinkler))
+    start = default_timer()
+    if batched:
+        setup_sprinklers(sprinklers, gpio_ctrl)
+    else:
+        for sprinkler in sprinklers:
+            if not sprinkler.is_setup:
+                sprinkler.setup()
+    return default_timer() - start
+
+
+def get_free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def time_first_request(config_path, timeout):
+    port = get_free_port()
+    with open(os.devnull, 'w') as devnull:
+        start = default_timer()
+        process = subprocess.Popen([sys.executable,
+                os.path.join(BASE_PATH, 'pba'), '-c', config_path,
+                '-p', str(port)], cwd=BASE_PATH, stdout=devnull,
+                stderr=devnull)
+        try:
+            while default_timer() - start < timeout:
+                if process.poll() is not None:
+                    raise RuntimeError('daemon exited with status {}'.format(
+                            process.returncode))
+                connection = httplib.HTTPConnection('127.0.0.1', port,
+                        timeout=timeout)
+                try:
+                    connection.request('GET', '/status')
+                    if connection.getresponse().status == httplib.OK:
+                        return default_timer() - start
+                except (httplib.HTTPException, socket.error):
+                    time.sleep(0.005)
+                finally:
+                    connection.close()
+            raise RuntimeError('daemon did not answer within {} seconds' \
+                    .format(timeout))
+        finally:
+            process.terminate()
+            process.wait()
+
+
+def summarize(seconds):
+    seconds = sorted(seconds)
+    return {
+        'median_ms': seconds[len(seconds) // 2] * 1000,
+        'min_ms': seconds[0] * 1000,
+        'max_ms': seconds[-1] * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--zones', type=int, default=16,
+            help='number of GPIO sprinklers (default: %(default)s)')
+    parser.add_argument('--export-latency', type=float, default=0.02,
+            help='seconds until the files of an exported port appear ' \
+                    '(default: %(default)s)')
+    parser.add_argument('--runs', type=int, default=5,
+            help='number of runs of each measurement (default: %(default)s)')
+    parser.add_argument('--timeout', type=float, default=30,
+            help='seconds to wait for the daemon (default: %(default)s)')
+    parser.add_argument('--output', help='also write the results to this file')
+    args = parser.parse_args()
+
+    fake_sysfs = FakeSysfs(args.export_latency)
+    config_path = os.path.join(fake_sysfs.base_path, 'pba.conf')
+    try:
+        config = write_config(config_path, fake_sysfs.base_path, args.zones)
+        sequential = [time_setup(config, fake_sysfs, batched=False) \
+                for _ in range(args.runs)]
+        batched = [time_setup(config, fake_sysfs, batched=True) \
+                for _ in range(args.runs)]
+        # The daemon is started with all ports exported, as after
+        # gpio-config.
+        first_request = [time_first_request(config_path, args.timeout) \
+                for _ in range(args.runs)]
+    finally:
+        fake_sysfs.close()
+
+    results = {
+        'zones': args.zones,
+        'export_latency_ms': args.export_latency * 1000,
+        'runs': args.runs,
+        'gpio_setup_sequential': summarize(sequential),
+        'gpio_setup_batched': summarize(batched),
+        'time_to_first_request': summarize(first_request),
+    }
+    print(json.dumps(results, indent=2, sort_keys=True))
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(results, fp, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,46 +1,147 @@
 #!/usr/bin/python
 # vim:set ts=4 sw=4 et:
+"""Remote control for the irrigation controller daemon."""
 from __future__ import (absolute_import, division, print_function,
         unicode_literals)
-import urllib2
-import json
+import argparse
+import os.path
 import sys
 
+PYTHON_BASE_PATH = os.path.join(
+        os.path.abspath(os.path.dirname(sys.argv[0])), b'src')
+sys.path.insert(0, PYTHON_BASE_PATH)
+
+from pba.client.remote import PbaClientError, connect
+
 BASE_URL = 'http://localhost:8080'
 
 
-def add_job(sprinkler_id, duration):
-    jsondata = json.dumps({
-        'sprinkler_id': sprinkler_id,
-        'duration': duration,
-        'high_priority': False
-        })
-    url = BASE_URL + '/jobs'
-    req = urllib2.Request(url, jsondata, {'Content-Type': 'application/json'})
-    f = urllib2.urlopen(req)
-    response = f.read()
-    f.close()
-    job_id = json.loads(response)['job_id']
-    print('added job with id {0}'.format(job_id))
+def print_job(job):
+    print('job {job_id}: {sprinkler_id} {status}, {duration} seconds, ' \
+            'priority {priority} (effective {effective_priority:.2f})' \
+            .format(**job))
+
+
+def pairs(values, first_type, second_type):
+    if len(values) % 2:
+        raise ValueError('expected pairs of values')
+    return [(first_type(values[idx]), second_type(values[idx + 1])) \
+            for idx in range(0, len(values), 2)]
+
+
+def add_job(client, args):
+    priority = args.priority
+    if priority is None:
+        priority = 1 if args.high_priority else 0
+    jobs = [(sprinkler_id, duration, priority) \
+            for sprinkler_id, duration in pairs(args.jobs, unicode, int)]
+    for job in client.add_jobs(jobs):
+        print('added job with id {0}'.format(job['job_id']))
+
+
+def add_sequence(client, args):
+    priority = args.priority
+    if priority is None:
+        priority = 1 if args.high_priority else 0
+    sequence = client.add_sequence(pairs(args.steps, unicode, int),
+            priority=priority, overlap=args.overlap)
+    print('added sequence with id {0}'.format(sequence['sequence_id']))
+
+
+def list_jobs(client, args):
+    for job in client.list_jobs():
+        print_job(job)
+
+
+def cancel(client, args):
+    for job in client.cancel_jobs(job_ids=args.job_ids,
+            sprinkler_ids=args.courts, sequence_ids=args.sequences):
+        print('cancelled job with id {0}'.format(job['job_id']))
+
+
+def change_duration(client, args):
+    for job in client.change_durations(pairs(args.durations, int, int)):
+        print_job(job)
+
+
+def watch(client, args):
+    try:
+        for event, data in client.watch():
+            if 'job_id' in data:
+                print('{}: job {} ({})'.format(event, data['job_id'],
+                        data['sprinkler_id']))
+            else:
+                print('{}: {}'.format(event, data))
+            sys.stdout.flush()
+    except KeyboardInterrupt:
+        pass
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--url', default=BASE_URL,
+            help='base URL of the daemon (default: %(default)s)')
+    parser.add_argument('--socket',
+            help='use the local command socket of the daemon instead')
+    subparsers = parser.add_subparsers()
+
+    add_parser = subparsers.add_parser('add-job',
+            help='add jobs, all in one batch')
+    add_parser.add_argument('jobs', nargs='+',
+            metavar='SPRINKLER_ID DURATION')
+    add_parser.add_argument('--high-priority', action='store_true',
+            help='same as --priority 1')
+    add_parser.add_argument('--priority', type=int)
+    add_parser.set_defaults(func=add_job)
+
+    sequence_parser = subparsers.add_parser('add-sequence',
+            help='add jobs that run one after the other')
+    sequence_parser.add_argument('steps', nargs='+',
+            metavar='SPRINKLER_ID DURATION')
+    sequence_parser.add_argument('--overlap', type=int, default=0,
+            help='seconds for which each valve opens before the previous ' \
+                    'one closes (default: %(default)s)')
+    sequence_parser.add_argument('--high-priority', action='store_true',
+            help='same as --priority 1')
+    sequence_parser.add_argument('--priority', type=int)
+    sequence_parser.set_defaults(func=add_sequence)
+
+    list_parser = subparsers.add_parser('list', help='list all jobs')
+    list_parser.set_defaults(func=list_jobs)
+
+    cancel_parser = subparsers.add_parser('cancel',
+            help='cancel jobs, all jobs of courts and sequences, ' \
+                    'all in one batch')
+    cancel_parser.add_argument('job_ids', nargs='*', type=int,
+            metavar='JOB_ID')
+    cancel_parser.add_argument('--court', dest='courts', action='append',
+            default=[], metavar='SPRINKLER_ID')
+    cancel_parser.add_argument('--sequence', dest='sequences',
+            action='append', default=[], type=int, metavar='SEQUENCE_ID')
+    cancel_parser.set_defaults(func=cancel)
 
+    change_parser = subparsers.add_parser('change-duration',
+            help='change the duration of jobs')
+    change_parser.add_argument('durations', nargs='+',
+            metavar='JOB_ID DURATION')
+    change_parser.set_defaults(func=change_duration)
 
-def show_usage():
-    print('usage: {0} add-job SPRINKLER_ID DURATION'.format(sys.argv[0]),
-            file=sys.stderr)
-    sys.exit(1)
+    watch_parser = subparsers.add_parser('watch',
+            help='print job and sprinkler events as they happen')
+    watch_parser.set_defaults(func=watch)
+    return parser.parse_args()
 
 
 def main():
-    if len(sys.argv) != 4:
-        show_usage()
-    cmd = sys.argv[1]
-    if cmd == 'add-job':
-        sprinkler_id = sys.argv[2]
-        duration = int(sys.argv[3])
-        add_job(sprinkler_id, duration)
-    else:
-        print('error: unknown command {0}'.format(cmd), file=sys.stderr)
-        show_usage()
+    args = parse_args()
+    client = connect(base_url=args.url, socket_path=args.socket)
+    try:
+        args.func(client, args)
+    except (PbaClientError, ValueError) as e:
+        print('error: {0}'.format(e), file=sys.stderr)
+        sys.exit(1)
+    finally:
+        client.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,116 @@
+# vim:set ts=4 sw=4 et:
+"""Local UNIX domain socket for on-box automation.
+
+Every line sent to the socket is a JSON command of the form
+{"id": 1, "command": "list_jobs", "args": {}}, answered by a line
+{"id": 1, "result": ...} or {"id": 1, "error": "..."}.  Commands may be
+pipelined.  After a "watch" command, all job and sprinkler events are
+sent as {"id": 1, "event": "...", "data": {...}} lines.
+"""
+from __future__ import (absolute_import, division, print_function,
+        unicode_literals)
+import json
+from twisted.internet.protocol import Factory
+from twisted.protocols.basic import LineOnlyReceiver
+from pba.client.web import court_status, get_priority
+
+
+class CommandProtocol(LineOnlyReceiver):
+    delimiter = b'\n'
+    MAX_LENGTH = 1024 * 1024
+
+    def __init__(self, job_queue, sprinkler_ctrl):
+        self._job_queue = job_queue
+        self._sprinkler_ctrl = sprinkler_ctrl
+        self._watching = False
+        self._watch_id = None
+        self._commands = {
+            'add_jobs': self._add_jobs,
+            'add_sequence': self._add_sequence,
+            'list_jobs': self._list_jobs,
+            'cancel_jobs': self._cancel_jobs,
+            'change_duration': self._change_duration,
+            'status': self._status,
+            'watch': self._watch,
+        }
+
+    def lineReceived(self, line):
+        request_id = None
+        try:
+            message = json.loads(line.decode('utf-8'))
+            request_id = message.get('id')
+            command = self._commands[message['command']]
+            result = command(request_id, **message.get('args', {}))
+        except (ValueError, KeyError, TypeError, AttributeError,
+                RuntimeError) as e:
+            self._send({'id': request_id, 'error': '{}: {}'.format(
+                    e.__class__.__name__, e)})
+            return
+        self._send({'id': request_id, 'result': result})
+
+    def lineLengthExceeded(self, line):
+        self._send({'id': None, 'error': 'command too long'})
+        self.transport.loseConnection()
+
+    def connectionLost(self, reason):
+        if self._watching:
+            self._job_queue.remove_listener(self._on_job_events)
+            self._sprinkler_ctrl.remove_listener(self._on_sprinkler_event)
+
+    def _send(self, message):
+        self.sendLine(json.dumps(message).encode('utf-8'))
+
+    def _add_jobs(self, request_id, jobs):
+        return [job.for_json() for job in self._job_queue.add_jobs(
+                (job['sprinkler_id'], job['duration'], get_priority(job)) \
+                for job in jobs)]
+
+    def _add_sequence(self, request_id, steps, overlap=0, **sequence):
+        return self._job_queue.add_sequence(
+                ((step['sprinkler_id'], step['duration']) for step in steps),
+                priority=get_priority(sequence), overlap=overlap).for_json()
+
+    def _list_jobs(self, request_id):
+        return [job.for_json() for job in self._job_queue.list_jobs()]
+
+    def _cancel_jobs(self, request_id, job_ids=(), sprinkler_ids=(),
+            sequence_ids=()):
+        return [job.for_json() for job in self._job_queue.remove_jobs(
+                job_ids=job_ids, sprinkler_ids=sprinkler_ids,
+                sequence_ids=sequence_ids)]
+
+    def _change_duration(self, request_id, job_id, duration):
+        job = self._job_queue.get_job(job_id)
+        if job is None:
+            raise RuntimeError('Invalid job id {}'.format(job_id))
+        job.duration = duration
+        return job.for_json()
+
+    def _status(self, request_id):
+        return {'courts': [court_status(sprinkler_id, self._job_queue) \
+                for sprinkler_id in self._sprinkler_ctrl.iter_sprinkler_ids()]}
+
+    def _watch(self, request_id):
+        if not self._watching:
+            self._job_queue.add_listener(self._on_job_events)
+            self._sprinkler_ctrl.add_listener(self._on_sprinkler_event)
+            self._watching = True
+        self._watch_id = request_id
+
+    def _on_job_events(self, events):
+        for event, job in events:
+            self._send({'id': self._watch_id, 'event': event,
+                    'data': job.for_json()})
+
+    def _on_sprinkler_event(self, event, sprinkler_id):
+        self._send({'id': self._watch_id, 'event': event,
+                'data': {'sprinkler_id': sprinkler_id}})
+
+
+class CommandFactory(Factory):
+    def __init__(self, job_queue, sprinkler_ctrl):
+        self._job_queue = job_queue
+        self._sprinkler_ctrl = sprinkler_ctrl
+
+    def buildProtocol(self, addr):
+        return CommandProtocol(self._job_queue, self._sprinkler_ctrl)
@@ -0,0 +1,147 @@
+# vim:set ts=4 sw=4 et:
+from __future__ import (absolute_import, division, print_function,
+        unicode_literals)
+from collections import deque
+import json
+from zope.interface import implementer
+from twisted.internet import task
+from twisted.internet.interfaces import IPushProducer
+from twisted.web import resource, server
+
+
+def encode_event(event_id, event, data):
+    return 'id: {}\nevent: {}\ndata: {}\n\n'.format(event_id, event,
+            json.dumps(data)).encode('utf-8')
+
+
+@implementer(IPushProducer)
+class EventStreamSubscriber(object):
+    """Single Server-Sent Events client.
+
+    Events are written directly while the connection keeps up.  While the
+    transport asks us to pause, at most `max_buffered_events` events are
+    buffered; a client that falls further behind is disconnected and
+    expected to reconnect and resynchronise.
+    """
+    def __init__(self, broadcaster, request, max_buffered_events):
+        self._broadcaster = broadcaster
+        self._request = request
+        self._max_buffered_events = max_buffered_events
+        self._buffered_events = deque()
+        self._paused = False
+        self._closed = False
+
+    def send(self, encoded_event):
+        if self._closed:
+            return
+        if not self._paused:
+            self._request.write(encoded_event)
+        elif len(self._buffered_events) < self._max_buffered_events:
+            self._buffered_events.append(encoded_event)
+        else:
+            print('event stream client {} fell behind, disconnecting'.format(
+                    self._request.getClientIP()))
+            self.close()
+            self._request.transport.loseConnection()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._buffered_events.clear()
+        self._broadcaster.unsubscribe(self)
+
+    def pauseProducing(self):
+        self._paused = True
+
+    def resumeProducing(self):
+        self._paused = False
+        while self._buffered_events and not self._paused:
+            self._request.write(self._buffered_events.popleft())
+
+    def stopProducing(self):
+        self.close()
+
+
+class EventBroadcaster(object):
+    """Fans job and sprinkler state changes out to all event stream
+    subscribers.  Each event is encoded once, regardless of the number of
+    subscribers.
+    """
+    HEARTBEAT_INTERVAL = 15
+
+    def __init__(self, sprinkler_ctrl, job_queue, clock,
+            max_buffered_events=100):
+        self._clock = clock
+        self._max_buffered_events = max_buffered_events
+        self._subscribers = set()
+        self._last_event_id = 0
+        self._heartbeat = None
+
+        job_queue.add_listener(self._on_job_events)
+        sprinkler_ctrl.add_listener(self._on_sprinkler_event)
+
+    def subscribe(self, request):
+        subscriber = EventStreamSubscriber(self, request,
+                self._max_buffered_events)
+        self._subscribers.add(subscriber)
+        if self._heartbeat is None:
+            self._heartbeat = task.LoopingCall(self._send_heartbeat)
+            self._heartbeat.clock = self._clock
+            self._heartbeat.start(self.HEARTBEAT_INTERVAL, now=False)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        self._subscribers.discard(subscriber)
+        if not self._subscribers and self._heartbeat is not None:
+            self._heartbeat.stop()
+            self._heartbeat = None
+
+    @property
+    def num_subscribers(self):
+        return len(self._subscribers)
+
+    def _on_job_events(self, events):
+        if len(events) == 1:
+            event, job = events[0]
+            self._broadcast(event, job.for_json())
+        else:
+            self._broadcast('batch', [{'event': event, 'job': job.for_json()} \
+                    for event, job in events])
+
+    def _on_sprinkler_event(self, event, sprinkler_id):
+        self._broadcast(event, {'sprinkler_id': sprinkler_id})
+
+    def _broadcast(self, event, data):
+        if not self._subscribers:
+            return
+        self._last_event_id += 1
+        self._send(encode_event(self._last_event_id, event, data))
+
+    def _send_heartbeat(self):
+        self._send(b':\n\n')
+
+    def _send(self, encoded_event):
+        for subscriber in list(self._subscribers):
+            subscriber.send(encoded_event)
+
+
+class EventStreamResource(resource.Resource):
+    isLeaf = True
+    # Not recorded by InstrumentedRequest.
+    streaming = True
+
+    def __init__(self, broadcaster):
+        resource.Resource.__init__(self)
+        self._broadcaster = broadcaster
+
+    def render_GET(self, request):
+        request.setHeader(b'Content-Type', b'text/event-stream')
+        request.setHeader(b'Cache-Control', b'no-cache')
+        request.setHeader(b'X-Accel-Buffering', b'no')
+        request.write(b'retry: 3000\n\n')
+
+        subscriber = self._broadcaster.subscribe(request)
+        request.registerProducer(subscriber, True)
+        request.notifyFinish().addBoth(lambda _: subscriber.close())
+        return server.NOT_DONE_YET
@@ -0,0 +1,679 @@
+# vim:set ts=4 sw=4 et:
+"""Front-end of a federation of daemons.
+
+In a federation, every daemon (a shard) owns a part of the sprinklers of
+the site and runs their jobs in its own process, see [shard] in the
+configuration.  The front-end serves the /jobs and /courts API of a single
+daemon: requests for a court or a job are forwarded to the shard that owns
+it and lists are merged from all shards.  Shards are reached over pooled
+keep-alive connections to their HTTP API, on a UNIX domain socket or on
+(loopback) TCP.
+
+Shard i of n hands out the job ids j with j % n == i, so jobs and
+sequences are routed by their id.  Courts are routed by the sprinkler ids
+each shard reports, which are re-read periodically, after /admin/reload
+and whenever an unknown sprinkler id is asked for.
+
+A shard that does not answer within its timeout only fails the requests
+for its own courts and jobs.  Lists are merged from the shards that
+answered and the shards that did not are listed in the
+X-Unavailable-Shards header.
+"""
+from __future__ import (absolute_import, division, print_function,
+        unicode_literals)
+from collections import OrderedDict
+import heapq
+from io import BytesIO
+import json
+import numbers
+from zope.interface import implementer
+from twisted.internet import defer, reactor, task
+from twisted.internet.endpoints import clientFromString
+from twisted.python.failure import Failure
+from twisted.web import http, resource, server
+from twisted.web.client import Agent, FileBodyProducer, HTTPConnectionPool, \
+    readBody
+from twisted.web.http_headers import Headers
+from twisted.web.iweb import IAgentEndpointFactory
+from pba.client.web import CourtsResource, error_response, get_id_list, \
+    get_limit_arg, get_list, get_query_arg, json_response, load_json_body, \
+    parse_json_body, parse_new_job, parse_step, set_next_page_link
+
+FORWARDED_HEADERS = (b'Content-Type', b'Link')
+
+
+class ShardError(Exception):
+    pass
+
+
+class ShardResponse(object):
+    def __init__(self, shard, code, headers, body):
+        self.shard = shard
+        self.code = code
+        self.headers = headers
+        self.body = body
+
+    @property
+    def data(self):
+        return json.loads(self.body.decode('utf-8'))
+
+
+@implementer(IAgentEndpointFactory)
+class ShardEndpointFactory(object):
+    def __init__(self, endpoint):
+        self._endpoint = endpoint
+
+    def endpointForURI(self, uri):
+        return self._endpoint
+
+
+class Shard(object):
+    """HTTP client of one shard, reached at the endpoint `description`,
+    e.g. unix:path=/run/pba/shard0.sock or tcp:host=127.0.0.1:port=8081.
+    Up to `max_connections` idle keep-alive connections are kept for
+    reuse."""
+    TIMEOUT = 5
+
+    def __init__(self, index, description, clock=reactor,
+            max_connections=8, timeout=TIMEOUT):
+        self.index = index
+        self.description = description
+        self._clock = clock
+        self._timeout = timeout
+        pool = HTTPConnectionPool(clock)
+        pool.maxPersistentPerHost = max_connections
+        self._agent = Agent.usingEndpointFactory(clock,
+                ShardEndpointFactory(clientFromString(clock, description)),
+                pool=pool)
+
+    def __str__(self):
+        return 'shard {} ({})'.format(self.index, self.description)
+
+    def request(self, method, uri, body=None):
+        """Returns a Deferred firing with the ShardResponse, or failing
+        with ShardError if the shard cannot be reached or does not answer
+        in time."""
+        headers = Headers()
+        producer = None
+        if body is not None:
+            headers.setRawHeaders(b'Content-Type', [b'application/json'])
+            producer = FileBodyProducer(BytesIO(body))
+        d = self._agent.request(method, b'http://shard' + uri, headers,
+                producer)
+        d.addCallback(self._read_response)
+        timeout = self._clock.callLater(self._timeout, d.cancel)
+        d.addBoth(self._on_request_done, timeout)
+        return d
+
+    def request_json(self, method, uri, data=None):
+        body = None if data is None else json.dumps(data).encode('utf-8')
+        return self.request(method, uri, body)
+
+    def _read_response(self, response):
+        d = readBody(response)
+        d.addCallback(lambda body: ShardResponse(self, response.code,
+                response.headers, body))
+        return d
+
+    def _on_request_done(self, result, timeout):
+        if timeout.active():
+            timeout.cancel()
+        elif isinstance(result, Failure):
+            raise ShardError('{} did not answer within {} seconds'.format(
+                    self, self._timeout))
+        if isinstance(result, Failure):
+            raise ShardError('{} failed: {}'.format(self,
+                    result.getErrorMessage()))
+        return result
+
+
+def merge_sorted(lists, key):
+    """Merges lists that are each sorted by `key`."""
+    return [entry[-1] for entry in heapq.merge(*[
+            [(key(item), list_idx, item_idx, item) \
+                    for item_idx, item in enumerate(items)] \
+            for list_idx, items in enumerate(lists)])]
+
+
+class Federation(object):
+    """Routes requests to the shards."""
+    REFRESH_INTERVAL = 60
+
+    def __init__(self, shards, clock=reactor):
+        self.shards = shards
+        self._shard_for_sprinkler = {}
+        self._refresh_waiters = []
+        self._refresher = task.LoopingCall(self.refresh)
+        self._refresher.clock = clock
+
+    def start(self):
+        self._refresher.start(self.REFRESH_INTERVAL)
+
+    def get_shard_for_job(self, job_id):
+        return self.shards[job_id % len(self.shards)]
+
+    def get_shards_for_sprinklers(self, sprinkler_ids):
+        """Returns a Deferred firing with a dict of the shard of each
+        sprinkler, None for unknown sprinklers."""
+        shards = dict((sprinkler_id,
+                self._shard_for_sprinkler.get(sprinkler_id)) \
+                for sprinkler_id in sprinkler_ids)
+        if None not in shards.values():
+            return defer.succeed(shards)
+        d = self.refresh()
+        d.addCallback(lambda _: dict((sprinkler_id,
+                self._shard_for_sprinkler.get(sprinkler_id)) \
+                for sprinkler_id in sprinkler_ids))
+        return d
+
+    def refresh(self):
+        """Re-reads the sprinkler ids of all shards.  Calls while a refresh
+        is under way wait for it instead of starting another one."""
+        d = defer.Deferred()
+        self._refresh_waiters.append(d)
+        if len(self._refresh_waiters) == 1:
+            self.fan_out(b'GET', b'/courts').addCallback(self._on_refreshed)
+        return d
+
+    def _on_refreshed(self, result):
+        responses, unavailable = result
+        # The sprinklers of shards that did not answer stay where they are.
+        shard_for_sprinkler = dict((sprinkler_id, shard) \
+                for sprinkler_id, shard in self._shard_for_sprinkler.items() \
+                if shard in unavailable)
+        for response in responses:
+            if response.code != http.OK:
+                print('{} cannot list its courts: HTTP status {}'.format(
+                        response.shard, response.code))
+                continue
+            try:
+                courts = response.data
+            except ValueError as e:
+                print('{} sent invalid courts: {}'.format(response.shard, e))
+                continue
+            for court in courts:
+                sprinkler_id = court['sprinkler_id']
+                if sprinkler_id in shard_for_sprinkler:
+                    print('sprinkler {} is on both {} and {}'.format(
+                            sprinkler_id, shard_for_sprinkler[sprinkler_id],
+                            response.shard))
+                shard_for_sprinkler[sprinkler_id] = response.shard
+        self._shard_for_sprinkler = shard_for_sprinkler
+        waiters, self._refresh_waiters = self._refresh_waiters, []
+        for waiter in waiters:
+            waiter.callback(None)
+
+    def fan_out(self, method, uri, data=None, shards=None):
+        """Sends the request to all (or the given) shards.  Returns a
+        Deferred firing with the ShardResponses of the shards that answered
+        and the list of shards that did not."""
+        if shards is None:
+            shards = self.shards
+        d = defer.DeferredList([shard.request_json(method, uri, data) \
+                for shard in shards], consumeErrors=True)
+        d.addCallback(self._collect_responses, shards)
+        return d
+
+    @staticmethod
+    def _collect_responses(results, shards):
+        responses = []
+        unavailable = []
+        for shard, (success, result) in zip(shards, results):
+            if success:
+                responses.append(result)
+            else:
+                print(result.getErrorMessage())
+                unavailable.append(shard)
+        return responses, unavailable
+
+
+def respond_later(request, d):
+    """Finishes `request` with the body that `d` fires with, unless the
+    client went away in the meantime."""
+    lost = []
+    request.notifyFinish().addErrback(lost.append)
+
+    def on_shard_error(failure):
+        failure.trap(ShardError)
+        return error_response(request, http.BAD_GATEWAY,
+                failure.getErrorMessage())
+
+    def on_error(failure):
+        print('federated request {} failed: {}'.format(request.uri,
+                failure.getTraceback()))
+        return error_response(request, http.INTERNAL_SERVER_ERROR,
+                failure.getErrorMessage())
+
+    def finish(body):
+        if not lost:
+            request.write(body)
+            request.finish()
+
+    d.addErrback(on_shard_error)
+    d.addErrback(on_error)
+    d.addCallback(finish)
+    return server.NOT_DONE_YET
+
+
+def forward_response(request, response):
+    request.setResponseCode(response.code)
+    for name in FORWARDED_HEADERS:
+        values = response.headers.getRawHeaders(name)
+        if values:
+            request.setHeader(name, values[0])
+    return response.body
+
+
+def get_failed_response(responses):
+    for response in responses:
+        if response.code != http.OK:
+            return response
+    return None
+
+
+def merged_response(request, responses, unavailable, merge):
+    """Returns the JSON response of `merge(lists)` over the lists the
+    shards answered with."""
+    failed_response = get_failed_response(responses)
+    if failed_response is not None:
+        return forward_response(request, failed_response)
+    if not responses:
+        return error_response(request, http.BAD_GATEWAY,
+                'no shard is available')
+    if unavailable:
+        request.setHeader(b'X-Unavailable-Shards', ', '.join(
+                '{}'.format(shard.index) for shard in unavailable) \
+                .encode('ascii'))
+    return json_response(request,
+            merge([response.data for response in responses]))
+
+
+def merge_active_jobs(job_lists):
+    return merge_sorted(job_lists,
+            lambda job: (job['start_time'], job['job_id']))
+
+
+def merge_waiting_jobs(job_lists):
+    return merge_sorted(job_lists,
+            lambda job: (-job['effective_priority'], job['job_id']))
+
+
+def merge_page(request, item_lists, responses, key, limit, **query_args):
+    """Merges the pages the shards returned for the same page request.
+    Each shard returns up to `limit` items, of which the first `limit`
+    after merging make up the page."""
+    items = merge_sorted(item_lists, key)
+    if limit is None:
+        return items
+    has_more_pages = any(response.headers.hasHeader(b'Link') \
+            for response in responses)
+    if len(items) > limit or has_more_pages:
+        items = items[:limit]
+        set_next_page_link(request, limit=limit, cursor=key(items[-1]),
+                **query_args)
+    return items
+
+
+def is_page_request(request):
+    return get_query_arg(request, 'limit') is not None \
+            or get_query_arg(request, 'cursor') is not None
+
+
+def job_page_response(federation, request):
+    """Lists a page of jobs ordered by their job id, see
+    list_jobs_response()."""
+    try:
+        limit = get_limit_arg(request)
+    except ValueError as e:
+        return error_response(request, http.BAD_REQUEST, str(e))
+    d = federation.fan_out(b'GET', request.uri)
+    d.addCallback(lambda result: merged_response(request, *result,
+            merge=lambda job_lists: merge_page(request, job_lists,
+                    result[0], lambda job: job['job_id'], limit)))
+    return respond_later(request, d)
+
+
+def forward_request(request, shard):
+    """Sends `request` unchanged to `shard`.  Returns a Deferred firing
+    with the body of the response."""
+    body = None
+    if request.method in (b'POST', b'PUT'):
+        body = request.content.getvalue()
+    d = shard.request(request.method, request.uri, body)
+    d.addCallback(lambda response: forward_response(request, response))
+    return d
+
+
+class ShardProxyResource(resource.Resource):
+    """Forwards requests unchanged to `shard`."""
+    isLeaf = True
+
+    def __init__(self, shard):
+        resource.Resource.__init__(self)
+        self._shard = shard
+
+    def render(self, request):
+        return respond_later(request, forward_request(request, self._shard))
+
+
+class FederatedJobsResource(resource.Resource):
+    def __init__(self, federation):
+        resource.Resource.__init__(self)
+        self._federation = federation
+
+        self.putChild('active', FederatedJobListResource(federation,
+                b'/jobs/active', merge_active_jobs))
+        self.putChild('waiting', FederatedJobListResource(federation,
+                b'/jobs/waiting', merge_waiting_jobs))
+        self.putChild('cancel', FederatedCancelJobsResource(federation))
+        self.putChild('sequences', FederatedSequencesResource(federation))
+
+    def getChild(self, path, request):
+        if not path.isdigit():
+            return resource.NoResource('unknown job')
+        return ShardProxyResource(self._federation.get_shard_for_job(
+                int(path)))
+
+    def render_GET(self, request):
+        if is_page_request(request):
+            return job_page_response(self._federation, request)
+        d = defer.gatherResults([
+                self._federation.fan_out(b'GET', b'/jobs/active'),
+                self._federation.fan_out(b'GET', b'/jobs/waiting')],
+                consumeErrors=True)
+        d.addCallback(self._merge_jobs, request)
+        return respond_later(request, d)
+
+    @staticmethod
+    def _merge_jobs(results, request):
+        (active, active_unavailable), (waiting, waiting_unavailable) = \
+                results
+        unavailable = [shard for shard in active_unavailable \
+                if shard not in waiting_unavailable] + waiting_unavailable
+        return merged_response(request, active + waiting, unavailable,
+                lambda job_lists: merge_active_jobs(
+                        job_lists[:len(active)]) \
+                        + merge_waiting_jobs(job_lists[len(active):]))
+
+    def render_POST(self, request):
+        """Adds a job, or all jobs of an array of jobs, each on the shard of
+        its sprinkler.  A batch is added at once on every shard, but not
+        across shards."""
+        try:
+            new_jobs = load_json_body(request)
+            for new_job in new_jobs if isinstance(new_jobs, list) \
+                    else [new_jobs]:
+                parse_new_job(new_job)
+        except ValueError as e:
+            return error_response(request, http.BAD_REQUEST, str(e))
+        if not isinstance(new_jobs, list):
+            d = self._federation.get_shards_for_sprinklers(
+                    [new_jobs['sprinkler_id']])
+            d.addCallback(self._add_job, new_jobs, request)
+            return respond_later(request, d)
+        d = self._federation.get_shards_for_sprinklers(
+                set(new_job['sprinkler_id'] for new_job in new_jobs))
+        d.addCallback(self._add_jobs, new_jobs, request)
+        return respond_later(request, d)
+
+    @staticmethod
+    def _add_job(shards, new_job, request):
+        shard = shards[new_job['sprinkler_id']]
+        if shard is None:
+            return error_response(request, http.BAD_REQUEST,
+                    'Invalid sprinkler id {}'.format(new_job['sprinkler_id']))
+        d = shard.request_json(b'POST', b'/jobs', new_job)
+        d.addCallback(lambda response: forward_response(request, response))
+        return d
+
+    def _add_jobs(self, shards, new_jobs, request):
+        for sprinkler_id, shard in sorted(shards.items()):
+            if shard is None:
+                return error_response(request, http.BAD_REQUEST,
+                        'Invalid sprinkler id {}'.format(sprinkler_id))
+        positions_by_shard = OrderedDict()
+        for position, new_job in enumerate(new_jobs):
+            positions_by_shard.setdefault(shards[new_job['sprinkler_id']],
+                    []).append(position)
+        d = defer.gatherResults([shard.request_json(b'POST', b'/jobs',
+                [new_jobs[position] for position in positions]) \
+                for shard, positions in positions_by_shard.items()],
+                consumeErrors=True)
+        d.addCallback(self._on_jobs_added, positions_by_shard.values(),
+                len(new_jobs), request)
+        d.addErrback(lambda failure: failure.value.subFailure)
+        return d
+
+    @staticmethod
+    def _on_jobs_added(responses, positions_by_shard, num_jobs, request):
+        failed_response = get_failed_response(responses)
+        if failed_response is not None:
+            return forward_response(request, failed_response)
+        jobs = [None] * num_jobs
+        for response, positions in zip(responses, positions_by_shard):
+            for position, job in zip(positions, response.data):
+                jobs[position] = job
+        return json_response(request, jobs)
+
+
+class FederatedJobListResource(resource.Resource):
+    """Lists the active or the waiting jobs of all shards."""
+    def __init__(self, federation, uri, merge):
+        resource.Resource.__init__(self)
+        self._federation = federation
+        self._uri = uri
+        self._merge = merge
+
+    def getChild(self, path, request):
+        if not path.isdigit():
+            return resource.NoResource('unknown job')
+        return ShardProxyResource(self._federation.get_shard_for_job(
+                int(path)))
+
+    def render_GET(self, request):
+        if is_page_request(request):
+            return job_page_response(self._federation, request)
+        d = self._federation.fan_out(b'GET', self._uri)
+        d.addCallback(lambda result: merged_response(request, *result,
+                merge=self._merge))
+        return respond_later(request, d)
+
+
+class FederatedCancelJobsResource(resource.Resource):
+    """Cancels jobs, all jobs of courts and sequences on the shards they
+    belong to.  All ids are checked by each shard before it cancels
+    anything, but a shard may reject its ids after others cancelled
+    theirs."""
+    isLeaf = True
+
+    def __init__(self, federation):
+        resource.Resource.__init__(self)
+        self._federation = federation
+
+    def render_POST(self, request):
+        try:
+            cancellation = parse_json_body(request)
+            get_id_list(cancellation, 'sprinkler_ids')
+            for name in ('job_ids', 'sequence_ids'):
+                for id_ in get_list(cancellation.get(name, []), name):
+                    if isinstance(id_, bool) \
+                            or not isinstance(id_, numbers.Integral):
+                        raise ValueError('{} needs to be a list of ' \
+                                'integers'.format(name))
+        except ValueError as e:
+            return error_response(request, http.BAD_REQUEST, str(e))
+        d = self._federation.get_shards_for_sprinklers(
+                cancellation.get('sprinkler_ids', []))
+        d.addCallback(self._cancel, cancellation, request)
+        return respond_later(request, d)
+
+    def _cancel(self, shards, cancellation, request):
+        cancellations = OrderedDict()
+
+        def get_cancellation(shard):
+            return cancellations.setdefault(shard, {'job_ids': [],
+                    'sprinkler_ids': [], 'sequence_ids': []})
+
+        for sprinkler_id in cancellation.get('sprinkler_ids', []):
+            if shards[sprinkler_id] is None:
+                return error_response(request, http.BAD_REQUEST,
+                        'Invalid sprinkler id {}'.format(sprinkler_id))
+            get_cancellation(shards[sprinkler_id])['sprinkler_ids'].append(
+                    sprinkler_id)
+        for name in ('job_ids', 'sequence_ids'):
+            for id_ in cancellation.get(name, []):
+                get_cancellation(self._federation.get_shard_for_job(
+                        id_))[name].append(id_)
+
+        d = defer.gatherResults([shard.request_json(b'POST',
+                b'/jobs/cancel', shard_cancellation) \
+                for shard, shard_cancellation in cancellations.items()],
+                consumeErrors=True)
+        d.addCallback(self._on_cancelled, request)
+        d.addErrback(lambda failure: failure.value.subFailure)
+        return d
+
+    @staticmethod
+    def _on_cancelled(responses, request):
+        failed_response = get_failed_response(responses)
+        if failed_response is not None:
+            return forward_response(request, failed_response)
+        return json_response(request, [job for response in responses \
+                for job in response.data])
+
+
+class FederatedSequencesResource(resource.Resource):
+    """Sequences of all shards.  All steps of a new sequence need to be on
+    the same shard, which hands the valves over."""
+    isLeaf = True
+
+    def __init__(self, federation):
+        resource.Resource.__init__(self)
+        self._federation = federation
+
+    def render_GET(self, request):
+        d = self._federation.fan_out(b'GET', b'/jobs/sequences')
+        d.addCallback(lambda result: merged_response(request, *result,
+                merge=lambda sequence_lists: merge_sorted(sequence_lists,
+                        lambda sequence: sequence['sequence_id'])))
+        return respond_later(request, d)
+
+    def render_POST(self, request):
+        try:
+            new_sequence = parse_json_body(request)
+            steps = [parse_step(step) for step \
+                    in get_list(new_sequence.get('steps'), 'steps')]
+        except ValueError as e:
+            return error_response(request, http.BAD_REQUEST, str(e))
+        d = self._federation.get_shards_for_sprinklers(
+                [sprinkler_id for sprinkler_id, _ in steps])
+        d.addCallback(self._add_sequence, new_sequence, request)
+        return respond_later(request, d)
+
+    @staticmethod
+    def _add_sequence(shards, new_sequence, request):
+        for sprinkler_id, shard in sorted(shards.items()):
+            if shard is None:
+                return error_response(request, http.BAD_REQUEST,
+                        'Invalid sprinkler id {}'.format(sprinkler_id))
+        if len(set(shards.values())) > 1:
+            return error_response(request, http.BAD_REQUEST,
+                    'the steps of a sequence need to be on the same shard')
+        shard = next(iter(shards.values()), None)
+        if shard is None:
+            return error_response(request, http.BAD_REQUEST,
+                    'sequence needs at least one step')
+        d = shard.request_json(b'POST', b'/jobs/sequences', new_sequence)
+        d.addCallback(lambda response: forward_response(request, response))
+        return d
+
+
+class FederatedCourtsResource(resource.Resource):
+    """Lists the status of the courts of all shards, sorted by sprinkler
+    id, with the query arguments of CourtsResource."""
+    def __init__(self, federation):
+        resource.Resource.__init__(self)
+        self._federation = federation
+
+    def getChild(self, path, request):
+        return FederatedCourtResource(self._federation, path.decode('utf-8'))
+
+    def render_GET(self, request):
+        try:
+            limit = get_limit_arg(request)
+        except ValueError as e:
+            return error_response(request, http.BAD_REQUEST, str(e))
+        status = get_query_arg(request, 'status')
+        if status is not None and status not in CourtsResource.COURT_STATES:
+            return error_response(request, http.BAD_REQUEST,
+                    'status needs to be one of {}'.format(
+                            ', '.join(CourtsResource.COURT_STATES)))
+        prefix = get_query_arg(request, 'prefix')
+        d = self._federation.fan_out(b'GET', request.uri)
+        d.addCallback(lambda result: merged_response(request, *result,
+                merge=lambda court_lists: merge_page(request, court_lists,
+                        result[0], lambda court: court['sprinkler_id'],
+                        limit, status=status, prefix=prefix)))
+        return respond_later(request, d)
+
+
+class FederatedCourtResource(resource.Resource):
+    """Forwards requests for a court to the shard of its sprinkler."""
+    isLeaf = True
+
+    def __init__(self, federation, sprinkler_id):
+        resource.Resource.__init__(self)
+        self._federation = federation
+        self._sprinkler_id = sprinkler_id
+
+    def render(self, request):
+        d = self._federation.get_shards_for_sprinklers([self._sprinkler_id])
+        d.addCallback(lambda shards: shards[self._sprinkler_id])
+        d.addCallback(self._forward, request)
+        return respond_later(request, d)
+
+    @staticmethod
+    def _forward(shard, request):
+        if shard is None:
+            return resource.NoResource('unknown court').render(request)
+        return forward_request(request, shard)
+
+
+class FederatedReloadResource(resource.Resource):
+    """Reloads the sprinklers of all shards and then re-reads which shard
+    owns which sprinkler."""
+    isLeaf = True
+
+    def __init__(self, federation):
+        resource.Resource.__init__(self)
+        self._federation = federation
+
+    def render_POST(self, request):
+        d = self._federation.fan_out(b'POST', b'/admin/reload')
+        d.addCallback(self._on_reloaded, request)
+        return respond_later(request, d)
+
+    def _on_reloaded(self, result, request):
+        d = self._federation.refresh()
+        d.addCallback(lambda _: merged_response(request, *result,
+                merge=lambda change_lists: dict((change,
+                        [sprinkler_id for changes in change_lists \
+                                for sprinkler_id in changes[change]]) \
+                        for change in ('added', 'removed', 'changed'))))
+        return d
+
+
+def create_federation_site(shard_descriptions, clock=reactor):
+    """Returns the site of the front-end for the shards at the given
+    endpoints, in the order of their [shard] index."""
+    federation = Federation([Shard(index, description, clock) \
+            for index, description in enumerate(shard_descriptions)], clock)
+    federation.start()
+
+    root = resource.Resource()
+    root.putChild('jobs', FederatedJobsResource(federation))
+    root.putChild('courts', FederatedCourtsResource(federation))
+    admin = resource.Resource()
+    admin.putChild('reload', FederatedReloadResource(federation))
+    root.putChild('admin', admin)
+    return server.Site(root)
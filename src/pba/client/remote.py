@@ -0,0 +1,277 @@
+# vim:set ts=4 sw=4 et:
+"""Client library for remote controlling the daemon.
+
+Commands are sent either to the HTTP API, reusing pooled keep-alive
+connections, or to the local UNIX domain command socket of the daemon,
+which skips TCP and HTTP and pipelines batches of commands.
+"""
+from __future__ import (absolute_import, division, print_function,
+        unicode_literals)
+import httplib
+import json
+import socket
+import threading
+from urlparse import urlsplit
+
+
+class PbaClientError(Exception):
+    pass
+
+
+class HttpTransport(object):
+    """Sends commands to the HTTP API.  Up to `max_connections` idle
+    keep-alive connections are kept for reuse."""
+    ROUTES = {
+        'add_jobs': lambda args: ('POST', '/jobs', args['jobs']),
+        'add_sequence': lambda args: ('POST', '/jobs/sequences', args),
+        'list_jobs': lambda args: ('GET', '/jobs', None),
+        'cancel_jobs': lambda args: ('POST', '/jobs/cancel', args),
+        'change_duration': lambda args: ('POST',
+                '/jobs/{}'.format(args['job_id']),
+                {'duration': args['duration']}),
+        'status': lambda args: ('GET', '/status', None),
+    }
+
+    def __init__(self, base_url, max_connections=4, timeout=10):
+        url = urlsplit(base_url)
+        self._host = url.hostname
+        self._port = url.port or 80
+        self._max_connections = max_connections
+        self._timeout = timeout
+        self._idle_connections = []
+        self._lock = threading.Lock()
+
+    def call(self, command, **args):
+        method, path, data = self.ROUTES[command](args)
+        return self._request(method, path, data)
+
+    def call_many(self, calls):
+        return [self.call(command, **args) for command, args in calls]
+
+    def watch(self):
+        """Yields (event, data) pairs from the event stream."""
+        connection = self._new_connection(timeout=None)
+        try:
+            connection.request('GET', '/events')
+            response = connection.getresponse()
+            if response.status != httplib.OK:
+                raise PbaClientError('HTTP status {}'.format(response.status))
+            event = None
+            for line in self._iter_lines(response):
+                if line.startswith('event:'):
+                    event = line[len('event:'):].strip()
+                elif line.startswith('data:') and event is not None:
+                    yield event, json.loads(line[len('data:'):])
+                    event = None
+        finally:
+            connection.close()
+
+    def close(self):
+        with self._lock:
+            connections, self._idle_connections = self._idle_connections, []
+        for connection in connections:
+            connection.close()
+
+    def _new_connection(self, timeout):
+        return httplib.HTTPConnection(self._host, self._port,
+                timeout=timeout)
+
+    def _get_connection(self):
+        with self._lock:
+            if self._idle_connections:
+                return self._idle_connections.pop(), True
+        return self._new_connection(self._timeout), False
+
+    def _release_connection(self, connection):
+        with self._lock:
+            if len(self._idle_connections) < self._max_connections:
+                self._idle_connections.append(connection)
+                return
+        connection.close()
+
+    def _request(self, method, path, data):
+        body = None if data is None else json.dumps(data)
+        headers = {'Content-Type': 'application/json'}
+        connection, reused = self._get_connection()
+        try:
+            connection.request(method, path, body, headers)
+            response = connection.getresponse()
+        except (httplib.HTTPException, socket.error):
+            connection.close()
+            if not reused:
+                raise
+            # The daemon closed the idle connection in the meantime.
+            connection = self._new_connection(self._timeout)
+            connection.request(method, path, body, headers)
+            response = connection.getresponse()
+        content = response.read()
+        if response.will_close:
+            connection.close()
+        else:
+            self._release_connection(connection)
+
+        try:
+            result = json.loads(content.decode('utf-8'))
+        except ValueError:
+            raise PbaClientError('HTTP status {}'.format(response.status))
+        if response.status >= 400:
+            raise PbaClientError(result.get('error',
+                    'HTTP status {}'.format(response.status)))
+        return result
+
+    @staticmethod
+    def _iter_lines(response):
+        line = []
+        while True:
+            char = response.read(1)
+            if not char:
+                return
+            if char == b'\n':
+                yield b''.join(line).decode('utf-8')
+                line = []
+            else:
+                line.append(char)
+
+
+class UnixSocketTransport(object):
+    """Sends commands as JSON lines to the command socket of the daemon.
+    Batches of commands are pipelined over the connection."""
+    def __init__(self, path, timeout=10):
+        self._path = path
+        self._timeout = timeout
+        self._socket = None
+        self._fp = None
+        self._last_request_id = 0
+
+    def call(self, command, **args):
+        return self.call_many([(command, args)])[0]
+
+    def call_many(self, calls):
+        """Sends all commands at once, then collects their results."""
+        self._connect()
+        request_ids = []
+        messages = []
+        for command, args in calls:
+            self._last_request_id += 1
+            request_ids.append(self._last_request_id)
+            messages.append(self._encode(self._last_request_id, command,
+                    args))
+        self._socket.sendall(b''.join(messages))
+
+        responses = {}
+        while len(responses) < len(request_ids):
+            response = self._read_message()
+            responses[response.get('id')] = response
+        return [self._get_result(responses[request_id]) \
+                for request_id in request_ids]
+
+    def watch(self):
+        """Yields (event, data) pairs of all job and sprinkler events."""
+        self._connect()
+        self._socket.settimeout(None)
+        self._last_request_id += 1
+        self._socket.sendall(self._encode(self._last_request_id, 'watch',
+                {}))
+        while True:
+            message = self._read_message()
+            if 'event' in message:
+                yield message['event'], message['data']
+            else:
+                self._get_result(message)
+
+    def close(self):
+        if self._socket is not None:
+            self._fp.close()
+            self._socket.close()
+            self._socket = None
+            self._fp = None
+
+    def _connect(self):
+        if self._socket is not None:
+            return
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.settimeout(self._timeout)
+        self._socket.connect(self._path)
+        self._fp = self._socket.makefile('rb')
+
+    @staticmethod
+    def _encode(request_id, command, args):
+        return json.dumps({
+            'id': request_id,
+            'command': command,
+            'args': args,
+        }).encode('utf-8') + b'\n'
+
+    def _read_message(self):
+        line = self._fp.readline()
+        if not line:
+            self.close()
+            raise PbaClientError('connection closed by the daemon')
+        return json.loads(line.decode('utf-8'))
+
+    @staticmethod
+    def _get_result(response):
+        if 'error' in response:
+            raise PbaClientError(response['error'])
+        return response.get('result')
+
+
+class PbaClient(object):
+    def __init__(self, transport):
+        self._transport = transport
+
+    def add_job(self, sprinkler_id, duration, priority=0):
+        return self.add_jobs([(sprinkler_id, duration, priority)])[0]
+
+    def add_jobs(self, jobs):
+        """Adds (sprinkler_id, duration, priority) jobs at once."""
+        return self._transport.call('add_jobs', jobs=[{
+            'sprinkler_id': sprinkler_id,
+            'duration': duration,
+            'priority': int(priority),
+        } for sprinkler_id, duration, priority in jobs])
+
+    def add_sequence(self, steps, priority=0, overlap=0):
+        """Adds (sprinkler_id, duration) steps to run one after the
+        other, overlapping by `overlap` seconds."""
+        return self._transport.call('add_sequence', steps=[{
+            'sprinkler_id': sprinkler_id,
+            'duration': duration,
+        } for sprinkler_id, duration in steps], priority=int(priority),
+                overlap=overlap)
+
+    def list_jobs(self):
+        return self._transport.call('list_jobs')
+
+    def cancel_jobs(self, job_ids=(), sprinkler_ids=(), sequence_ids=()):
+        """Cancels the given jobs, all jobs of the given courts and the
+        given sequences."""
+        return self._transport.call('cancel_jobs', job_ids=list(job_ids),
+                sprinkler_ids=list(sprinkler_ids),
+                sequence_ids=list(sequence_ids))
+
+    def change_duration(self, job_id, duration):
+        return self.change_durations([(job_id, duration)])[0]
+
+    def change_durations(self, durations):
+        """Changes the durations of (job_id, duration) jobs."""
+        return self._transport.call_many([('change_duration',
+                {'job_id': job_id, 'duration': duration}) \
+                for job_id, duration in durations])
+
+    def status(self):
+        return self._transport.call('status')
+
+    def watch(self):
+        return self._transport.watch()
+
+    def close(self):
+        self._transport.close()
+
+
+def connect(base_url='http://localhost:8080', socket_path=None):
+    """Returns a client for the command socket at `socket_path` if given,
+    otherwise for the HTTP API at `base_url`."""
+    if socket_path is not None:
+        return PbaClient(UnixSocketTransport(socket_path))
+    return PbaClient(HttpTransport(base_url))
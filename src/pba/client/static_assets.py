@@ -0,0 +1,212 @@
+# vim:set ts=4 sw=4 et:
+"""Static files of the web interface, served from memory.
+
+All files below the root directory are read once at startup.  Text files
+are then compressed in a background thread, with gzip and, if the brotli
+module is installed, with brotli, and the variant the client accepts is
+served.  Variants compressed at build time, e.g. by
+`gzip -k9 libs/jquery/jquery-2.0.3.js`, are picked up from the .gz and .br
+files next to the original instead.
+
+Every variant has an ETag derived from the content hash, so that clients
+revalidate cheaply.  Files below libs/ are also cached for a year without
+revalidation.
+"""
+from __future__ import (absolute_import, division, print_function,
+        unicode_literals)
+import hashlib
+import os
+import os.path
+import zlib
+from twisted.internet import defer, threads
+from twisted.internet.interfaces import IReactorThreads
+from twisted.python import log
+from twisted.web import http, resource
+
+# Not mimetypes, which reads the system wide MIME types on first use.
+CONTENT_TYPES = {
+    '.css': b'text/css; charset=utf-8',
+    '.gif': b'image/gif',
+    '.html': b'text/html; charset=utf-8',
+    '.ico': b'image/x-icon',
+    '.jpg': b'image/jpeg',
+    '.js': b'application/javascript; charset=utf-8',
+    '.json': b'application/json',
+    '.png': b'image/png',
+    '.svg': b'image/svg+xml',
+    '.txt': b'text/plain; charset=utf-8',
+}
+COMPRESSIBLE_EXTENSIONS = ('.css', '.html', '.js', '.json', '.svg', '.txt')
+PRECOMPRESSED_EXTENSIONS = {'.gz': 'gzip', '.br': 'br'}
+# Preferred first.
+ENCODINGS = ('br', 'gzip')
+IMMUTABLE_PREFIX = 'libs/'
+IMMUTABLE_CACHE_CONTROL = b'public, max-age=31536000, immutable'
+DEFAULT_CACHE_CONTROL = b'no-cache'
+
+
+def compress_gzip(content):
+    # Without a timestamp in the header, so that the output is the same on
+    # every start.
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(content) + compressor.flush()
+
+
+def get_compressors():
+    compressors = {'gzip': compress_gzip}
+    try:
+        import brotli
+    except ImportError:
+        pass
+    else:
+        compressors['br'] = brotli.compress
+    return compressors
+
+
+def get_accepted_encodings(request):
+    """Returns the content codings the client accepts, ignoring their
+    weights other than 0."""
+    header = request.getHeader(b'Accept-Encoding')
+    if not header:
+        return set()
+    encodings = set()
+    for coding in header.decode('latin-1').split(','):
+        params = coding.strip().split(';')
+        quality = '1'
+        for param in params[1:]:
+            name, _, value = param.strip().partition('=')
+            if name == 'q':
+                quality = value
+        try:
+            if float(quality) > 0:
+                encodings.add(params[0].strip().lower())
+        except ValueError:
+            pass
+    return encodings
+
+
+class StaticAsset(object):
+    def __init__(self, path, content, content_type, cache_control,
+            compressible):
+        self.path = path
+        self.content = content
+        self.content_type = content_type
+        self.cache_control = cache_control
+        self.compressible = compressible
+        self.content_hash = hashlib.sha1(content).hexdigest()[:20]
+        # Compressed variants by content coding, only those that are
+        # smaller than the content.
+        self.variants = {}
+
+    def add_variant(self, encoding, content):
+        if len(content) < len(self.content):
+            self.variants[encoding] = content
+
+    def select_variant(self, accepted_encodings):
+        """Returns the content coding (None for identity) and the content
+        to send."""
+        for encoding in ENCODINGS:
+            if encoding in accepted_encodings and encoding in self.variants:
+                return encoding, self.variants[encoding]
+        return None, self.content
+
+    def get_etag(self, encoding):
+        if encoding is None:
+            return '"{}"'.format(self.content_hash).encode('ascii')
+        return '"{}-{}"'.format(self.content_hash, encoding).encode('ascii')
+
+
+def load_assets(root_dir):
+    """Reads all files below `root_dir`.  Returns the StaticAssets by their
+    URL path relative to the root."""
+    assets = {}
+    precompressed = []
+    for dir_path, _, file_names in os.walk(root_dir):
+        for file_name in file_names:
+            file_path = os.path.join(dir_path, file_name)
+            path = os.path.relpath(file_path, root_dir).replace(os.sep, '/')
+            base_path, extension = os.path.splitext(path)
+            if extension in PRECOMPRESSED_EXTENSIONS:
+                precompressed.append((base_path,
+                        PRECOMPRESSED_EXTENSIONS[extension], file_path))
+                continue
+            with open(file_path, 'rb') as fp:
+                content = fp.read()
+            cache_control = IMMUTABLE_CACHE_CONTROL \
+                    if path.startswith(IMMUTABLE_PREFIX) \
+                    else DEFAULT_CACHE_CONTROL
+            assets[path] = StaticAsset(path, content,
+                    CONTENT_TYPES.get(extension, b'application/octet-stream'),
+                    cache_control, extension in COMPRESSIBLE_EXTENSIONS)
+    for path, encoding, file_path in precompressed:
+        if path in assets:
+            with open(file_path, 'rb') as fp:
+                assets[path].add_variant(encoding, fp.read())
+    return assets
+
+
+def compress_assets(assets, compressors=None):
+    """Adds the compressed variants the assets do not have yet.  Meant to
+    run in a thread, as both zlib and brotli release the GIL."""
+    if compressors is None:
+        compressors = get_compressors()
+    for asset in assets.values():
+        if not asset.compressible:
+            continue
+        for encoding, compress in compressors.items():
+            if encoding not in asset.variants:
+                asset.add_variant(encoding, compress(asset.content))
+
+
+def compress_assets_in_background(assets, reactor):
+    """Runs compress_assets() in the thread pool of `reactor`.  Clocks
+    without threads, e.g. a task.Clock, compress at once instead.  Returns
+    a Deferred that fires once the assets are compressed."""
+    if not IReactorThreads.providedBy(reactor):
+        return defer.maybeDeferred(compress_assets, assets)
+    d = threads.deferToThreadPool(reactor, reactor.getThreadPool(),
+            compress_assets, assets)
+    d.addErrback(log.err, 'compressing the static files failed')
+    return d
+
+
+class StaticAssetResource(resource.Resource):
+    isLeaf = True
+
+    def __init__(self, asset):
+        resource.Resource.__init__(self)
+        self._asset = asset
+
+    def render_GET(self, request):
+        encoding, content = self._asset.select_variant(
+                get_accepted_encodings(request))
+        request.setHeader(b'Content-Type', self._asset.content_type)
+        request.setHeader(b'Cache-Control', self._asset.cache_control)
+        if self._asset.compressible:
+            request.setHeader(b'Vary', b'Accept-Encoding')
+        if encoding is not None:
+            request.setHeader(b'Content-Encoding', encoding.encode('ascii'))
+        if request.setETag(self._asset.get_etag(encoding)) == http.CACHED:
+            return b''
+        return content
+
+
+class StaticAssetsResource(resource.Resource):
+    """Serves `assets` by their path, index.html for the root."""
+    INDEX = 'index.html'
+
+    def __init__(self, assets):
+        resource.Resource.__init__(self)
+        self._assets = assets
+
+    def getChild(self, path, request):
+        try:
+            path = b'/'.join([path] + request.postpath).decode('utf-8')
+        except UnicodeDecodeError:
+            return resource.NoResource()
+        if path == '':
+            path = self.INDEX
+        asset = self._assets.get(path)
+        if asset is None:
+            return resource.NoResource()
+        return StaticAssetResource(asset)
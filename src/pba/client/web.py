@@ -1,9 +1,27 @@
 # vim:set ts=4 sw=4 et:
 from __future__ import (absolute_import, division, print_function,
         unicode_literals)
-from twisted.web import static, server, resource
-from pba.core import daemon
+from zope.interface import implementer
+from twisted.web import server, resource, http
+from twisted.internet import reactor
+from twisted.internet.interfaces import IPullProducer
+from pba.client.events import EventBroadcaster, EventStreamResource
+from pba.client.static_assets import StaticAssetsResource, \
+    compress_assets_in_background, load_assets
+import binascii
+import heapq
+from itertools import chain, islice
 import json
+import numbers
+import os
+from timeit import default_timer
+from urllib import urlencode
+from pba.core.metrics import REGISTRY
+from pba.core.tracing import TRACER
+from pba.core.programs import schedule_from_json
+
+HTTP_REQUEST_LATENCY = REGISTRY.histogram('pba_http_request_seconds',
+        'Time taken to handle HTTP requests', ['resource'])
 
 
 def json_response(request, raw_response):
@@ -12,6 +30,200 @@ def json_response(request, raw_response):
         return json.dumps(raw_response)
 
 
+def error_response(request, code, message):
+    request.setResponseCode(code)
+    return json_response(request, {'error': message})
+
+
+def get_query_arg(request, name, default=None):
+    values = request.args.get(name.encode('ascii'))
+    if not values:
+        return default
+    return values[0].decode('utf-8')
+
+
+def get_limit_arg(request):
+    limit = get_query_arg(request, 'limit')
+    if limit is None:
+        return None
+    if not limit.isdigit() or int(limit) == 0:
+        raise ValueError('limit needs to be a positive integer')
+    return int(limit)
+
+
+def load_json_body(request):
+    """Returns the JSON value in the body of the request.  Raises
+    ValueError if the body is malformed."""
+    try:
+        return json.loads(request.content.getvalue())
+    except ValueError:
+        raise ValueError('request body needs to be valid JSON')
+
+
+def parse_json_body(request):
+    """Returns the JSON object in the body of the request.  Raises
+    ValueError if there is none."""
+    return get_object(load_json_body(request), 'request body')
+
+
+def get_object(value, name):
+    if not isinstance(value, dict):
+        raise ValueError('{} needs to be a JSON object'.format(name))
+    return value
+
+
+def get_list(value, name):
+    if not isinstance(value, list):
+        raise ValueError('{} needs to be a JSON array'.format(name))
+    return value
+
+
+def get_priority(new_job):
+    """Returns the requested priority of a job, which clients may also
+    give by the high_priority flag."""
+    if 'priority' not in new_job:
+        return 1 if new_job.get('high_priority') else 0
+    priority = new_job['priority']
+    if not isinstance(priority, bool):
+        try:
+            return int(priority)
+        except (TypeError, ValueError):
+            pass
+    raise ValueError('priority needs to be an integer')
+
+
+def get_duration(new_job):
+    duration = new_job.get('duration')
+    if isinstance(duration, bool) \
+            or not isinstance(duration, numbers.Real) or duration <= 0:
+        raise ValueError('duration needs to be a number greater than 0')
+    return duration
+
+
+def get_sprinkler_id(new_job):
+    sprinkler_id = new_job.get('sprinkler_id')
+    if not isinstance(sprinkler_id, basestring):
+        raise ValueError('sprinkler_id needs to be a string')
+    return sprinkler_id
+
+
+def get_id_list(body, name):
+    """Returns the list of ids `name` of the request body, which defaults
+    to no ids."""
+    ids = get_list(body.get(name, []), name)
+    for id_ in ids:
+        if isinstance(id_, (dict, list)):
+            raise ValueError('{} needs to be a list of ids'.format(name))
+    return ids
+
+
+def parse_new_job(new_job):
+    """Returns the (sprinkler_id, duration, priority) of a job posted by a
+    client.  Raises ValueError if the job is malformed."""
+    get_object(new_job, 'job')
+    return get_sprinkler_id(new_job), get_duration(new_job), \
+            get_priority(new_job)
+
+
+def parse_step(step):
+    """Returns the (sprinkler_id, duration) of a sequence step posted by a
+    client."""
+    get_object(step, 'step')
+    return get_sprinkler_id(step), get_duration(step)
+
+
+def set_next_page_link(request, **query_args):
+    query = urlencode(sorted((name, '{}'.format(value).encode('utf-8')) \
+            for name, value in query_args.items() if value is not None))
+    request.setHeader(b'Link', '<{}?{}>; rel="next"'.format(
+            request.path.decode('utf-8'), query).encode('utf-8'))
+
+
+@implementer(IPullProducer)
+class JobListProducer(object):
+    """Writes the JSON array of the jobs whose ids the iterator `job_ids`
+    yields, reading and encoding CHUNK_SIZE jobs whenever the transport
+    asks for more, so that a big listing neither blocks the reactor nor
+    builds up in memory.  Jobs that are gone by the time their chunk is
+    encoded are left out."""
+    CHUNK_SIZE = 100
+
+    def __init__(self, request, job_queue, job_ids):
+        self._request = request
+        self._job_queue = job_queue
+        self._job_ids = job_ids
+        self._separator = b'['
+
+    def start(self):
+        self._request.setHeader(b'Content-Type', b'application/json')
+        self._request.registerProducer(self, False)
+
+    def resumeProducing(self):
+        if self._request is None:
+            return
+        job_ids = list(islice(self._job_ids, self.CHUNK_SIZE))
+        chunk = []
+        for job_id in job_ids:
+            job = self._job_queue.get_job(job_id)
+            if job is not None:
+                chunk.append(self._separator)
+                chunk.append(json.dumps(job.for_json()))
+                self._separator = b','
+        # One write per call, as the transport asks to pause on every write
+        # while its buffer is full, but to resume only once.
+        if chunk:
+            self._request.write(b''.join(chunk))
+        if len(job_ids) < self.CHUNK_SIZE:
+            self._request.write(b']' if self._separator == b',' else b'[]')
+            self._request.unregisterProducer()
+            self._request.finish()
+            self.stopProducing()
+
+    def stopProducing(self):
+        self._request = None
+
+
+def list_jobs_response(request, job_queue, iter_jobs, *iter_job_ids):
+    """Lists jobs, by default those of iter_jobs() in their order.
+
+    With the query arguments `limit` or `cursor` (the job id to continue
+    after), the jobs are instead ordered by their job id, which stays
+    stable while jobs are added and removed, taken from the merged sorted
+    id iterators `iter_job_ids(after)`.  If there are more jobs than the
+    limit, the URL of the next page is returned in a Link header, so the
+    ids of a page are read at once, but its jobs are encoded in chunks.
+    """
+    try:
+        limit = get_limit_arg(request)
+        cursor = get_query_arg(request, 'cursor')
+        if cursor is not None:
+            if not cursor.isdigit():
+                raise ValueError('cursor needs to be a job id')
+            cursor = int(cursor)
+    except ValueError as e:
+        return error_response(request, http.BAD_REQUEST, str(e))
+
+    if limit is None and cursor is None:
+        job_ids = (job.job_id for job in iter_jobs())
+    else:
+        job_ids = merge_sorted_ids(*[iter_ids(cursor) \
+                for iter_ids in iter_job_ids])
+        if limit is not None:
+            page = list(islice(job_ids, limit + 1))
+            if len(page) > limit:
+                del page[limit:]
+                set_next_page_link(request, limit=limit, cursor=page[-1])
+            job_ids = iter(page)
+
+    first_chunk = list(islice(job_ids, JobListProducer.CHUNK_SIZE + 1))
+    if len(first_chunk) <= JobListProducer.CHUNK_SIZE:
+        return json_response(request, [job_queue.get_job(job_id).for_json() \
+                for job_id in first_chunk])
+    JobListProducer(request, job_queue,
+            chain(first_chunk, job_ids)).start()
+    return server.NOT_DONE_YET
+
+
 class JobsResource(resource.Resource):
     def __init__(self, job_queue):
         resource.Resource.__init__(self)
@@ -19,16 +231,33 @@ class JobsResource(resource.Resource):
 
         self.putChild('active', ActiveJobsResource(self._job_queue))
         self.putChild('waiting', WaitingJobsResource(self._job_queue))
+        self.putChild('cancel', CancelJobsResource(self._job_queue))
+        self.putChild('sequences', SequencesResource(self._job_queue))
 
     def render_POST(self, request):
-        new_job = json.loads(request.content.getvalue())
-        job = self._job_queue.add(new_job['sprinkler_id'],
-                new_job['duration'], new_job['high_priority'])
+        """Adds a job, or all jobs of an array of jobs at once."""
+        with TRACER.request('POST /jobs'):
+            try:
+                new_jobs = load_json_body(request)
+                if isinstance(new_jobs, list):
+                    jobs = self._job_queue.add_jobs([parse_new_job(new_job) \
+                            for new_job in new_jobs])
+                    return json_response(request,
+                            [job.for_json() for job in jobs])
+                sprinkler_id, duration, priority = parse_new_job(new_jobs)
+                job = self._job_queue.add(sprinkler_id, duration,
+                        priority=priority)
+            except (RuntimeError, ValueError) as e:
+                return error_response(request, http.BAD_REQUEST, str(e))
         return json_response(request, job.for_json())
 
     def render_GET(self, request):
-        return json_response(request, [job.for_json() for job \
-                in self._job_queue.list_jobs()])
+        """Lists the active and then the waiting jobs, see
+        list_jobs_response()."""
+        return list_jobs_response(request, self._job_queue,
+                self._job_queue.iter_jobs,
+                self._job_queue.iter_active_job_ids,
+                self._job_queue.iter_waiting_job_ids)
 
     def getChild(self, path, request): 
         job_id = int(path)
@@ -38,10 +267,56 @@ class JobsResource(resource.Resource):
         return WaitingJobResource(job_queue=self._job_queue, job_id=job_id)
 
 
-def find_job_for_court(sprinkler_id, jobs):
-    for job in jobs:
-        if job.sprinkler_id == sprinkler_id:
-            return job
+class CancelJobsResource(resource.Resource):
+    """Cancels the jobs listed by `job_ids`, all jobs of the courts
+    listed by `sprinkler_ids` and the sequences listed by `sequence_ids` at
+    once."""
+    isLeaf = True
+
+    def __init__(self, job_queue):
+        resource.Resource.__init__(self)
+        self._job_queue = job_queue
+
+    def render_POST(self, request):
+        try:
+            cancellation = parse_json_body(request)
+            jobs = self._job_queue.remove_jobs(
+                    job_ids=get_id_list(cancellation, 'job_ids'),
+                    sprinkler_ids=get_id_list(cancellation, 'sprinkler_ids'),
+                    sequence_ids=get_id_list(cancellation, 'sequence_ids'))
+        except (RuntimeError, ValueError) as e:
+            return error_response(request, http.BAD_REQUEST, str(e))
+        return json_response(request, [job.for_json() for job in jobs])
+
+
+class SequencesResource(resource.Resource):
+    """Sequences of jobs that run one after the other, see
+    SprinklerJobQueue.add_sequence()."""
+    isLeaf = True
+
+    def __init__(self, job_queue):
+        resource.Resource.__init__(self)
+        self._job_queue = job_queue
+
+    def render_GET(self, request):
+        return json_response(request, [sequence.for_json() for sequence \
+                in self._job_queue.list_sequences()])
+
+    def render_POST(self, request):
+        with TRACER.request('POST /jobs/sequences'):
+            try:
+                new_sequence = parse_json_body(request)
+                overlap = new_sequence.get('overlap', 0)
+                if isinstance(overlap, bool) \
+                        or not isinstance(overlap, numbers.Real):
+                    raise ValueError('overlap needs to be a number')
+                steps = get_list(new_sequence.get('steps'), 'steps')
+                sequence = self._job_queue.add_sequence(
+                        [parse_step(step) for step in steps],
+                        priority=get_priority(new_sequence), overlap=overlap)
+            except (RuntimeError, ValueError) as e:
+                return error_response(request, http.BAD_REQUEST, str(e))
+        return json_response(request, sequence.for_json())
 
 
 def create_inactive_court_for_json(sprinkler_id):
@@ -50,30 +325,154 @@ def create_inactive_court_for_json(sprinkler_id):
             }
 
 
-def court_status_from_jobs(sprinkler_id, jobs):
-    job = find_job_for_court(sprinkler_id, jobs)
+def court_status(sprinkler_id, job_queue):
+    job = job_queue.get_job_for_sprinkler(sprinkler_id)
     if job is not None:
         return job.for_json()
     return create_inactive_court_for_json(sprinkler_id)
 
 
+def merge_sorted_ids(*sorted_ids):
+    last_id = None
+    for id_ in heapq.merge(*sorted_ids):
+        if id_ != last_id:
+            yield id_
+        last_id = id_
+
+
 class CourtsResource(resource.Resource):
+    """Lists the status of the courts, sorted by sprinkler id.
+
+    Supports the optional query arguments `status` (active, waiting or
+    inactive), `prefix` (of the sprinkler id), `limit` and `cursor`.  If a
+    limit is given and there are more courts, the URL of the next page is
+    returned in a Link header.
+    """
+    COURT_STATES = ('active', 'waiting', 'inactive')
+
     def __init__(self, sprinkler_ctrl, job_queue):
         resource.Resource.__init__(self)
         self._sprinkler_ctrl = sprinkler_ctrl
         self._job_queue = job_queue
 
-        for sprinkler_id in self._sprinkler_ctrl.sprinkler_ids:
-            self.putChild(sprinkler_id, CourtResource(sprinkler_id,
-                    self._job_queue))
+    def getChild(self, path, request):
+        sprinkler_id = path.decode('utf-8')
+        if not self._sprinkler_ctrl.is_valid(sprinkler_id):
+            return resource.NoResource('unknown court')
+        return CourtResource(sprinkler_id, self._job_queue)
 
     def render_GET(self, request):
-        jobs = self._job_queue.list_jobs()
+        try:
+            limit = get_limit_arg(request)
+        except ValueError as e:
+            return error_response(request, http.BAD_REQUEST, str(e))
+        status = get_query_arg(request, 'status')
+        if status is not None and status not in self.COURT_STATES:
+            return error_response(request, http.BAD_REQUEST,
+                    'status needs to be one of {}'.format(
+                            ', '.join(self.COURT_STATES)))
+        prefix = get_query_arg(request, 'prefix', '')
+        cursor = get_query_arg(request, 'cursor')
+
         courts = []
-        for sprinkler_id in sorted(self._sprinkler_ctrl.sprinkler_ids):
-            courts.append(court_status_from_jobs(sprinkler_id, jobs))
+        for sprinkler_id in self._iter_candidate_ids(status, cursor, prefix):
+            court = court_status(sprinkler_id, self._job_queue)
+            if status is not None and court['status'] != status:
+                continue
+            if limit is not None and len(courts) == limit:
+                set_next_page_link(request, status=status,
+                        prefix=prefix or None, limit=limit,
+                        cursor=courts[-1]['sprinkler_id'])
+                break
+            courts.append(court)
         return json_response(request, courts)
 
+    def _iter_candidate_ids(self, status, cursor, prefix):
+        """Yields the ids of the courts that may have the given status,
+        avoiding to look at every court unless inactive ones are wanted."""
+        if status == 'active':
+            return self._job_queue.iter_active_sprinkler_ids(cursor, prefix)
+        if status == 'waiting':
+            # Jobs whose sprinkler is still being turned on are already
+            # counted as active but still reported as waiting.
+            return merge_sorted_ids(
+                    self._job_queue.iter_waiting_sprinkler_ids(cursor,
+                            prefix),
+                    self._job_queue.iter_active_sprinkler_ids(cursor,
+                            prefix))
+        return self._sprinkler_ctrl.iter_sprinkler_ids(cursor, prefix)
+
+
+class CourtStatusSnapshot(object):
+    """Status of all courts, serialised at most once per state change.
+
+    The version is bumped whenever a job or a sprinkler changes state.  It
+    is combined with a per-process random tag to form the ETag, so that
+    ETags from before a restart never match.
+    """
+    def __init__(self, sprinkler_ctrl, job_queue):
+        self._sprinkler_ctrl = sprinkler_ctrl
+        self._job_queue = job_queue
+        # Not uuid, which is slow to import.
+        self._instance_tag = binascii.hexlify(os.urandom(4))
+        self.version = 0
+        self._body = None
+
+        self._job_queue.add_listener(self._on_jobs_changed)
+        self._sprinkler_ctrl.add_listener(self._on_sprinkler_changed)
+
+    def _on_jobs_changed(self, events):
+        self._invalidate()
+
+    def _on_sprinkler_changed(self, event, sprinkler_id):
+        self._invalidate()
+
+    def _invalidate(self):
+        self.version += 1
+        self._body = None
+
+    @property
+    def etag(self):
+        return '"{}-{}"'.format(self._instance_tag, self.version)
+
+    @property
+    def body(self):
+        if self._body is None:
+            self._body = json.dumps({
+                'version': self.version,
+                'courts': [self._court_status(sprinkler_id) \
+                        for sprinkler_id \
+                        in self._sprinkler_ctrl.iter_sprinkler_ids()],
+            })
+        return self._body
+
+    def _court_status(self, sprinkler_id):
+        status = court_status(sprinkler_id, self._job_queue)
+        # Only changes of state bump the version, so the snapshot does not
+        # carry the ever-changing remaining time.  Clients derive it from
+        # start_time, duration and the X-Server-Time header.
+        status.pop('remaining_time', None)
+        status['sprinkler_on'] = self._sprinkler_ctrl.is_on(sprinkler_id)
+        return status
+
+
+class StatusResource(resource.Resource):
+    isLeaf = True
+
+    def __init__(self, snapshot, clock):
+        resource.Resource.__init__(self)
+        self._snapshot = snapshot
+        self._clock = clock
+
+    def render_GET(self, request):
+        request.setHeader(b'X-Server-Time',
+                '{:.3f}'.format(self._clock.seconds()).encode('ascii'))
+        request.setHeader(b'Cache-Control', b'no-cache')
+        if request.setETag(self._snapshot.etag.encode('ascii')) == http.CACHED:
+            return b''
+        request.setHeader(b'Content-Type', b'application/json')
+        return self._snapshot.body
+
 
 class CourtResource(resource.Resource):
     def __init__(self, court_id, job_queue):
@@ -82,8 +481,7 @@ class CourtResource(resource.Resource):
         self._court_id = court_id
 
     def _get_job(self):
-        return find_job_for_court(self._court_id,
-                self._job_queue.list_jobs())
+        return self._job_queue.get_job_for_sprinkler(self._court_id)
 
     def render_GET(self, request):
         job = self._get_job()
@@ -93,15 +491,19 @@ class CourtResource(resource.Resource):
         return json_response(request, job.for_json())
 
     def render_POST(self, request):
-        job = self._get_job()
-        new_job = json.loads(request.content.getvalue())
-        duration = new_job['duration']
-        if job is not None:
-            job.duration = duration
-            return json_response(request, job.for_json())
-
-        job = self._job_queue.add(self._court_id,
-                duration, new_job['high_priority'])
+        with TRACER.request('POST /courts'):
+            try:
+                new_job = parse_json_body(request)
+                duration = get_duration(new_job)
+                job = self._get_job()
+                if job is not None:
+                    job.duration = duration
+                    return json_response(request, job.for_json())
+
+                job = self._job_queue.add(self._court_id, duration,
+                        priority=get_priority(new_job))
+            except (RuntimeError, ValueError) as e:
+                return error_response(request, http.BAD_REQUEST, str(e))
         return json_response(request, job.for_json())
 
 
@@ -111,8 +513,9 @@ class ActiveJobsResource(resource.Resource):
         self._job_queue = job_queue
 
     def render_GET(self, request):
-        return json_response(request, [job.for_json() for job \
-                in self._job_queue.list_active_jobs()])
+        return list_jobs_response(request, self._job_queue,
+                self._job_queue.iter_active_jobs,
+                self._job_queue.iter_active_job_ids)
 
     def getChild(self, path, request): 
         return ActiveJobResource(job_queue=self._job_queue, job_id=int(path))
@@ -146,8 +549,11 @@ class WaitingJobsResource(resource.Resource):
         self._job_queue = job_queue
 
     def render_GET(self, request):
-        return json_response(request, [job.for_json() for job \
-                in self._job_queue.list_waiting_jobs()])
+        """Lists the waiting jobs, by default in the order in which they
+        are started, see list_jobs_response()."""
+        return list_jobs_response(request, self._job_queue,
+                self._job_queue.iter_waiting_jobs,
+                self._job_queue.iter_waiting_job_ids)
 
     def getChild(self, path, request): 
         return WaitingJobResource(job_queue=self._job_queue, job_id=int(path))
@@ -175,10 +581,161 @@ class WaitingJobResource(resource.Resource):
         return json_response(request, job.for_json())
 
 
-def create_site(job_queue, sprinkler_ctrl):
-    root = static.File('wwwroot')
+class ProgramsResource(resource.Resource):
+    def __init__(self, program_scheduler):
+        resource.Resource.__init__(self)
+        self._program_scheduler = program_scheduler
+
+    def getChild(self, path, request):
+        if not path.isdigit() \
+                or self._program_scheduler.get_program(int(path)) is None:
+            return resource.NoResource('unknown program')
+        return ProgramResource(self._program_scheduler, int(path))
+
+    def render_GET(self, request):
+        return json_response(request, [program.for_json() for program \
+                in self._program_scheduler.list_programs()])
+
+    def render_POST(self, request):
+        try:
+            new_program = parse_json_body(request)
+            program = self._program_scheduler.add_program(
+                    new_program.get('name', ''),
+                    schedule_from_json(new_program['schedule']),
+                    new_program['sprinkler_ids'],
+                    new_program['duration'],
+                    paused=new_program.get('paused', False),
+                    overlap=new_program.get('overlap'),
+                    priority=get_priority(new_program))
+        except (RuntimeError, ValueError, KeyError) as e:
+            return error_response(request, http.BAD_REQUEST, str(e))
+        return json_response(request, program.for_json())
+
+
+class ProgramResource(resource.Resource):
+    isLeaf = True
+
+    def __init__(self, program_scheduler, program_id):
+        resource.Resource.__init__(self)
+        self._program_scheduler = program_scheduler
+        self._program_id = program_id
+
+    def render_GET(self, request):
+        program = self._program_scheduler.get_program(self._program_id)
+        return json_response(request, program.for_json())
+
+    def render_POST(self, request):
+        """Pauses or resumes the program."""
+        modified_program = json.loads(request.content.getvalue())
+        if not isinstance(modified_program.get('paused'), bool):
+            return error_response(request, http.BAD_REQUEST,
+                    'paused needs to be true or false')
+        if modified_program['paused']:
+            program = self._program_scheduler.pause_program(self._program_id)
+        else:
+            program = self._program_scheduler.resume_program(
+                    self._program_id)
+        return json_response(request, program.for_json())
+
+    def render_DELETE(self, request):
+        program = self._program_scheduler.remove_program(self._program_id)
+        return json_response(request, program.for_json())
+
+
+class ReloadResource(resource.Resource):
+    """Applies the changes of the sprinklers in the configuration file,
+    see SprinklerZones.reload()."""
+    isLeaf = True
+
+    def __init__(self, reload_sprinklers):
+        resource.Resource.__init__(self)
+        self._reload_sprinklers = reload_sprinklers
+
+    def render_POST(self, request):
+        try:
+            changes = self._reload_sprinklers()
+        except RuntimeError as e:
+            return error_response(request, http.BAD_REQUEST, str(e))
+        return json_response(request, changes)
+
+
+class MetricsResource(resource.Resource):
+    isLeaf = True
+
+    def __init__(self, registry):
+        resource.Resource.__init__(self)
+        self._registry = registry
+
+    def render_GET(self, request):
+        request.setHeader(b'Content-Type', b'text/plain; version=0.0.4')
+        return self._registry.expose().encode('utf-8')
+
+
+class TracesResource(resource.Resource):
+    isLeaf = True
+
+    def __init__(self, tracer):
+        resource.Resource.__init__(self)
+        self._tracer = tracer
+
+    def render_GET(self, request):
+        try:
+            limit = get_limit_arg(request)
+        except ValueError as e:
+            return error_response(request, http.BAD_REQUEST, str(e))
+        return json_response(request, {
+            'enabled': self._tracer.enabled,
+            'stages': self._tracer.stage_summary(),
+            'traces': [trace.for_json() for trace \
+                    in self._tracer.list_traces()[:limit]],
+        })
+
+
+class InstrumentedRequest(server.Request):
+    """Request that records its latency per rendering resource.  Resources
+    with a true `streaming` attribute keep the connection open for as long
+    as the client listens, so their requests are not recorded."""
+    def __init__(self, *args, **kwargs):
+        server.Request.__init__(self, *args, **kwargs)
+        self._start_time = default_timer()
+        self._resource_name = None
+        self._is_streaming = False
+
+    def render(self, resrc):
+        self._resource_name = resrc.__class__.__name__
+        self._is_streaming = getattr(resrc, 'streaming', False)
+        server.Request.render(self, resrc)
+
+    def finish(self):
+        if not self._is_streaming:
+            HTTP_REQUEST_LATENCY.labels(self._resource_name).observe(
+                    default_timer() - self._start_time)
+        return server.Request.finish(self)
+
+
+def create_site(job_queue, sprinkler_ctrl, clock=reactor,
+        program_scheduler=None, reload_sprinklers=None, www_root='wwwroot'):
+    assets = load_assets(www_root)
+    # Compressing takes longer than the rest of the start-up, so it is done
+    # in the background, serving uncompressed files in the meantime.
+    compress_assets_in_background(assets, clock)
+    root = StaticAssetsResource(assets)
     root.putChild('jobs', JobsResource(job_queue))
     root.putChild('courts', CourtsResource(sprinkler_ctrl, job_queue))
+    root.putChild('status', StatusResource(
+            CourtStatusSnapshot(sprinkler_ctrl, job_queue), clock))
+    root.putChild('events', EventStreamResource(
+            EventBroadcaster(sprinkler_ctrl, job_queue, clock)))
+
+    if program_scheduler is not None:
+        root.putChild('programs', ProgramsResource(program_scheduler))
+    if reload_sprinklers is not None:
+        admin = resource.Resource()
+        admin.putChild('reload', ReloadResource(reload_sprinklers))
+        root.putChild('admin', admin)
+    root.putChild('metrics', MetricsResource(REGISTRY))
+    root.putChild('traces', TracesResource(TRACER))
 
     site = server.Site(root)
+    site.requestFactory = InstrumentedRequest
     return site
@@ -1,8 +1,20 @@
 # vim:set ts=4 sw=4 et:
 from __future__ import (absolute_import, division, print_function,
         unicode_literals)
-import time
-from pba.core.task_ext import defer_later
+from twisted.internet import defer
+from pba.core.scheduler import TimerScheduler
+from pba.core.sliding_window import SlidingWindowSum
+from pba.core.sorted_ids import SortedIds
+from pba.core.metrics import REGISTRY
+from pba.core.tracing import TRACER
+
+INTERCEPTOR_REJECTIONS = REGISTRY.counter('pba_interceptor_rejections_total',
+        'Sprinkler state changes rejected by an interceptor',
+        ['interceptor'])
+MAX_ACTIVE_REJECTIONS = INTERCEPTOR_REJECTIONS.labels('max_active')
+STATE_VERIFICATION_REJECTIONS = INTERCEPTOR_REJECTIONS.labels(
+        'state_verification')
+MAX_RUNTIME_REJECTIONS = INTERCEPTOR_REJECTIONS.labels('max_runtime')
 
 
 class SprinklerException(Exception):
@@ -11,97 +23,143 @@ class SprinklerException(Exception):
 
 class NullInterceptor(object):
     def turn_on(self, sprinkler):
-        sprinkler.turn_on()
+        return defer.maybeDeferred(sprinkler.turn_on)
 
     def turn_off(self, sprinkler):
-        sprinkler.turn_off()
+        return defer.maybeDeferred(sprinkler.turn_off)
 
 
 class AbstractBaseInterceptor(object):
+    """Base class of the interceptors in the SprinklerController chain.
+
+    turn_on() and turn_off() return Deferreds that fire once the sprinkler
+    was actually switched, which may happen asynchronously.  Interceptors
+    must only commit their state once the chained call succeeded, and need
+    to account for calls that are still in progress.
+    """
     def __init__(self):
         self.chained_interceptor = NullInterceptor()
 
 
+class TracePointInterceptor(object):
+    """Stamps the current trace when a sprinkler is about to be turned on
+    by `interceptor`."""
+    def __init__(self, interceptor):
+        self._interceptor = interceptor
+        self._stage = 'interceptor:{}'.format(interceptor.__class__.__name__)
+
+    def turn_on(self, sprinkler):
+        TRACER.stamp(self._stage)
+        return self._interceptor.turn_on(sprinkler)
+
+    def turn_off(self, sprinkler):
+        return self._interceptor.turn_off(sprinkler)
+
+
 class GlobalMaximumOfActiveSprinklersInterceptor(AbstractBaseInterceptor):
     def __init__(self, max_active_sprinklers=2):
         AbstractBaseInterceptor.__init__(self)
         self._max_active_sprinklers = max_active_sprinklers
         self._active_sprinklers = 0
+        self._sprinklers_turning_on = 0
 
     def turn_on(self, sprinkler):
         if self._max_active_sprinklers_reached():
+            MAX_ACTIVE_REJECTIONS.inc()
             raise SprinklerException(
                     'maximum number of active sprinklers exceeded')
-        self.chained_interceptor.turn_on(sprinkler)
+        self._sprinklers_turning_on += 1
+        d = defer.maybeDeferred(self.chained_interceptor.turn_on, sprinkler)
+        d.addCallback(self._on_turned_on)
+        d.addBoth(self._on_turn_on_done)
+        return d
+
+    def _on_turned_on(self, result):
         self._active_sprinklers += 1
+        return result
+
+    def _on_turn_on_done(self, result):
+        self._sprinklers_turning_on -= 1
+        return result
 
     def turn_off(self, sprinkler):
-        self.chained_interceptor.turn_off(sprinkler)
+        d = defer.maybeDeferred(self.chained_interceptor.turn_off, sprinkler)
+        d.addCallback(self._on_turned_off)
+        return d
+
+    def _on_turned_off(self, result):
         self._active_sprinklers -= 1
+        return result
 
     def _max_active_sprinklers_reached(self):
-        return self._active_sprinklers == self._max_active_sprinklers
+        return self._active_sprinklers + self._sprinklers_turning_on \
+                >= self._max_active_sprinklers
 
 
 class StateVerificationInterceptor(AbstractBaseInterceptor):
     def __init__(self):
         AbstractBaseInterceptor.__init__(self)
         self._state = {}
+        self._sprinklers_turning_on = set()
 
     def turn_on(self, sprinkler):
-        if self._state.get(sprinkler, False):
+        if self._state.get(sprinkler, False) \
+                or sprinkler in self._sprinklers_turning_on:
+            STATE_VERIFICATION_REJECTIONS.inc()
             raise SprinklerException('sprinkler {} already turned on'.format(
                     sprinkler))
-        self.chained_interceptor.turn_on(sprinkler)
-        self._state[sprinkler] = True
+        self._sprinklers_turning_on.add(sprinkler)
+        d = defer.maybeDeferred(self.chained_interceptor.turn_on, sprinkler)
+        d.addCallback(self._set_state, sprinkler, True)
+        d.addBoth(self._on_turn_on_done, sprinkler)
+        return d
+
+    def _on_turn_on_done(self, result, sprinkler):
+        self._sprinklers_turning_on.discard(sprinkler)
+        return result
 
     def turn_off(self, sprinkler):
         if not self._state.get(sprinkler, False):
+            STATE_VERIFICATION_REJECTIONS.inc()
             raise SprinklerException('sprinkler {} already turned off'.format(
                     sprinkler))
-        self.chained_interceptor.turn_off(sprinkler)
-        self._state[sprinkler] = False
+        d = defer.maybeDeferred(self.chained_interceptor.turn_off, sprinkler)
+        d.addCallback(self._set_state, sprinkler, False)
+        return d
 
+    def _set_state(self, result, sprinkler, state):
+        self._state[sprinkler] = state
+        return result
 
-class MaximumAverageRuntimeTracker(object):
-    TWENTY_FOUR_HOURS_IN_SECS = 24 * 60 * 60
 
-    def __init__(self, clock, sprinkler_id, sprinkler_ctrl, max_runtimes):
-        self._clock = clock
+class MaximumAverageRuntimeTracker(object):
+    def __init__(self, scheduler, sprinkler_id, sprinkler_ctrl, max_runtimes):
+        self._scheduler = scheduler
         self._sprinkler_id = sprinkler_id
         self._sprinkler_ctrl = sprinkler_ctrl
-        self._max_runtimes = max_runtimes
+        self._max_runtimes = [(SlidingWindowSum(duration), max_runtime) \
+                for duration, max_runtime in max_runtimes]
         self._timer = None
-        self._historic_runtimes = []
         self._start_time = None
 
     def start(self):
         """Track sprinkler start event."""
         self._cancel()
-        max_remaining_runtime = None
-        for duration, max_runtime in self._max_runtimes:
-            last_runtime = self._calculate_runtime_for(duration)
-            max_remaining_runtime_for_duration = max_runtime - last_runtime
-            if max_remaining_runtime is None:
-                max_remaining_runtime = max_remaining_runtime_for_duration
-            max_remaining_runtime = min(max_remaining_runtime_for_duration,
-                     max_remaining_runtime)
+        now = self._scheduler.seconds()
+        max_remaining_runtime = min([max_runtime - runtimes.total(now) \
+                for runtimes, max_runtime in self._max_runtimes])
 
         if max_remaining_runtime < 0:
+            MAX_RUNTIME_REJECTIONS.inc()
             raise SprinklerException(
                     'sprinkler {} was already running for too long'.format(
                             self._sprinkler_id))
 
         print('sprinkler {} will be stopped in {} seconds'.format(
                 self._sprinkler_id, max_remaining_runtime))
-        self._timer = defer_later(self._clock, max_remaining_runtime,
+        self._timer = self._scheduler.call_later(max_remaining_runtime,
                 self._on_timeout)
-        self._start_time = time.time()
-
-    def _max_remaining_runtime(self, since):
-        last_runtime = self._calculate_duration_for(since)
-        max_remaining_runtime = self._max_runtime_secs - last_runtime
-        return max_remaining_runtime
+        self._start_time = now
 
     def cancel(self):
         """Cancel the sprinkler start event."""
@@ -112,27 +170,26 @@ class MaximumAverageRuntimeTracker(object):
         self._cancel()
         self._record_runtime()
 
+    def snapshot(self):
+        """Returns the recorded runtimes in a JSON serialisable form."""
+        return [runtimes.snapshot() for runtimes, _ in self._max_runtimes]
+
+    def restore(self, state):
+        """Restores runtimes recorded by snapshot().  Windows that are not
+        part of the state are left untouched."""
+        window_states = dict((window_state['window'], window_state) \
+                for window_state in state)
+        for runtimes, _ in self._max_runtimes:
+            if runtimes.window in window_states:
+                runtimes.restore(window_states[runtimes.window])
+
     def _record_runtime(self):
-        end_time = time.time()
+        end_time = self._scheduler.seconds()
         runtime = end_time - self._start_time
         print("Recording end runtime: {0}, {1}".format(end_time, runtime))
-        self._historic_runtimes.append((end_time, runtime))
+        for runtimes, _ in self._max_runtimes:
+            runtimes.add(end_time, runtime)
         self._start_time = None
-        self._clean_history()
-
-    def _calculate_runtime_for(self, duration):
-        last_relevant_timestamp = time.time() - duration
-        return sum([runtime \
-                for end_time, runtime \
-                in self._historic_runtimes \
-                if end_time >= last_relevant_timestamp])
-
-    def _clean_history(self):
-        last_relevant_timestamp = time.time() - self.TWENTY_FOUR_HOURS_IN_SECS
-        self._historic_runtimes = [(end_time, runtime) \
-                for end_time, runtime \
-                in self._historic_runtimes \
-                if end_time >= last_relevant_timestamp]
 
     def _cancel(self):
         if self._timer is not None:
@@ -140,54 +197,158 @@ class MaximumAverageRuntimeTracker(object):
             self._timer = None
 
     def _on_timeout(self):
-        self._sprinkler_ctrl.turn_off(self._sprinkler_id)
+        self._timer = None
+        d = self._sprinkler_ctrl.turn_off(self._sprinkler_id)
+        d.addErrback(lambda failure: print(
+                'stopping sprinkler {} after its maximum runtime failed: {}'
+                .format(self._sprinkler_id, failure.getErrorMessage())))
 
 
 class MaximumAverageRuntimeInterceptor(AbstractBaseInterceptor):
-    def __init__(self, clock, sprinkler_ctrl, max_runtimes):
+    def __init__(self, clock, sprinkler_ctrl, max_runtimes, scheduler=None):
         AbstractBaseInterceptor.__init__(self)
-        self._clock = clock
+        if scheduler is None:
+            scheduler = TimerScheduler(clock)
+        self._scheduler = scheduler
         self._sprinkler_ctrl = sprinkler_ctrl
         self._max_runtimes = max_runtimes
         self._sprinkler_tracker = {}
+        self._restored_state = {}
+
+    def _get_tracker(self, sprinkler):
+        # Trackers are kept by sprinkler id, so the runtime history of a
+        # sprinkler carries over if its port is replaced.
+        sprinkler_id = sprinkler.sprinkler_id
+        if sprinkler_id not in self._sprinkler_tracker:
+            tracker = MaximumAverageRuntimeTracker(self._scheduler,
+                    sprinkler_id,
+                    self._sprinkler_ctrl,
+                    max_runtimes=self._max_runtimes)
+            state = self._restored_state.pop(sprinkler_id, None)
+            if state is not None:
+                tracker.restore(state)
+            self._sprinkler_tracker[sprinkler_id] = tracker
+        return self._sprinkler_tracker[sprinkler_id]
 
     def turn_on(self, sprinkler):
-        if sprinkler not in self._sprinkler_tracker:
-            self._sprinkler_tracker[sprinkler] = \
-                    MaximumAverageRuntimeTracker(self._clock,
-                            sprinkler.sprinkler_id,
-                            self._sprinkler_ctrl,
-                            max_runtimes=self._max_runtimes)
-        self._sprinkler_tracker[sprinkler].start()
-        try:
-            self.chained_interceptor.turn_on(sprinkler)
-        except:
-            self._sprinkler_tracker[sprinkler].cancel()
-            raise
+        tracker = self._get_tracker(sprinkler)
+        tracker.start()
+        d = defer.maybeDeferred(self.chained_interceptor.turn_on, sprinkler)
+        d.addErrback(self._on_turn_on_failed, tracker)
+        return d
+
+    def _on_turn_on_failed(self, failure, tracker):
+        tracker.cancel()
+        return failure
 
     def turn_off(self, sprinkler):
-        self.chained_interceptor.turn_off(sprinkler)
-        self._sprinkler_tracker[sprinkler].stop()
+        d = defer.maybeDeferred(self.chained_interceptor.turn_off, sprinkler)
+        d.addCallback(self._on_turned_off, sprinkler)
+        return d
+
+    def _on_turned_off(self, result, sprinkler):
+        self._sprinkler_tracker[sprinkler.sprinkler_id].stop()
+        return result
+
+    def snapshot(self):
+        """Returns the runtime history of all sprinklers, keyed by sprinkler
+        id, in a JSON serialisable form."""
+        state = dict(self._restored_state)
+        for sprinkler_id, tracker in self._sprinkler_tracker.items():
+            state[sprinkler_id] = tracker.snapshot()
+        return state
+
+    def restore(self, state):
+        """Restores the runtime history recorded by snapshot()."""
+        for sprinkler_id, tracker_state in state.items():
+            if sprinkler_id in self._sprinkler_tracker:
+                self._sprinkler_tracker[sprinkler_id].restore(tracker_state)
+            else:
+                self._restored_state[sprinkler_id] = tracker_state
 
 
 class SprinklerController(object):
+    SPRINKLER_ON = 'sprinkler_on'
+    SPRINKLER_OFF = 'sprinkler_off'
+    SPRINKLER_ADDED = 'sprinkler_added'
+    SPRINKLER_REMOVED = 'sprinkler_removed'
+
     def __init__(self):
         self._sprinkler_to_port = {}
+        self._sorted_sprinkler_ids = SortedIds()
         self._interceptor = NullInterceptor()
+        # The ports that are on, which are turned off even if the sprinkler
+        # was removed or replaced in the meantime.
+        self._active_ports = {}
+        self._listeners = []
+
+    def add_listener(self, listener):
+        """Registers `listener(event, sprinkler_id)` to be called after a
+        sprinkler was successfully turned on or off, or was added or
+        removed."""
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        self._listeners.remove(listener)
+
+    def _notify(self, event, sprinkler_id):
+        for listener in list(self._listeners):
+            listener(event, sprinkler_id)
 
     def add_sprinkler(self, sprinkler_id, port):
+        """Adds the sprinkler, or replaces the port of an existing one."""
         self._sprinkler_to_port[sprinkler_id] = port
+        self._sorted_sprinkler_ids.add(sprinkler_id)
+        self._notify(self.SPRINKLER_ADDED, sprinkler_id)
+
+    def remove_sprinkler(self, sprinkler_id):
+        """Removes the sprinkler.  If it is on, it can still be turned
+        off."""
+        port = self._sprinkler_to_port.pop(sprinkler_id)
+        self._sorted_sprinkler_ids.remove(sprinkler_id)
+        self._notify(self.SPRINKLER_REMOVED, sprinkler_id)
+        return port
 
     def add_interceptor(self, interceptor):
         interceptor.chained_interceptor = self._interceptor
-        self._interceptor = interceptor
+        self._interceptor = TracePointInterceptor(interceptor)
 
     def turn_on(self, sprinkler_id):
-        return self._interceptor.turn_on(self._sprinkler_to_port[sprinkler_id])
+        """Turns the sprinkler on.  Returns a Deferred that fires once it
+        was turned on."""
+        port = self._sprinkler_to_port.get(sprinkler_id)
+        if port is None:
+            return defer.fail(SprinklerException(
+                    'unknown sprinkler {}'.format(sprinkler_id)))
+        d = defer.maybeDeferred(self._interceptor.turn_on, port)
+        d.addCallback(self._on_turned_on, sprinkler_id, port)
+        return d
+
+    def _on_turned_on(self, result, sprinkler_id, port):
+        self._active_ports[sprinkler_id] = port
+        self._notify(self.SPRINKLER_ON, sprinkler_id)
+        return result
 
     def turn_off(self, sprinkler_id):
-        return self._interceptor.turn_off(
-                self._sprinkler_to_port[sprinkler_id])
+        """Turns the sprinkler off.  Returns a Deferred that fires once it
+        was turned off."""
+        port = self._active_ports.get(sprinkler_id,
+                self._sprinkler_to_port.get(sprinkler_id))
+        if port is None:
+            return defer.fail(SprinklerException(
+                    'unknown sprinkler {}'.format(sprinkler_id)))
+        d = defer.maybeDeferred(self._interceptor.turn_off, port)
+        d.addCallback(self._on_turned_off, sprinkler_id, port)
+        return d
+
+    def _on_turned_off(self, result, sprinkler_id, port):
+        if self._active_ports.get(sprinkler_id) is port:
+            del self._active_ports[sprinkler_id]
+        self._notify(self.SPRINKLER_OFF, sprinkler_id)
+        return result
+
+    def is_on(self, sprinkler_id):
+        return sprinkler_id in self._active_ports
 
     def is_valid(self, sprinkler_id):
         return sprinkler_id in self._sprinkler_to_port
@@ -195,3 +356,8 @@ class SprinklerController(object):
     @property
     def sprinkler_ids(self):
         return self._sprinkler_to_port.keys()
+
+    def iter_sprinkler_ids(self, after=None, prefix=''):
+        """Yields the sprinkler ids in sorted order, see
+        SortedIds.iter_range()."""
+        return self._sorted_sprinkler_ids.iter_range(after, prefix)
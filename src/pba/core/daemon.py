@@ -2,44 +2,209 @@
 from __future__ import (absolute_import, division, print_function,
         unicode_literals)
 import sys
-from pba.core import gpio
-from twisted.internet import reactor
+import os
+import json
+from pba.core import gpio, tracing
+from twisted.internet import reactor, task
 import weakref
 from pba.core.controller import MaximumAverageRuntimeInterceptor, \
     GlobalMaximumOfActiveSprinklersInterceptor, StateVerificationInterceptor, \
     SprinklerController
-from pba.core.job_queue import MaxActiveSprinklerJobPolicy, SprinklerJobQueue
-from ConfigParser import SafeConfigParser
-from pba.core.sprinkler_config import load_sprinklers
+from pba.core.job_queue import FlowBudgetJobPolicy, \
+        MaxActiveSprinklerJobPolicy, SprinklerJobQueue
+from pba.core.scheduler import TimerScheduler
+from ConfigParser import SafeConfigParser, Error as ConfigParserError
+from timeit import default_timer
+from pba.core.sprinkler_config import SprinklerZones
+from pba.core.journal import JobJournal
+from pba.core.programs import ProgramScheduler
 
+RUNTIME_LIMIT_STATE_SAVE_INTERVAL = 5 * 60
 
-def load_sprinkler_interceptors(sprinkler_ctrl):
-    sprinkler_ctrl.add_interceptor(MaximumAverageRuntimeInterceptor(
+
+def load_sprinkler_interceptors(sprinkler_ctrl, scheduler=None,
+        max_active_sprinklers=2):
+    runtime_interceptor = MaximumAverageRuntimeInterceptor(
             reactor,
             weakref.proxy(sprinkler_ctrl),
             max_runtimes=[
                 (60 * 60, 10 * 60),
                 (12 * 60 * 60, 30 * 60),
                 (24 * 60 * 60, 1 * 60 * 60),
-            ]))
+            ],
+            scheduler=scheduler)
+    sprinkler_ctrl.add_interceptor(runtime_interceptor)
     sprinkler_ctrl.add_interceptor(
-            GlobalMaximumOfActiveSprinklersInterceptor())
+            GlobalMaximumOfActiveSprinklersInterceptor(
+                    max_active_sprinklers))
     sprinkler_ctrl.add_interceptor(
             StateVerificationInterceptor())
+    return runtime_interceptor
+
+
+def restore_runtime_limit_state(runtime_interceptor, state_file):
+    if not os.path.exists(state_file):
+        return
+    with open(state_file) as fp:
+        runtime_interceptor.restore(json.load(fp))
+
+
+def save_state(state, state_file):
+    tmp_state_file = state_file + '.tmp'
+    with open(tmp_state_file, 'w') as fp:
+        json.dump(state, fp)
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.rename(tmp_state_file, state_file)
+
+
+def save_runtime_limit_state(runtime_interceptor, state_file):
+    save_state(runtime_interceptor.snapshot(), state_file)
+
+
+def persist_runtime_limit_state(runtime_interceptor, state_file):
+    """Restores the runtime history from `state_file` and keeps saving it
+    there periodically and on shutdown (after all sprinklers were stopped).
+    """
+    restore_runtime_limit_state(runtime_interceptor, state_file)
+    saver = task.LoopingCall(save_runtime_limit_state, runtime_interceptor,
+            state_file)
+    saver.start(RUNTIME_LIMIT_STATE_SAVE_INTERVAL, now=False)
+    reactor.addSystemEventTrigger('during', 'shutdown',
+            save_runtime_limit_state, runtime_interceptor, state_file)
+
+
+def load_job_journal(config, job_queue):
+    """Restores the jobs recorded in the configured job journal and keeps
+    journaling job_queue.  Returns the journal, or None if no journal is
+    configured."""
+    if not config.has_option('state', 'job_journal_file'):
+        return None
+    journal = JobJournal(reactor, config.get('state', 'job_journal_file'))
+    job_queue.restore_jobs(*journal.recover())
+    journal.attach(job_queue)
+    return journal
+
+
+def load_programs(config, job_queue, sprinkler_ctrl):
+    """Returns the program scheduler.  If [state] programs_file is
+    configured, the programs are restored from it and saved there whenever
+    they change."""
+    program_scheduler = ProgramScheduler(TimerScheduler(reactor), job_queue,
+            sprinkler_ctrl)
+    if config.has_option('state', 'programs_file'):
+        programs_file = config.get('state', 'programs_file')
+        if os.path.exists(programs_file):
+            with open(programs_file) as fp:
+                program_scheduler.restore(json.load(fp))
+        program_scheduler.add_listener(lambda: save_state(
+                program_scheduler.snapshot(), programs_file))
+    return program_scheduler
+
+
+def load_gpio_controller(config):
+    gpio_worker = None
+    if config.has_option('gpio', 'async_io') \
+            and config.getboolean('gpio', 'async_io'):
+        gpio_worker = gpio.GpioWorker(reactor)
+        gpio_worker.start()
+    base_path = gpio.GpioController.GPIO_BASE_PATH
+    if config.has_option('gpio', 'base_path'):
+        base_path = config.get('gpio', 'base_path')
+    return gpio.GpioController(base_path=base_path, worker=gpio_worker)
+
+
+def load_tracing(config):
+    if not config.has_option('tracing', 'enabled'):
+        return
+    buffer_size = tracing.Tracer.BUFFER_SIZE
+    if config.has_option('tracing', 'buffer_size'):
+        buffer_size = config.getint('tracing', 'buffer_size')
+    tracing.TRACER.configure(config.getboolean('tracing', 'enabled'),
+            buffer_size)
+
+
+def load_flow_capacity(config):
+    """Returns the flow the site can supply, limited by its pump and its
+    mainline, or None if neither is configured."""
+    capacities = [config.getfloat('site', option) \
+            for option in ('pump_capacity', 'mainline_capacity') \
+            if config.has_option('site', option)]
+    if not capacities:
+        return None
+    return min(capacities)
+
+
+def load_shard(config):
+    """Returns the index of this daemon among the shards of its
+    federation and the number of shards, (0, 1) if it is not a shard."""
+    if not config.has_option('shard', 'count'):
+        return 0, 1
+    index = config.getint('shard', 'index')
+    count = config.getint('shard', 'count')
+    if not 0 <= index < count:
+        raise RuntimeError('shard index {} is out of range 0-{}'.format(
+                index, count - 1))
+    return index, count
 
 
 def main(config):
-    gpio_ctrl = gpio.GpioController()
+    load_tracing(config)
+    gpio_ctrl = load_gpio_controller(config)
     sprinkler_ctrl = SprinklerController()
-    queue_policy = MaxActiveSprinklerJobPolicy(max_total=1, max_low_priority=1)
+    scheduler = TimerScheduler(reactor)
+    sprinkler_zones = SprinklerZones(gpio_ctrl, sprinkler_ctrl)
+    sprinkler_zones.load(config)
+    flow_rates = sprinkler_zones.flow_rates
+
+    flow_capacity = load_flow_capacity(config)
+    if flow_capacity is None:
+        queue_policy = MaxActiveSprinklerJobPolicy(max_total=1,
+                max_low_priority=1)
+        max_active_sprinklers = 2
+    else:
+        queue_policy = FlowBudgetJobPolicy(flow_rates, flow_capacity)
+        max_active_sprinklers = len(flow_rates)
+        if config.has_option('site', 'max_active_sprinklers'):
+            max_active_sprinklers = config.getint('site',
+                    'max_active_sprinklers')
+    aging_rate = 0
+    if config.has_option('queue', 'priority_aging'):
+        # Configured in priority levels per hour of waiting.
+        aging_rate = config.getfloat('queue', 'priority_aging') / (60 * 60)
+    shard_index, num_shards = load_shard(config)
     sprinkler_job_queue = SprinklerJobQueue(reactor, sprinkler_ctrl,
-            queue_policy)
+            queue_policy, scheduler=scheduler, aging_rate=aging_rate,
+            job_id_step=num_shards, job_id_offset=shard_index)
+    sprinkler_zones.attach(sprinkler_job_queue)
 
-    load_sprinklers(config, gpio_ctrl,
-            lambda sprinkler_name, sprinkler: sprinkler_ctrl.add_sprinkler(sprinkler_name, sprinkler))
-    load_sprinkler_interceptors(sprinkler_ctrl)
+    runtime_interceptor = load_sprinkler_interceptors(sprinkler_ctrl,
+            scheduler=scheduler, max_active_sprinklers=max_active_sprinklers)
+    if config.has_option('state', 'runtime_limits_file'):
+        persist_runtime_limit_state(runtime_interceptor,
+                config.get('state', 'runtime_limits_file'))
 
-    return sprinkler_job_queue, sprinkler_ctrl
+    return sprinkler_job_queue, sprinkler_ctrl, sprinkler_zones
+
+
+def reload_sprinklers(config_file, sprinkler_zones):
+    """Applies the changes of the [sprinklers] section of `config_file`,
+    see SprinklerZones.reload().  Changes of other sections still need a
+    restart."""
+    start = default_timer()
+    config = SafeConfigParser()
+    try:
+        if not config.read(config_file):
+            raise RuntimeError('cannot read {}'.format(config_file))
+        changes = sprinkler_zones.reload(config)
+    except (ValueError, EnvironmentError, ConfigParserError) as e:
+        raise RuntimeError('reloading {} failed: {}'.format(config_file, e))
+    print('reloaded sprinklers in {:.1f} ms, added: {}, removed: {}, ' \
+            'changed: {}'.format((default_timer() - start) * 1000,
+            ', '.join(changes['added']) or '-',
+            ', '.join(changes['removed']) or '-',
+            ', '.join(changes['changed']) or '-'))
+    return changes
 
 
 if __name__ == '__main__':
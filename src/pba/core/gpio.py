@@ -2,25 +2,192 @@
 from __future__ import (absolute_import, division, print_function,
         unicode_literals)
 
+from collections import deque
+import errno
+import os
 import os.path
+import time
+from timeit import default_timer
+from pba.core.metrics import REGISTRY
+from pba.core.tracing import TRACER
+
+GPIO_WRITE_LATENCY = REGISTRY.histogram('pba_gpio_write_seconds',
+        'Time taken by writes to the sysfs GPIO files', ['file'])
+GPIO_VALUE_WRITE_LATENCY = GPIO_WRITE_LATENCY.labels('value')
+
+
+def _emulated_pwrite(fd, data, offset):
+    os.lseek(fd, offset, os.SEEK_SET)
+    return os.write(fd, data)
+
+
+pwrite = getattr(os, 'pwrite', _emulated_pwrite)
 
 
 class GpioController(object):
     GPIO_BASE_PATH = '/sys/class/gpio'
+    EXPORT_THREADS = 8
 
-    def __init__(self, base_path=GPIO_BASE_PATH):
+    def __init__(self, base_path=GPIO_BASE_PATH, worker=None):
         self._base_path = base_path
+        self._worker = worker
 
     def get_outgoing_port(self, port_id, inverted=False):
-        return GpioOutPort(base_path=self._base_path, port_id=port_id, inverted=inverted)
+        port = GpioOutPort(base_path=self._base_path, port_id=port_id, inverted=inverted)
+        if self._worker is not None:
+            return AsyncGpioOutPort(port, self._worker)
+        return port
+
+    def export_ports(self, ports, num_threads=EXPORT_THREADS):
+        """Exports all GpioOutPorts that are not exported yet at once and
+        sets them up in parallel, so that waiting for the kernel and for
+        udev overlaps.  Returns the exported ports."""
+        exported = set(os.listdir(self._base_path))
+        ports = [port for port in ports if port.node_name not in exported]
+        if not ports:
+            return []
+        fd = os.open(os.path.join(self._base_path, 'export'), os.O_WRONLY)
+        try:
+            for port in ports:
+                # The kernel expects one port number per write.
+                os.write(fd, '{}\n'.format(port.port_id).encode('ascii'))
+        finally:
+            os.close(fd)
+
+        # Not the thread pool of twisted, which gpio-config does not load.
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(min(num_threads, len(ports)))
+        try:
+            pool.map(lambda port: port.configure(), ports)
+        finally:
+            pool.close()
+            pool.join()
+        return ports
+
+
+class GpioWorker(object):
+    """Performs GPIO writes off the reactor thread, so that a slow driver
+    cannot stall the event loop.
+
+    The commands for each port are executed one at a time in the order in
+    which they were submitted, while the commands for different ports run
+    in parallel on a pool of up to `max_threads` threads.  A port whose
+    driver hangs only holds up its own commands, as long as fewer than
+    `max_threads` ports hang.
+    """
+    MAX_THREADS = 8
+
+    def __init__(self, reactor, max_threads=MAX_THREADS):
+        # Only imported when needed, so that gpio-config does not load
+        # twisted.
+        from twisted.python.threadpool import ThreadPool
+        self._reactor = reactor
+        self._pool = ThreadPool(minthreads=1, maxthreads=max_threads,
+                name='gpio')
+        # The commands waiting behind the running one, by port.
+        self._queues = {}
+        self._idle_waiters = []
+
+    def start(self):
+        self._pool.start()
+        self._reactor.addSystemEventTrigger('during', 'shutdown', self.stop)
+
+    def stop(self):
+        """Waits for the pending commands and stops the worker threads.
+        Returns a Deferred."""
+        from twisted.internet import defer
+        if self._queues:
+            d = defer.Deferred()
+            self._idle_waiters.append(d)
+        else:
+            d = defer.succeed(None)
+        d.addCallback(lambda _: self._pool.stop())
+        return d
+
+    def submit(self, port, func, *args, **kwargs):
+        """Runs func in a worker thread once the commands submitted before
+        for `port` are done.  Returns a Deferred with its result."""
+        from twisted.internet import defer
+        d = defer.Deferred()
+        queue = self._queues.get(port)
+        if queue is None:
+            self._queues[port] = deque()
+            self._run(port, d, func, args, kwargs)
+        else:
+            queue.append((d, func, args, kwargs))
+        return d
+
+    def _run(self, port, d, func, args, kwargs):
+        from twisted.internet import threads
+        pool_d = threads.deferToThreadPool(self._reactor, self._pool, func,
+                *args, **kwargs)
+        pool_d.addBoth(self._on_done, port)
+        pool_d.chainDeferred(d)
+
+    def _on_done(self, result, port):
+        queue = self._queues[port]
+        if queue:
+            self._run(port, *queue.popleft())
+        else:
+            del self._queues[port]
+            if not self._queues:
+                waiters, self._idle_waiters = self._idle_waiters, []
+                for waiter in waiters:
+                    waiter.callback(None)
+        return result
+
+
+class AsyncGpioOutPort(object):
+    """GpioOutPort whose state changes are executed by a GpioWorker and
+    return Deferreds."""
+    def __init__(self, port, worker):
+        self._port = port
+        self._worker = worker
+
+    def __str__(self):
+        return str(self._port)
+
+    @property
+    def port_id(self):
+        return self._port.port_id
+
+    @property
+    def node_name(self):
+        return self._port.node_name
+
+    @property
+    def is_exported(self):
+        return self._port.is_exported
+
+    def export(self):
+        self._port.export()
+
+    def configure(self):
+        self._port.configure()
+
+    def turn_on(self):
+        return self._worker.submit(self._port, TRACER.call_with,
+                TRACER.current_trace, self._port.turn_on)
+
+    def turn_off(self):
+        return self._worker.submit(self._port, self._port.turn_off)
+
+    def toggle(self):
+        return self._worker.submit(self._port, self._port.toggle)
 
 
 class GpioOutPort(object):
+    # How long to wait for the files of a freshly exported port, e.g. for
+    # udev to adjust their permissions.
+    EXPORT_TIMEOUT = 5
+
     def __init__(self, base_path, port_id, inverted):
         self._base_path = base_path
-        self._port_id = port_id
+        self.port_id = port_id
         self._inverted = inverted
-        self._state = False
+        # The state of the port is unknown until it is first written.
+        self._state = None
+        self._value_fd = None
 
     def __str__(self):
         return 'device {}{}'.format(self._port_path, ' inverted' if self._inverted else '')
@@ -29,24 +196,51 @@ class GpioOutPort(object):
     def is_exported(self):
         return os.path.exists(self._port_path)
 
+    @property
+    def node_name(self):
+        return 'gpio{}'.format(self.port_id)
+
     @property
     def _port_path(self):
-        return os.path.join(self._base_path, 'gpio{}'.format(self._port_id))
+        return os.path.join(self._base_path, self.node_name)
 
     def export(self):
         with open(os.path.join(self._base_path, 'export'), 'w') as fp:
-            fp.write('{}'.format(self._port_id))
-        self._set_direction('high' if self._inverted else 'low')
+            fp.write('{}'.format(self.port_id))
+        self.configure()
+
+    def configure(self):
+        """Sets up the port after it was exported."""
+        deadline = default_timer() + self.EXPORT_TIMEOUT
+        while True:
+            try:
+                self._set_direction('high' if self._inverted else 'low')
+                break
+            except (OSError, IOError) as e:
+                if e.errno not in (errno.ENOENT, errno.EACCES) \
+                        or default_timer() > deadline:
+                    raise
+                time.sleep(0.001)
         self._set_active_low('1' if self._inverted else '0')
+        self._state = False
+
+    def close(self):
+        if self._value_fd is not None:
+            os.close(self._value_fd)
+            self._value_fd = None
 
     def turn_on(self):
+        if self._state is True:
+            return
         print("activating port {}".format(self._port_path))
-        self._set_value('1')
+        self._set_value(b'1')
         self._state = True
 
     def turn_off(self):
+        if self._state is False:
+            return
         print("deactivating port {}".format(self._port_path))
-        self._set_value('0')
+        self._set_value(b'0')
         self._state = False
 
     def toggle(self):
@@ -56,7 +250,29 @@ class GpioOutPort(object):
             self.turn_on()
 
     def _set_value(self, value):
-        self._write('value', value)
+        try:
+            self._write_value(value)
+        except (OSError, IOError) as e:
+            if e.errno not in (errno.ENOENT, errno.ENODEV, errno.EBADF,
+                    errno.EINVAL):
+                raise
+            # The port was unexported underneath us, which invalidates the
+            # open value file.
+            print('port {} went away ({}), re-opening'.format(
+                    self._port_path, e))
+            self.close()
+            if not self.is_exported:
+                self.export()
+            self._write_value(value)
+
+    def _write_value(self, value):
+        if self._value_fd is None:
+            self._value_fd = os.open(os.path.join(self._port_path, 'value'),
+                    os.O_WRONLY)
+        start = default_timer()
+        pwrite(self._value_fd, value, 0)
+        GPIO_VALUE_WRITE_LATENCY.observe(default_timer() - start)
+        TRACER.stamp('gpio_write')
 
     def _set_direction(self, value):
         self._write('direction', value)
@@ -65,5 +281,8 @@ class GpioOutPort(object):
         self._write('active_low', value)
 
     def _write(self, variable_name, value):
+        start = default_timer()
         with open(os.path.join(self._port_path, variable_name), 'w') as fp:
             fp.write(value)
+        GPIO_WRITE_LATENCY.labels(variable_name).observe(
+                default_timer() - start)
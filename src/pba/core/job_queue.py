@@ -1,41 +1,55 @@
 # vim:set ts=4 sw=4 et:
 from __future__ import (absolute_import, division, print_function,
         unicode_literals)
-import time
-from pba.core.controller import SprinklerException
-from pba.core.task_ext import defer_later
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+import itertools
+from twisted.internet import defer
+from pba.core.lazy_heap import LazyHeap
+from pba.core.scheduler import TimerScheduler
+from pba.core.sorted_ids import SortedIds
+from pba.core.metrics import REGISTRY
+from pba.core.tracing import TRACER
+
+JOB_WAIT_TIME = REGISTRY.histogram('pba_job_wait_seconds',
+        'Time from queueing a job until it started',
+        buckets=(1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600, 3 * 3600))
+QUEUED_JOBS = REGISTRY.gauge('pba_jobs',
+        'Number of waiting and active jobs', ['state', 'priority'])
 
 
 class Queue(object):
-    def __init__(self):
-        self._queue = []
+    """FIFO queue whose items can be looked up and removed by key in
+    constant time.
+    """
+    def __init__(self, key_func):
+        self._key_func = key_func
+        self._queue = OrderedDict()
 
     def push(self, item):
-        self._queue.append(item)
+        self._queue[self._key_func(item)] = item
 
     def is_empty(self):
         return len(self._queue) == 0
 
+    def __len__(self):
+        return len(self._queue)
+
     def peek(self):
-        return self._queue[0]
+        return self._queue[next(iter(self._queue))]
 
     def pop(self):
-        return self._queue.pop(0)
+        return self._queue.popitem(last=False)[1]
 
-    def remove(self, search_func):
-        for idx, item in enumerate(self._queue):
-            if search_func(item):
-                del self._queue[idx]
-                return item
+    def remove(self, key):
+        return self._queue.pop(key, None)
 
     def list_all(self):
-        return self._queue
+        return list(self._queue.values())
 
-    def find(self, match_func):
-        for _, item in enumerate(self._queue):
-            if match_func(item):
-                return item
-        return None
+    def find(self, key):
+        return self._queue.get(key)
 
 
 class SprinklerJob(object):
@@ -44,20 +58,27 @@ class SprinklerJob(object):
     JOB_FINISHED = 'finished'
     JOB_CANCELLED = 'cancelled'
 
-    def __init__(self, clock, job_id, sprinkler_id, duration,
-            high_priority=False):
-        self._clock = clock
+    def __init__(self, scheduler, job_id, sprinkler_id, duration,
+            priority=0, aging_rate=0, queue_time=None):
+        self._scheduler = scheduler
         self.job_id = job_id
         self.sprinkler_id = sprinkler_id
         self._duration = duration
-        self.high_priority = high_priority
+        self.priority = priority
+        self.aging_rate = aging_rate
 
         self.status = self.JOB_WAITING
+        self.queue_time = scheduler.seconds() if queue_time is None \
+                else queue_time
         self.start_time = None
         self.stop_time = None
         self.timer = None
+        self.trace = None
+        self.sequence = None
         self.on_stop = None
         self.on_finished = None
+        self.on_cancelled = None
+        self.on_duration_changed = None
 
     def for_json(self):
         return {
@@ -65,79 +86,283 @@ class SprinklerJob(object):
             'sprinkler_id': self.sprinkler_id,
             'duration': self.duration,
             'high_priority': self.high_priority,
+            'priority': self.priority,
+            'effective_priority': self.effective_priority,
             'start_time': self.start_time,
             'remaining_time': self.remaining_time,
             'stop_time': self.stop_time,
             'status': self.status,
+            'sequence_id': self.sequence.sequence_id \
+                    if self.sequence is not None else None,
         }
 
+    @property
+    def high_priority(self):
+        return self.priority > 0
+
+    @property
+    def effective_priority(self):
+        """The priority plus `aging_rate` for every second the job waited
+        before it was started."""
+        end_time = self.start_time
+        if end_time is None:
+            end_time = self._scheduler.seconds()
+        return self.priority \
+                + self.aging_rate * max(0, end_time - self.queue_time)
+
     @property
     def remaining_time(self):
         if self.status != self.JOB_ACTIVE:
             return None
-        return (self.start_time + self.duration) - time.time()
+        return (self.start_time + self.duration) - self._scheduler.seconds()
 
     def _get_duration(self):
         return self._duration
 
     def _set_duration(self, duration):
         self._duration = duration
+        self.on_duration_changed()
         if self.timer is not None:
-            self.timer.cancel()
             remaining_time = self.remaining_time
             if remaining_time > 0:
-                self._start_timer_with_duration(self.remaining_time)
+                self.timer.reschedule(remaining_time)
             else:
+                self.timer.cancel()
                 self._on_finished()
 
     duration = property(_get_duration, _set_duration)
 
-    def start(self):
+    def start(self, start_time=None):
+        """Starts the job.  A job that was already started before (e.g. prior
+        to a restart) may pass its original start time and only runs for
+        the remainder of its duration."""
         print('starting job {}'.format(self.job_id))
-        self.start_time = time.time()
+        now = self._scheduler.seconds()
+        if start_time is None:
+            start_time = now
+            JOB_WAIT_TIME.observe(now - self.queue_time)
+        self.start_time = start_time
         self.status = self.JOB_ACTIVE
-        self._start_timer_with_duration(self.duration)
+        self._start_timer_with_duration(self.start_time + self.duration - now)
 
     def _start_timer_with_duration(self, duration):
-        self.timer = defer_later(self._clock, duration,
-                lambda _: self._on_finished(), self)
+        self.timer = self._scheduler.call_later(duration, self._on_finished)
 
     def _on_finished(self):
         self.status = self.JOB_FINISHED
-        self.stop_time = time.time()
+        self.stop_time = self._scheduler.seconds()
         self.timer = None
 
         self.on_finished()
         self.on_stop()
 
     def cancel(self):
+        was_started = self.status == self.JOB_ACTIVE
         self.status = self.JOB_CANCELLED
-        self.stop_time = time.time()
-        self.timer.cancel()
-        self.timer = None
+        self.stop_time = self._scheduler.seconds()
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+        self.on_cancelled()
+        if was_started:
+            self.on_stop()
+
+
+class JobSequence(object):
+    """Jobs that run one after the other.  The next job is queued when
+    the current one ends, or `overlap` seconds earlier, so that its valve
+    opens before the previous one closes and the line stays pressurised.
+
+    The job ids of all jobs are assigned up front, so that a job that is
+    queued later still ranks by the arrival of the sequence.
+    """
+    def __init__(self, jobs, overlap):
+        self.sequence_id = jobs[0].job_id
+        self.pending_jobs = deque(jobs)
+        self.overlap = overlap
+        self.current_job = None
+        self.previous_job = None
+        self.handover_timer = None
+
+    def iter_live_jobs(self, jobs):
+        """Yields the jobs that were queued and are still waiting or active
+        in `jobs`, a JobRegistry."""
+        for job in (self.previous_job, self.current_job):
+            if job is not None and jobs.get_job(job.job_id) is job:
+                yield job
+
+    def for_json(self):
+        return {
+            'sequence_id': self.sequence_id,
+            'overlap': self.overlap,
+            'current_job_id': self.current_job.job_id \
+                    if self.current_job is not None else None,
+            'pending_jobs': [job.for_json() for job in self.pending_jobs],
+        }
 
-        self.on_stop()
 
+class JobCounters(object):
+    """Numbers of waiting and active jobs in total and per priority,
+    maintained as jobs are added and removed."""
+    def __init__(self):
+        self._num_waiting = {}
+        self._num_active = {}
+
+    def num_waiting(self, priority=None):
+        return self._count(self._num_waiting, priority)
+
+    def num_active(self, priority=None):
+        return self._count(self._num_active, priority)
+
+    def num_active_up_to(self, priority):
+        """Returns the number of active jobs with at most `priority`."""
+        return sum(num_jobs for job_priority, num_jobs \
+                in self._num_active.items() if job_priority <= priority)
+
+    def iter_counts(self):
+        """Yields (state, priority, number of jobs) tuples."""
+        for state, counts in (('waiting', self._num_waiting),
+                ('active', self._num_active)):
+            for priority, num_jobs in counts.items():
+                yield state, priority, num_jobs
+
+    def count_waiting_job(self, job, delta):
+        self._num_waiting[job.priority] = \
+                self._num_waiting.get(job.priority, 0) + delta
+
+    def count_active_job(self, job, delta):
+        self._num_active[job.priority] = \
+                self._num_active.get(job.priority, 0) + delta
+
+    @staticmethod
+    def _count(counts, priority):
+        if priority is None:
+            return sum(counts.values())
+        return counts.get(priority, 0)
+
+
+class AbstractBaseJobPolicy(object):
+    """Base class of the admission policies of a SprinklerJobQueue.
+
+    Whenever a job might be started, the queue asks is_job_runnable()
+    about the next waiting job.  Rather than lists of jobs, policies get
+    the JobCounters of the queue, so that admission does not depend on
+    the number of jobs.  Policies that need to track more than that can
+    do so in on_job_started() and on_job_stopped(), which are called when
+    a job becomes active (before its sprinkler was turned on) and when it
+    is no longer active.
+
+    If the next waiting job cannot be started, select_backfill_job() may
+    pick a job from further back in the queue to start ahead of it.  Jobs
+    whose sprinkler is already in use are never started.
+    """
+    def is_job_runnable(self, job, counters):
+        raise NotImplementedError()
+
+    def select_backfill_job(self, blocked_job, waiting_jobs, counters):
+        """Returns one of `waiting_jobs`, an iterator over the waiting
+        jobs behind `blocked_job` in queue order, to be started ahead of
+        `blocked_job`, or None."""
+        return None
 
-class MaxActiveSprinklerJobPolicy(object):
+    def on_job_started(self, job):
+        pass
+
+    def on_job_stopped(self, job):
+        pass
+
+
+class MaxActiveSprinklerJobPolicy(AbstractBaseJobPolicy):
     def __init__(self, max_total, max_low_priority):
         self._max_total = max_total
         self._max_low_priority = max_low_priority
 
-    def is_job_runnable(self, job, waiting_jobs, active_jobs):
-        if self._max_total <= len(active_jobs):
+    def is_job_runnable(self, job, counters):
+        if self._max_total <= counters.num_active():
             return False
         if job.high_priority:
             return True
+        return self._max_low_priority > counters.num_active_up_to(0)
+
+
+class FlowBudgetJobPolicy(AbstractBaseJobPolicy):
+    """Admits jobs as long as the flow rates of the sprinklers of all
+    active jobs fit into the flow capacity of the site, e.g. of its pump
+    and its mainline.  Sprinklers without a flow rate use the whole
+    capacity, as does a job that exceeds it on its own.
+
+    A job that does not fit gets a reservation for the time at which
+    enough flow will be free (EASY backfilling): jobs further back in the
+    queue are started ahead of it if they fit into the flow that is free
+    now and either end before that time or only use flow the blocked job
+    will not need then.
+    """
+    BACKFILL_DEPTH = 100
+
+    def __init__(self, flow_rates, capacity, backfill_depth=BACKFILL_DEPTH):
+        self._flow_rates = flow_rates
+        self._capacity = capacity
+        self._backfill_depth = backfill_depth
+        self._active_jobs = {}
+        self._flow_in_use = 0
+
+    def _get_flow_rate(self, job):
+        flow_rate = self._flow_rates.get(job.sprinkler_id)
+        if flow_rate is None:
+            return self._capacity
+        return min(flow_rate, self._capacity)
+
+    def is_job_runnable(self, job, counters):
+        return self._flow_in_use + self._get_flow_rate(job) <= self._capacity
+
+    def select_backfill_job(self, blocked_job, waiting_jobs, counters):
+        shadow_time, extra_flow = self._get_reservation(blocked_job)
+        free_flow = self._capacity - self._flow_in_use
+        for job in itertools.islice(waiting_jobs, self._backfill_depth):
+            flow_rate = self._get_flow_rate(job)
+            if flow_rate > free_flow:
+                continue
+            if job.duration <= shadow_time or flow_rate <= extra_flow:
+                return job
+        return None
+
+    def _get_reservation(self, blocked_job):
+        """Returns the time until enough flow for `blocked_job` will be
+        free and the flow that will be left over at that time."""
+        free_flow = self._capacity - self._flow_in_use
+        needed_flow = self._get_flow_rate(blocked_job)
+        shadow_time = 0
+        for remaining_time, flow_rate in sorted(
+                (self._get_remaining_time(job), flow_rate) \
+                for job, flow_rate in self._active_jobs.values()):
+            if free_flow >= needed_flow:
+                break
+            free_flow += flow_rate
+            shadow_time = remaining_time
+        return shadow_time, free_flow - needed_flow
+
+    @staticmethod
+    def _get_remaining_time(job):
+        # Jobs whose sprinkler is still being turned on have not started.
+        if job.remaining_time is None:
+            return job.duration
+        return job.remaining_time
 
-        num_jobs_low_priority = len([job for job in active_jobs \
-                if not job.high_priority])
-        return self._max_low_priority > num_jobs_low_priority
+    def on_job_started(self, job):
+        # The flow rates may change while the job is active.
+        flow_rate = self._get_flow_rate(job)
+        self._active_jobs[job.job_id] = (job, flow_rate)
+        self._flow_in_use += flow_rate
+
+    def on_job_stopped(self, job):
+        _, flow_rate = self._active_jobs.pop(job.job_id)
+        self._flow_in_use -= flow_rate
 
 
 class JobQueue(object):
     def __init__(self):
-        self._queue = Queue()
+        self._queue = Queue(lambda job: job.job_id)
 
     def push(self, job):
         self._queue.push(job)
@@ -145,6 +370,9 @@ class JobQueue(object):
     def is_empty(self):
         return self._queue.is_empty()
 
+    def __len__(self):
+        return len(self._queue)
+
     def peek(self):
         return self._queue.peek()
 
@@ -152,7 +380,7 @@ class JobQueue(object):
         return self._queue.pop()
 
     def remove(self, job_id):
-        job = self._queue.remove(lambda job: job.job_id == job_id)
+        job = self._queue.remove(job_id)
         if job is None:
             raise ValueError('job with id {} not found'.format(job_id))
         return job
@@ -164,163 +392,756 @@ class JobQueue(object):
         return self.get(job_id) is not None
 
     def get(self, job_id):
-        return self._queue.find(lambda job: job.job_id == job_id)
+        return self._queue.find(job_id)
 
 
 class PriorityJobQueue(object):
-    def __init__(self):
-        self._queues = []
-
-    def _get_queue_for(self, job):
-        priority = 1 if job.high_priority else 0
-
-        last_position = 0
-        for queue_priority, queue in self._queues:
-            if queue_priority == priority:
-                return queue
-            if queue_priority < priority:
-                break
-            last_position += 1
-
-        new_queue = JobQueue()
-        self._queues.insert(last_position, (priority, new_queue))
-        return new_queue
+    """Jobs ordered by their effective priority, highest first, and by
+    their job id, i.e. their arrival, within the same effective priority.
+
+    All waiting jobs age at the same rate, so their order does not change
+    while they wait and they are kept in a LazyHeap keyed by
+    aging_rate * queue_time - priority.
+    """
+    def __init__(self, aging_rate=0):
+        self._aging_rate = aging_rate
+        self._heap = LazyHeap()
+        self._entry_for_job_id = {}
 
     def push(self, job):
-        self._get_queue_for(job).push(job)
-
-    def _get_first_nonempty_queue(self, default=JobQueue()):
-        for _, queue in self._queues:
-            if not queue.is_empty():
-                return queue
-        return default
+        entry = [self._aging_rate * job.queue_time - job.priority,
+                job.job_id, job]
+        self._heap.push(entry)
+        self._entry_for_job_id[job.job_id] = entry
 
     def is_empty(self):
-        return self._get_first_nonempty_queue().is_empty()
+        return len(self._entry_for_job_id) == 0
+
+    def __len__(self):
+        return len(self._entry_for_job_id)
 
     def peek(self):
-        return self._get_first_nonempty_queue().peek()
+        return self._heap.peek()[2]
 
     def pop(self):
-        return self._get_first_nonempty_queue().pop()
+        job = self._heap.pop()[2]
+        del self._entry_for_job_id[job.job_id]
+        return job
 
     def remove(self, job_id):
-        for _, queue in self._queues:
-            job = queue.remove(job_id)
-            if job is not None:
-                return job
-        raise ValueError('job with id {} not found'.format(job_id))
+        entry = self._entry_for_job_id.pop(job_id, None)
+        if entry is None:
+            raise ValueError('job with id {} not found'.format(job_id))
+        return self._heap.remove(entry)
 
     def list_all(self):
-        return reduce(lambda jobs, queue: jobs + queue[1].list_all(),
-                self._queues, [])
+        return self._heap.list_items()
+
+    def iter_jobs(self, copy=False):
+        """Yields the jobs in order, taking O(log n) per job, see
+        LazyHeap.iter_items()."""
+        return self._heap.iter_items(copy)
 
     def __contains__(self, job_id):
-        for _, queue in self._queues:
-            if job_id in queue:
-                return True
-        return False
+        return job_id in self._entry_for_job_id
 
     def get(self, job_id):
-        for _, queue in self._queues:
-            job = queue.get(job_id)
-            if job is not None:
-                return job
+        entry = self._entry_for_job_id.get(job_id)
+        if entry is None:
+            return None
+        return entry[2]
+
+
+class JobRegistry(object):
+    """Keeps track of the waiting and the active jobs.
+
+    Jobs are indexed by their job id and by their sprinkler id, so that
+    looking up, removing and dequeueing a job and finding the job of a
+    specific sprinkler do not depend on the number of queued jobs.
+    """
+    def __init__(self, aging_rate=0):
+        self._aging_rate = aging_rate
+        self._waiting_jobs = PriorityJobQueue(aging_rate)
+        self._active_jobs = JobQueue()
+        self._waiting_jobs_by_sprinkler = {}
+        self._active_jobs_by_sprinkler = {}
+        self._waiting_sprinkler_ids = SortedIds()
+        self._active_sprinkler_ids = SortedIds()
+        # The ids of the jobs in ascending order, which is the order in
+        # which they are handed out.  The ids of jobs that ended are purged
+        # once they make up half of the list.
+        self._job_ids = []
+        self.counters = JobCounters()
+
+    def add_waiting_job(self, job):
+        self._waiting_jobs.push(job)
+        self._index_job_id(job.job_id)
+        self.counters.count_waiting_job(job, 1)
+        self._index_job(self._waiting_jobs_by_sprinkler,
+                self._waiting_sprinkler_ids, job,
+                lambda: PriorityJobQueue(self._aging_rate))
+
+    def has_waiting_jobs(self):
+        return not self._waiting_jobs.is_empty()
+
+    def peek_waiting_job(self):
+        return self._waiting_jobs.peek()
+
+    def pop_waiting_job(self):
+        job = self._waiting_jobs.pop()
+        self._purge_job_ids()
+        self.counters.count_waiting_job(job, -1)
+        self._unindex_job(self._waiting_jobs_by_sprinkler,
+                self._waiting_sprinkler_ids, job)
+        return job
+
+    def remove_waiting_job(self, job_id):
+        job = self._waiting_jobs.remove(job_id)
+        self._purge_job_ids()
+        self.counters.count_waiting_job(job, -1)
+        self._unindex_job(self._waiting_jobs_by_sprinkler,
+                self._waiting_sprinkler_ids, job)
+        return job
+
+    def get_waiting_job(self, job_id):
+        return self._waiting_jobs.get(job_id)
+
+    def is_job_waiting(self, job_id):
+        return job_id in self._waiting_jobs
+
+    def list_waiting_jobs(self):
+        return self._waiting_jobs.list_all()
+
+    def iter_waiting_jobs(self, copy=False):
+        return self._waiting_jobs.iter_jobs(copy)
+
+    def add_active_job(self, job):
+        self._active_jobs.push(job)
+        self._index_job_id(job.job_id)
+        self.counters.count_active_job(job, 1)
+        self._index_job(self._active_jobs_by_sprinkler,
+                self._active_sprinkler_ids, job, JobQueue)
+
+    def remove_active_job(self, job_id):
+        job = self._active_jobs.remove(job_id)
+        self._purge_job_ids()
+        self.counters.count_active_job(job, -1)
+        self._unindex_job(self._active_jobs_by_sprinkler,
+                self._active_sprinkler_ids, job)
+        return job
+
+    def get_active_job(self, job_id):
+        return self._active_jobs.get(job_id)
+
+    def is_job_active(self, job_id):
+        return job_id in self._active_jobs
+
+    def is_sprinkler_active(self, sprinkler_id):
+        return sprinkler_id in self._active_jobs_by_sprinkler
+
+    def list_active_jobs(self):
+        return self._active_jobs.list_all()
+
+    def get_job(self, job_id):
+        job = self._active_jobs.get(job_id)
+        if job is not None:
+            return job
+        return self._waiting_jobs.get(job_id)
+
+    def count_jobs_by_priority(self):
+        """Returns ((state, priority), number of jobs) pairs."""
+        return [((state, priority), num_jobs) for state, priority, num_jobs \
+                in self.counters.iter_counts()]
+
+    def list_jobs_for_sprinkler(self, sprinkler_id):
+        """Returns the active and the waiting jobs of the sprinkler."""
+        jobs = []
+        for jobs_by_sprinkler in (self._active_jobs_by_sprinkler,
+                self._waiting_jobs_by_sprinkler):
+            if sprinkler_id in jobs_by_sprinkler:
+                jobs.extend(jobs_by_sprinkler[sprinkler_id].list_all())
+        return jobs
+
+    def get_job_for_sprinkler(self, sprinkler_id):
+        """Returns the job that determines the state of the sprinkler:
+        its active job if there is one, otherwise its next waiting job.
+        """
+        for jobs_by_sprinkler in (self._active_jobs_by_sprinkler,
+                self._waiting_jobs_by_sprinkler):
+            jobs = jobs_by_sprinkler.get(sprinkler_id)
+            if jobs is not None:
+                return jobs.peek()
+        return None
+
+    def _index_job_id(self, job_id):
+        if not self._job_ids or job_id > self._job_ids[-1]:
+            self._job_ids.append(job_id)
+            return
+        # A job that is queued again or restored.
+        idx = bisect_left(self._job_ids, job_id)
+        if idx == len(self._job_ids) or self._job_ids[idx] != job_id:
+            self._job_ids.insert(idx, job_id)
+
+    def _purge_job_ids(self):
+        if len(self._job_ids) > 2 * (len(self._waiting_jobs) \
+                + len(self._active_jobs)):
+            self._job_ids = [job_id for job_id in self._job_ids \
+                    if job_id in self._waiting_jobs \
+                    or job_id in self._active_jobs]
+
+    def iter_active_job_ids(self, after=None):
+        """Yields the ids of the active jobs greater than `after` in
+        sorted order.  There are only as many active jobs as valves may be
+        open at once, so they are sorted on every call."""
+        return iter(sorted(job.job_id \
+                for job in self._active_jobs.list_all() \
+                if after is None or job.job_id > after))
+
+    def iter_waiting_job_ids(self, after=None):
+        """Yields the ids of the waiting jobs greater than `after` in
+        sorted order.  Jobs may be added and removed while iterating, the
+        jobs removed meanwhile are left out."""
+        job_ids = self._job_ids
+        idx = 0 if after is None else bisect_right(job_ids, after)
+        for job_id in itertools.islice(job_ids, idx, None):
+            if job_id in self._waiting_jobs:
+                yield job_id
+
+    def iter_active_sprinkler_ids(self, after=None, prefix=''):
+        """Yields the ids of the sprinklers with active jobs in sorted
+        order, see SortedIds.iter_range()."""
+        return self._active_sprinkler_ids.iter_range(after, prefix)
+
+    def iter_waiting_sprinkler_ids(self, after=None, prefix=''):
+        """Yields the ids of the sprinklers with waiting jobs in sorted
+        order, see SortedIds.iter_range()."""
+        return self._waiting_sprinkler_ids.iter_range(after, prefix)
+
+    def _index_job(self, jobs_by_sprinkler, sprinkler_ids, job,
+            queue_factory):
+        jobs = jobs_by_sprinkler.get(job.sprinkler_id)
+        if jobs is None:
+            jobs = jobs_by_sprinkler[job.sprinkler_id] = queue_factory()
+            sprinkler_ids.add(job.sprinkler_id)
+        jobs.push(job)
+
+    def _unindex_job(self, jobs_by_sprinkler, sprinkler_ids, job):
+        jobs = jobs_by_sprinkler[job.sprinkler_id]
+        jobs.remove(job.job_id)
+        if jobs.is_empty():
+            del jobs_by_sprinkler[job.sprinkler_id]
+            sprinkler_ids.remove(job.sprinkler_id)
+
 
 class SprinklerJobQueue(object):
-    def __init__(self, clock, sprinkler_ctrl, queue_policy):
+    JOB_QUEUED = 'queued'
+    JOB_STARTED = 'started'
+    JOB_DURATION_CHANGED = 'duration_changed'
+    JOB_FINISHED = 'finished'
+    JOB_CANCELLED = 'cancelled'
+
+    def __init__(self, clock, sprinkler_ctrl, queue_policy, scheduler=None,
+            aging_rate=0, job_id_step=1, job_id_offset=0):
+        """Waiting jobs gain `aging_rate` priority levels per second, so
+        that jobs of low priority are not starved.  Only job ids j with
+        j % job_id_step == job_id_offset are handed out, so that the shards
+        of a federation do not share job ids."""
         self._clock = clock
+        if scheduler is None:
+            scheduler = TimerScheduler(clock)
+        self._scheduler = scheduler
         self._sprinkler_ctrl = sprinkler_ctrl
         self._queue_policy = queue_policy
         self._last_job_id = 0
-        self._waiting_jobs = PriorityJobQueue()
-        self._active_jobs = JobQueue()
-
-    def add(self, sprinkler_id, duration, high_priority=False):
+        self._job_id_step = job_id_step
+        self._job_id_offset = job_id_offset
+        self._aging_rate = aging_rate
+        self._jobs = JobRegistry(aging_rate)
+        self._sequences = {}
+        self._listeners = []
+        self._pending_events = []
+        self._batch_turn_offs = None
+        self._attempting_next_job = False
+        QUEUED_JOBS.set_function(self._jobs.count_jobs_by_priority)
+
+    def add_listener(self, listener):
+        """Registers `listener(events)` to be called whenever jobs are
+        queued, started, finished or cancelled or their duration changes.
+        `events` is a list of (event, job) pairs; the changes of a batch
+        operation are reported with a single call."""
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        self._listeners.remove(listener)
+
+    def _notify(self, event, job):
+        self._pending_events.append((event, job))
+        if self._batch_turn_offs is None:
+            self._flush_events()
+
+    def _flush_events(self):
+        events, self._pending_events = self._pending_events, []
+        if not events:
+            return
+        for listener in list(self._listeners):
+            listener(events)
+
+    @contextmanager
+    def _batch(self):
+        """Holds back notifications and admission of waiting jobs until
+        the end of the batch, so that they happen once for all of its
+        changes."""
+        self._batch_turn_offs = []
+        try:
+            yield
+        finally:
+            turn_offs, self._batch_turn_offs = self._batch_turn_offs, None
+            self._flush_events()
+            d = defer.DeferredList(turn_offs)
+            d.addCallback(lambda _: self._attempt_next_job())
+
+    def _validate_job(self, sprinkler_id, duration):
         if not self._sprinkler_ctrl.is_valid(sprinkler_id):
             raise RuntimeError('Invalid sprinkler id {}'.format(sprinkler_id))
         if duration is None or duration <= 0:
             raise RuntimeError('Invalid duration "{}", ' \
                     'needs to be greater than 0'.format(duration))
 
-        job_id = self._get_next_job_id()
-        job = SprinklerJob(self._clock, job_id, sprinkler_id, duration,
-                high_priority)
+    @staticmethod
+    def _get_priority(priority):
+        try:
+            return int(priority)
+        except (TypeError, ValueError):
+            raise RuntimeError('Invalid priority "{}", needs to be an ' \
+                    'integer'.format(priority))
+
+    def add(self, sprinkler_id, duration, high_priority=False, priority=None):
+        """Queues a job.  Its priority defaults to 1 for jobs of high
+        priority and to 0 otherwise."""
+        if priority is None:
+            priority = 1 if high_priority else 0
+        self._validate_job(sprinkler_id, duration)
+        job = self._queue_job(sprinkler_id, duration,
+                self._get_priority(priority),
+                TRACER.start_trace('add'))
+        self._attempt_next_job()
+        return job
+
+    def add_jobs(self, jobs):
+        """Queues (sprinkler_id, duration, priority) jobs.  Either all of
+        them are valid and queued or none is."""
+        jobs = [(sprinkler_id, duration, self._get_priority(priority)) \
+                for sprinkler_id, duration, priority in jobs]
+        for sprinkler_id, duration, _ in jobs:
+            self._validate_job(sprinkler_id, duration)
+        with self._batch():
+            return [self._queue_job(sprinkler_id, duration, priority,
+                    TRACER.start_trace('add_jobs')) \
+                    for sprinkler_id, duration, priority in jobs]
+
+    def add_sequence(self, steps, priority=0, overlap=0):
+        """Queues (sprinkler_id, duration) steps to run one after the
+        other, each starting `overlap` seconds before the previous one
+        ends.  Returns the JobSequence.
+
+        Only the first job competes for admission with the other jobs; each
+        following one opens its valve while the previous valve is still
+        open, ahead of the waiting jobs, if the queue policy admits it
+        next to the active jobs, e.g. within the flow budget.  If the
+        policy or the interceptors of the sprinkler controller do not let
+        it start, the job waits for admission once the previous one has
+        ended.  Jobs of a sequence that were not queued yet are not kept
+        across restarts.
+        """
+        steps = list(steps)
+        if not steps:
+            raise RuntimeError('A sequence needs at least one step')
+        for sprinkler_id, duration in steps:
+            self._validate_job(sprinkler_id, duration)
+        if overlap is None or overlap < 0 \
+                or any(duration <= overlap for _, duration in steps):
+            raise RuntimeError('Invalid overlap "{}", needs to be at ' \
+                    'least 0 and shorter than every step'.format(overlap))
+        priority = self._get_priority(priority)
+        queue_time = self._scheduler.seconds()
+        jobs = [self._create_job(self._get_next_job_id(), sprinkler_id,
+                duration, priority, queue_time) \
+                for sprinkler_id, duration in steps]
+        sequence = JobSequence(jobs, overlap)
+        for job in jobs:
+            job.sequence = sequence
+        self._sequences[sequence.sequence_id] = sequence
+        self._queue_next_step(sequence)
+        self._attempt_next_job()
+        return sequence
+
+    def get_sequence(self, sequence_id):
+        return self._sequences.get(sequence_id)
+
+    def list_sequences(self):
+        return [self._sequences[sequence_id] \
+                for sequence_id in sorted(self._sequences)]
+
+    def _queue_next_step(self, sequence):
+        """Queues the next job of the sequence and returns it, or
+        returns None if there is none."""
+        if not sequence.pending_jobs:
+            return None
+        job = sequence.pending_jobs.popleft()
+        sequence.previous_job = sequence.current_job
+        sequence.current_job = job
+        job.trace = TRACER.start_trace('sequence')
+        if job.trace is not None:
+            job.trace.job_id = job.job_id
+            job.trace.stamp('queued')
+        self._jobs.add_waiting_job(job)
+        self._notify(self.JOB_QUEUED, job)
+        return job
+
+    def _on_step_ended(self, job):
+        sequence = job.sequence
+        if job is not sequence.current_job:
+            # Its successor was already queued during the overlap.
+            return
+        self._disarm_handover(sequence)
+        if self._queue_next_step(sequence) is None:
+            self._sequences.pop(sequence.sequence_id, None)
+
+    def _arm_handover(self, job):
+        sequence = job.sequence
+        if job is not sequence.current_job or not sequence.overlap \
+                or not sequence.pending_jobs:
+            return
+        delay = max(0, job.remaining_time - sequence.overlap)
+        if sequence.handover_timer is None:
+            sequence.handover_timer = self._scheduler.call_later(delay,
+                    self._hand_over, job)
+        else:
+            sequence.handover_timer.reschedule(delay)
+
+    def _disarm_handover(self, sequence):
+        if sequence.handover_timer is not None:
+            sequence.handover_timer.cancel()
+            sequence.handover_timer = None
+
+    def _hand_over(self, job):
+        """Turns on the sprinkler of the next job of the sequence while
+        that of `job` is still on."""
+        sequence = job.sequence
+        sequence.handover_timer = None
+        next_job = self._queue_next_step(sequence)
+        if not self._is_job_runnable(next_job):
+            # E.g. the same court again, or both valves together would
+            # exceed the flow budget.  Admitted once `job` has ended.
+            return
+        self._jobs.remove_waiting_job(next_job.job_id)
+        if next_job.trace is not None:
+            next_job.trace.stamp('handover')
+        self._activate_job(next_job, None, self._on_handover_failed)
+
+    def _on_handover_failed(self, job, start_time):
+        if job.status != job.JOB_CANCELLED:
+            self._remove_active_job(job.job_id)
+            self._jobs.add_waiting_job(job)
+        previous_job = job.sequence.previous_job
+        if previous_job is None \
+                or not self._jobs.is_job_active(previous_job.job_id):
+            self._attempt_next_job()
+
+    def _queue_job(self, sprinkler_id, duration, priority, trace):
+        job = self._create_job(self._get_next_job_id(), sprinkler_id,
+                duration, priority)
+        job.trace = trace
+        if job.trace is not None:
+            job.trace.job_id = job.job_id
+            job.trace.stamp('queued')
+        self._jobs.add_waiting_job(job)
+        self._notify(self.JOB_QUEUED, job)
+        return job
+
+    def _create_job(self, job_id, sprinkler_id, duration, priority,
+            queue_time=None):
+        job = SprinklerJob(self._scheduler, job_id, sprinkler_id, duration,
+                priority, self._aging_rate, queue_time)
         job.on_stop = lambda: self._turn_off(job)
         job.on_finished = lambda: self._on_end_of_duration(job)
-        self._waiting_jobs.push(job)
-        self._attempt_next_job()
+        job.on_cancelled = lambda: self._on_job_cancelled(job)
+        job.on_duration_changed = lambda: self._on_duration_changed(job)
         return job
 
+    def _on_job_cancelled(self, job):
+        self._notify(self.JOB_CANCELLED, job)
+        if job.sequence is not None:
+            self._on_step_ended(job)
+
+    def _on_duration_changed(self, job):
+        self._notify(self.JOB_DURATION_CHANGED, job)
+        if job.sequence is not None and job.status == job.JOB_ACTIVE:
+            self._arm_handover(job)
+
     def _get_next_job_id(self):
-        self._last_job_id += 1
+        job_id = self._last_job_id + 1
+        job_id += (self._job_id_offset - job_id) % self._job_id_step
+        self._last_job_id = job_id
+        return job_id
+
+    @property
+    def last_job_id(self):
         return self._last_job_id
 
+    def restore_jobs(self, last_job_id, job_states):
+        """Re-creates jobs recovered after a restart, keeping their job ids.
+
+        Jobs that were active are turned on again for the remainder of
+        their duration; those whose time ran out in the meantime are
+        dropped.  If an active job cannot be turned on again, it is queued
+        with its remaining duration.
+        """
+        self._last_job_id = max(self._last_job_id, last_job_id)
+        now = self._scheduler.seconds()
+        for job_state in job_states:
+            sprinkler_id = job_state['sprinkler_id']
+            if not self._sprinkler_ctrl.is_valid(sprinkler_id):
+                print('dropping job {} for unknown sprinkler {}'.format(
+                        job_state['job_id'], sprinkler_id))
+                continue
+            # Journals written before there were integer priorities only
+            # record high_priority.
+            priority = job_state.get('priority',
+                    1 if job_state['high_priority'] else 0)
+            job = self._create_job(job_state['job_id'], sprinkler_id,
+                    job_state['duration'], priority,
+                    job_state.get('queue_time'))
+            start_time = job_state['start_time']
+            if start_time is None:
+                self._jobs.add_waiting_job(job)
+                self._notify(self.JOB_QUEUED, job)
+            elif start_time + job.duration > now:
+                self._activate_job(job, start_time,
+                        self._on_reactivation_failed)
+        self._attempt_next_job()
+
+    def _on_reactivation_failed(self, job, start_time):
+        if job.status != job.JOB_CANCELLED:
+            self._remove_active_job(job.job_id)
+            job = self._create_job(job.job_id, job.sprinkler_id,
+                    start_time + job.duration - self._scheduler.seconds(),
+                    job.priority, job.queue_time)
+            self._jobs.add_waiting_job(job)
+            self._notify(self.JOB_QUEUED, job)
+        self._attempt_next_job()
+
     def remove_waiting_job(self, job_id):
-        return self._waiting_jobs.remove(job_id)
+        job = self._jobs.remove_waiting_job(job_id)
+        job.cancel()
+        if job.sequence is not None and self._batch_turn_offs is None:
+            # The next job of the sequence was queued.
+            self._attempt_next_job()
+        return job
 
     def list_waiting_jobs(self):
-        return self._waiting_jobs.list_all()
+        return self._jobs.list_waiting_jobs()
 
     def _attempt_next_job(self):
-        while not self._waiting_jobs.is_empty():
-            job = self._waiting_jobs.peek()
-            if not self._queue_policy.is_job_runnable(job,
-                    waiting_jobs=self.list_waiting_jobs(),
-                    active_jobs=self.list_active_jobs()):
-                break
-            self._waiting_jobs.pop()
-            try:
-                self._sprinkler_ctrl.turn_on(job.sprinkler_id)
-            except SprinklerException as e:
-                print('activating sprinkler failed: {}'.format(e))
-                self._attempt_next_job()
-                continue
-
-            job.start()
-            self._active_jobs.push(job)
+        # Turning a sprinkler on may complete (or fail) synchronously and
+        # call back into this method, the running loop takes care of that.
+        if self._attempting_next_job:
+            return
+        self._attempting_next_job = True
+        try:
+            while self._jobs.has_waiting_jobs():
+                job = self._jobs.peek_waiting_job()
+                if self._is_job_runnable(job):
+                    self._jobs.pop_waiting_job()
+                else:
+                    job = self._select_backfill_job(job)
+                    if job is None:
+                        break
+                    self._jobs.remove_waiting_job(job.job_id)
+                if job.trace is not None:
+                    job.trace.stamp('admitted')
+                self._activate_job(job, None, self._on_activation_failed)
+        finally:
+            self._attempting_next_job = False
+
+    def _is_job_runnable(self, job):
+        return not self._jobs.is_sprinkler_active(job.sprinkler_id) \
+                and self._queue_policy.is_job_runnable(job,
+                        self._jobs.counters)
+
+    def _select_backfill_job(self, blocked_job):
+        waiting_jobs = (job for job \
+                in itertools.islice(self._jobs.iter_waiting_jobs(), 1, None) \
+                if not self._jobs.is_sprinkler_active(job.sprinkler_id))
+        return self._queue_policy.select_backfill_job(blocked_job,
+                waiting_jobs, self._jobs.counters)
+
+    def _activate_job(self, job, start_time, on_failure):
+        """Turns the sprinkler of the job on and starts the job once that
+        succeeded.  Until then, the job already counts as active."""
+        self._add_active_job(job)
+        with TRACER.activate(job.trace):
+            d = self._sprinkler_ctrl.turn_on(job.sprinkler_id)
+        d.addCallbacks(self._on_job_activated, self._on_job_activation_failed,
+                callbackArgs=(job, start_time),
+                errbackArgs=(job, start_time, on_failure))
+
+    def _on_job_activated(self, _, job, start_time):
+        if job.status == job.JOB_CANCELLED:
+            # Cancelled while the sprinkler was being turned on.
+            self._turn_off(job)
+            return
+        job.start(start_time)
+        if job.trace is not None:
+            job.trace.stamp('started')
+            job.trace = None
+        self._notify(self.JOB_STARTED, job)
+        if job.sequence is not None:
+            self._arm_handover(job)
+
+    def _on_job_activation_failed(self, failure, job, start_time,
+            on_failure):
+        print('activating sprinkler failed: {}'.format(
+                failure.getErrorMessage()))
+        if job.trace is not None:
+            job.trace.stamp('failed')
+            job.trace = None
+        on_failure(job, start_time)
+
+    def _on_activation_failed(self, job, start_time):
+        if job.status != job.JOB_CANCELLED:
+            self._remove_active_job(job.job_id)
+            job.cancel()
+        self._attempt_next_job()
 
     def remove_active_job(self, job_id):
-        job = self._active_jobs.remove(job_id)
+        job = self._remove_active_job(job_id)
         job.cancel()
         return job
 
+    def _add_active_job(self, job):
+        self._jobs.add_active_job(job)
+        self._queue_policy.on_job_started(job)
+
+    def _remove_active_job(self, job_id):
+        job = self._jobs.remove_active_job(job_id)
+        self._queue_policy.on_job_stopped(job)
+        return job
+
     def _on_end_of_duration(self, job):
-        self._active_jobs.remove(job.job_id)
+        self._remove_active_job(job.job_id)
+        self._notify(self.JOB_FINISHED, job)
+        if job.sequence is not None:
+            self._on_step_ended(job)
 
     def _turn_off(self, job):
-        try:
-            self._sprinkler_ctrl.turn_off(job.sprinkler_id)
-        except SprinklerException as e:
-            print('deactivating sprinkler failed: {}'.format(e))
-        self._attempt_next_job()
+        d = self._sprinkler_ctrl.turn_off(job.sprinkler_id)
+        d.addErrback(lambda failure: print(
+                'deactivating sprinkler failed: {}'.format(
+                        failure.getErrorMessage())))
+        if self._batch_turn_offs is not None:
+            self._batch_turn_offs.append(d)
+        else:
+            d.addCallback(lambda _: self._attempt_next_job())
 
     def list_active_jobs(self):
-        return self._active_jobs.list_all()
+        return self._jobs.list_active_jobs()
 
     def is_job_active(self, job_id):
-        return job_id in self._active_jobs
+        return self._jobs.is_job_active(job_id)
 
     def is_job_waiting(self, job_id):
-        return job_id in self._waiting_jobs
+        return self._jobs.is_job_waiting(job_id)
 
     def get_waiting_job(self, job_id):
-        return self._waiting_jobs.get(job_id)
+        return self._jobs.get_waiting_job(job_id)
 
     def get_active_job(self, job_id):
-        return self._active_jobs.get(job_id)
+        return self._jobs.get_active_job(job_id)
 
     def get_job(self, job_id):
-        job = self.get_active_jobs(job_id)
-        if job is not None:
-            return job
-        return self.get_waiting_jobs(job_id)
+        return self._jobs.get_job(job_id)
+
+    def get_job_for_sprinkler(self, sprinkler_id):
+        return self._jobs.get_job_for_sprinkler(sprinkler_id)
+
+    def iter_active_jobs(self):
+        """Yields the jobs of list_active_jobs()."""
+        return iter(self._jobs.list_active_jobs())
+
+    def iter_waiting_jobs(self):
+        """Yields the jobs of list_waiting_jobs(), taking O(log n) per job.
+        Jobs may be added and removed while iterating, the jobs removed
+        meanwhile are left out."""
+        return self._jobs.iter_waiting_jobs(copy=True)
+
+    def iter_jobs(self):
+        """Yields the jobs of list_jobs(), see iter_waiting_jobs()."""
+        return itertools.chain(self.iter_active_jobs(),
+                self.iter_waiting_jobs())
+
+    def iter_active_job_ids(self, after=None):
+        return self._jobs.iter_active_job_ids(after)
+
+    def iter_waiting_job_ids(self, after=None):
+        return self._jobs.iter_waiting_job_ids(after)
+
+    def iter_active_sprinkler_ids(self, after=None, prefix=''):
+        return self._jobs.iter_active_sprinkler_ids(after, prefix)
+
+    def iter_waiting_sprinkler_ids(self, after=None, prefix=''):
+        return self._jobs.iter_waiting_sprinkler_ids(after, prefix)
 
     def list_jobs(self):
         return self.list_active_jobs() + self.list_waiting_jobs()
 
+    def remove_jobs(self, job_ids=(), sprinkler_ids=(), sequence_ids=()):
+        """Cancels the jobs with the given ids, all jobs of the given
+        sprinklers and the given sequences.  Either all ids are valid and
+        the jobs are cancelled or nothing is.  Returns the cancelled jobs.
+        """
+        sequences = OrderedDict()
+        for sequence_id in sequence_ids:
+            sequence = self._sequences.get(sequence_id)
+            if sequence is None:
+                raise RuntimeError('Invalid sequence id {}'.format(
+                        sequence_id))
+            sequences[sequence_id] = sequence
+        jobs = OrderedDict()
+        for job_id in job_ids:
+            job = self._jobs.get_job(job_id)
+            if job is None:
+                raise RuntimeError('Invalid job id {}'.format(job_id))
+            jobs[job_id] = job
+        for sprinkler_id in sprinkler_ids:
+            if not self._sprinkler_ctrl.is_valid(sprinkler_id):
+                raise RuntimeError('Invalid sprinkler id {}'.format(
+                        sprinkler_id))
+            for job in self._jobs.list_jobs_for_sprinkler(sprinkler_id):
+                jobs[job.job_id] = job
+        for sequence in sequences.values():
+            for job in sequence.iter_live_jobs(self._jobs):
+                jobs[job.job_id] = job
+        for sequence in sequences.values():
+            self._drop_sequence(sequence)
+        self._remove_jobs(jobs.values())
+        return list(jobs.values())
+
+    def _drop_sequence(self, sequence):
+        """Drops the jobs of the sequence that were not queued yet."""
+        sequence.pending_jobs.clear()
+        self._disarm_handover(sequence)
+        del self._sequences[sequence.sequence_id]
+
+    def _remove_jobs(self, jobs):
+        with self._batch():
+            for job in jobs:
+                if self._jobs.is_job_active(job.job_id):
+                    self.remove_active_job(job.job_id)
+                else:
+                    self.remove_waiting_job(job.job_id)
+
     def remove_all_jobs(self):
-        for job in self.list_waiting_jobs():
-            self.remove_waiting_job(job.job_id)
-        for job in self.list_active_jobs():
-            self.remove_active_job(job.job_id)
+        for sequence in list(self._sequences.values()):
+            self._drop_sequence(sequence)
+        self._remove_jobs(self.list_waiting_jobs() + self.list_active_jobs())
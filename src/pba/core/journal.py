@@ -0,0 +1,147 @@
+# vim:set ts=4 sw=4 et:
+from __future__ import (absolute_import, division, print_function,
+        unicode_literals)
+from collections import OrderedDict
+import json
+import logging
+import os
+
+log = logging.getLogger(__name__)
+
+
+def job_state_for_json(job):
+    return {
+        'job_id': job.job_id,
+        'sprinkler_id': job.sprinkler_id,
+        'duration': job.duration,
+        'high_priority': job.high_priority,
+        'priority': job.priority,
+        'queue_time': job.queue_time,
+        'start_time': job.start_time,
+    }
+
+
+class JobJournal(object):
+    """Append-only journal of job mutations, used to restore the waiting
+    and active jobs after a restart.
+
+    Every job event is appended as one JSON line.  Records are written and
+    fsync'ed in groups, at most `commit_delay` seconds after the first
+    record of a group.  Once more than `compaction_threshold` records were
+    written, the current jobs are written to a snapshot file and the
+    journal is truncated, so recovery only ever replays a bounded number
+    of records.
+    """
+    COMMIT_DELAY = 0.1
+    COMPACTION_THRESHOLD = 1000
+
+    def __init__(self, clock, path, commit_delay=COMMIT_DELAY,
+            compaction_threshold=COMPACTION_THRESHOLD):
+        self._clock = clock
+        self._path = path
+        self._snapshot_path = path + '.snapshot'
+        self._commit_delay = commit_delay
+        self._compaction_threshold = compaction_threshold
+        self._job_queue = None
+        self._fp = None
+        self._pending_records = []
+        self._commit_call = None
+        self._num_records = 0
+
+    def recover(self):
+        """Reads the snapshot and replays the journal.  Returns the last
+        assigned job id and the states of the waiting and active jobs,
+        ordered by job id."""
+        last_job_id = 0
+        jobs = OrderedDict()
+        if os.path.exists(self._snapshot_path):
+            with open(self._snapshot_path, 'rb') as fp:
+                snapshot = json.loads(fp.read().decode('utf-8'))
+            last_job_id = snapshot['last_job_id']
+            for job_state in snapshot['jobs']:
+                jobs[job_state['job_id']] = job_state
+
+        if os.path.exists(self._path):
+            with open(self._path, 'rb') as fp:
+                for line in fp:
+                    try:
+                        record = json.loads(line.decode('utf-8'))
+                    except ValueError:
+                        log.warning('ignoring torn record at the end of '
+                                'job journal {}'.format(self._path))
+                        break
+                    job_state = record['job']
+                    last_job_id = max(last_job_id, job_state['job_id'])
+                    if record['event'] in ('finished', 'cancelled'):
+                        jobs.pop(job_state['job_id'], None)
+                    else:
+                        jobs[job_state['job_id']] = job_state
+
+        return last_job_id, sorted(jobs.values(),
+                key=lambda job_state: job_state['job_id'])
+
+    def attach(self, job_queue):
+        """Starts journaling the events of `job_queue`, beginning with a
+        snapshot of its current jobs."""
+        self._job_queue = job_queue
+        self.compact()
+        self._job_queue.add_listener(self._on_job_events)
+
+    def close(self):
+        """Stops journaling and commits all pending records."""
+        if self._job_queue is not None:
+            self._job_queue.remove_listener(self._on_job_events)
+        self.commit()
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+
+    def _on_job_events(self, events):
+        for event, job in events:
+            self._pending_records.append(json.dumps({
+                'event': event,
+                'job': job_state_for_json(job),
+            }).encode('utf-8') + b'\n')
+        if self._commit_call is None:
+            self._commit_call = self._clock.callLater(self._commit_delay,
+                    self.commit)
+
+    def commit(self):
+        if self._commit_call is not None:
+            if self._commit_call.active():
+                self._commit_call.cancel()
+            self._commit_call = None
+        if not self._pending_records:
+            return
+
+        if self._fp is None:
+            self._fp = open(self._path, 'ab')
+        self._fp.write(b''.join(self._pending_records))
+        self._fp.flush()
+        os.fsync(self._fp.fileno())
+        self._num_records += len(self._pending_records)
+        self._pending_records = []
+
+        if self._num_records > self._compaction_threshold:
+            self.compact()
+
+    def compact(self):
+        """Replaces snapshot and journal by a snapshot of the current
+        jobs."""
+        self._pending_records = []
+        tmp_snapshot_path = self._snapshot_path + '.tmp'
+        with open(tmp_snapshot_path, 'wb') as fp:
+            fp.write(json.dumps({
+                'last_job_id': self._job_queue.last_job_id,
+                'jobs': [job_state_for_json(job) \
+                        for job in self._job_queue.list_jobs()],
+            }).encode('utf-8'))
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.rename(tmp_snapshot_path, self._snapshot_path)
+
+        if self._fp is not None:
+            self._fp.close()
+        self._fp = open(self._path, 'wb')
+        os.fsync(self._fp.fileno())
+        self._num_records = 0
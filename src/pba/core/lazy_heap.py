@@ -0,0 +1,70 @@
+# vim:set ts=4 sw=4 et:
+from __future__ import (absolute_import, division, print_function,
+        unicode_literals)
+import heapq
+
+
+class LazyHeap(object):
+    """Heap of entries that can be removed in constant time.
+
+    Entries are lists whose last element is the item, preceded by its sort
+    keys, which need to be unique.  Removed entries stay in the heap with
+    their item set to None and are skipped when they reach the top of the
+    heap and purged once they make up half of the heap.
+    """
+    def __init__(self):
+        self._heap = []
+        self._num_stale_entries = 0
+
+    def __len__(self):
+        return len(self._heap) - self._num_stale_entries
+
+    def push(self, entry):
+        heapq.heappush(self._heap, entry)
+
+    def remove(self, entry):
+        """Marks `entry` as removed.  Returns its item."""
+        item = entry[-1]
+        entry[-1] = None
+        self._num_stale_entries += 1
+        if self._num_stale_entries > len(self._heap) // 2:
+            self._heap = [entry for entry in self._heap \
+                    if entry[-1] is not None]
+            heapq.heapify(self._heap)
+            self._num_stale_entries = 0
+        return item
+
+    def peek(self):
+        """Returns the first entry, or None if the heap is empty."""
+        while self._heap and self._heap[0][-1] is None:
+            heapq.heappop(self._heap)
+            self._num_stale_entries -= 1
+        if not self._heap:
+            return None
+        return self._heap[0]
+
+    def pop(self):
+        """Removes and returns the first entry, or returns None if the heap
+        is empty."""
+        if self.peek() is None:
+            return None
+        return heapq.heappop(self._heap)
+
+    def list_items(self):
+        return [entry[-1] for entry in sorted(self._heap) \
+                if entry[-1] is not None]
+
+    def iter_items(self, copy=False):
+        """Yields the items in order, taking O(log n) per item.  The heap
+        must not be modified while iterating, unless `copy` is true, which
+        iterates over a shallow copy of the heap instead and leaves out the
+        items removed meanwhile."""
+        heap = list(self._heap) if copy else self._heap
+        candidates = [(heap[0], 0)] if heap else []
+        while candidates:
+            entry, idx = heapq.heappop(candidates)
+            if entry[-1] is not None:
+                yield entry[-1]
+            for child_idx in (2 * idx + 1, 2 * idx + 2):
+                if child_idx < len(heap):
+                    heapq.heappush(candidates, (heap[child_idx], child_idx))
@@ -0,0 +1,187 @@
+# vim:set ts=4 sw=4 et:
+"""Minimal metrics in the Prometheus text exposition format.
+
+Metrics are cheap enough to stay enabled in production: labelled children
+are created once and cached, and histograms count observations in
+preallocated fixed buckets.  Hot paths should keep a reference to the
+child they update instead of looking it up for every event.
+"""
+from __future__ import (absolute_import, division, print_function,
+        unicode_literals)
+from bisect import bisect_left
+import threading
+
+DEFAULT_LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+        0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+def format_labels(label_names, label_values, extra_labels=()):
+    labels = list(zip(label_names, label_values)) + list(extra_labels)
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, '{}'.format(value) \
+            .replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) \
+            for name, value in labels) + '}'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class _Metric(object):
+    metric_type = None
+
+    def __init__(self, name, description, label_names=()):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self._children = {}
+        if not self.label_names:
+            self._unlabelled = self.labels()
+
+    def labels(self, *label_values):
+        if len(label_values) != len(self.label_names):
+            raise ValueError('{} expects the labels {}'.format(self.name,
+                    ', '.join(self.label_names)))
+        child = self._children.get(label_values)
+        if child is None:
+            # Atomic, so that threads creating the same child share it.
+            child = self._children.setdefault(label_values,
+                    self._create_child())
+        return child
+
+    def expose(self):
+        lines = ['# HELP {} {}'.format(self.name, self.description),
+                '# TYPE {} {}'.format(self.name, self.metric_type)]
+        for label_values, child in sorted(self._children.items()):
+            lines.extend(self._expose_child(label_values, child))
+        return lines
+
+
+class _CounterChild(object):
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Counter(_Metric):
+    metric_type = 'counter'
+
+    def _create_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self._unlabelled.inc(amount)
+
+    def _expose_child(self, label_values, child):
+        yield '{}{} {}'.format(self.name,
+                format_labels(self.label_names, label_values),
+                format_value(child.value))
+
+
+class Gauge(_Metric):
+    """Gauge whose values are determined by a function when scraped.  The
+    function returns (label_values, value) pairs."""
+    metric_type = 'gauge'
+
+    def __init__(self, name, description, label_names=()):
+        _Metric.__init__(self, name, description, label_names)
+        self._function = lambda: []
+
+    def _create_child(self):
+        return None
+
+    def set_function(self, function):
+        self._function = function
+
+    def expose(self):
+        lines = ['# HELP {} {}'.format(self.name, self.description),
+                '# TYPE {} {}'.format(self.name, self.metric_type)]
+        for label_values, value in sorted(self._function()):
+            lines.append('{}{} {}'.format(self.name,
+                    format_labels(self.label_names, label_values),
+                    format_value(value)))
+        return lines
+
+
+class _HistogramChild(object):
+    """Histogram child that may be observed from several threads, e.g. the
+    GPIO workers."""
+    def __init__(self, buckets):
+        self._buckets = buckets
+        self._lock = threading.Lock()
+        self._counts = [0] * (len(buckets) + 1)
+        self._sum = 0.0
+
+    def observe(self, value):
+        idx = bisect_left(self._buckets, value)
+        with self._lock:
+            self._counts[idx] += 1
+            self._sum += value
+
+    def snapshot(self):
+        """Returns the bucket counts and the sum at a single point in
+        time."""
+        with self._lock:
+            return list(self._counts), self._sum
+
+
+class Histogram(_Metric):
+    metric_type = 'histogram'
+
+    def __init__(self, name, description, label_names=(),
+            buckets=DEFAULT_LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        _Metric.__init__(self, name, description, label_names)
+
+    def _create_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self._unlabelled.observe(value)
+
+    def _expose_child(self, label_values, child):
+        counts, sum_ = child.snapshot()
+        cumulative_count = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative_count += count
+            yield '{}_bucket{} {}'.format(self.name,
+                    format_labels(self.label_names, label_values,
+                            [('le', format_value(bound))]),
+                    cumulative_count)
+        labels = format_labels(self.label_names, label_values)
+        yield '{}_sum{} {}'.format(self.name, labels, format_value(sum_))
+        yield '{}_count{} {}'.format(self.name, labels, cumulative_count)
+
+
+class MetricsRegistry(object):
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, description, label_names=()):
+        return self.register(Counter(name, description, label_names))
+
+    def gauge(self, name, description, label_names=()):
+        return self.register(Gauge(name, description, label_names))
+
+    def histogram(self, name, description, label_names=(),
+            buckets=DEFAULT_LATENCY_BUCKETS):
+        return self.register(Histogram(name, description, label_names,
+                buckets))
+
+    def expose(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.expose())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = MetricsRegistry()
@@ -0,0 +1,307 @@
+# vim:set ts=4 sw=4 et:
+"""Recurring irrigation programs.
+
+A program queues jobs for one or more courts whenever its schedule fires.
+Each program has exactly one pending call in a TimerScheduler, whose heap
+keeps the upcoming fire times, so firing a program costs O(log n) in the
+number of programs and nothing is polled.
+"""
+from __future__ import (absolute_import, division, print_function,
+        unicode_literals)
+from datetime import datetime, timedelta
+import time
+
+
+class IntervalSchedule(object):
+    """Fires every `interval` seconds, counted from `start`."""
+    def __init__(self, interval, start=0):
+        if interval <= 0:
+            raise ValueError('interval needs to be greater than 0')
+        self.interval = interval
+        self.start = start
+
+    def next_fire_time(self, after):
+        if after < self.start:
+            return self.start
+        return self.start + ((after - self.start) // self.interval + 1) \
+                * self.interval
+
+    def for_json(self):
+        return {'interval': self.interval, 'start': self.start}
+
+
+class CronField(object):
+    def __init__(self, spec, minimum, maximum):
+        self.is_wildcard = spec == '*'
+        self.values = set()
+        for part in spec.split(','):
+            self.values.update(self._parse_part(part, minimum, maximum))
+
+    @staticmethod
+    def _parse_part(part, minimum, maximum):
+        step = 1
+        if '/' in part:
+            part, step = part.split('/', 1)
+            step = int(step)
+            if step <= 0:
+                raise ValueError('invalid step {}'.format(step))
+        if part == '*':
+            first, last = minimum, maximum
+        elif '-' in part:
+            first, last = [int(value) for value in part.split('-', 1)]
+        else:
+            first = last = int(part)
+        if first < minimum or last > maximum or first > last:
+            raise ValueError('{}-{} is out of range {}-{}'.format(first, last,
+                    minimum, maximum))
+        return range(first, last + 1, step)
+
+    def __contains__(self, value):
+        return value in self.values
+
+
+class CronSchedule(object):
+    """Fires at the local times matching a crontab(5) style expression of
+    minute, hour, day of month, month and day of week."""
+    MAX_SEARCH_DAYS = 5 * 366
+
+    def __init__(self, expression):
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError('cron expression "{}" needs 5 fields'.format(
+                    expression))
+        self.expression = expression
+        self._minutes = CronField(fields[0], 0, 59)
+        self._hours = CronField(fields[1], 0, 23)
+        self._days = CronField(fields[2], 1, 31)
+        self._months = CronField(fields[3], 1, 12)
+        # Both 0 and 7 are Sunday.
+        self._weekdays = CronField(fields[4], 0, 7)
+        if 7 in self._weekdays:
+            self._weekdays.values.add(0)
+
+    def next_fire_time(self, after):
+        moment = datetime.fromtimestamp(after).replace(second=0,
+                microsecond=0) + timedelta(minutes=1)
+        give_up = moment + timedelta(days=self.MAX_SEARCH_DAYS)
+        while moment < give_up:
+            if moment.month not in self._months:
+                moment = (moment.replace(day=1) + timedelta(days=32)) \
+                        .replace(day=1, hour=0, minute=0)
+            elif not self._is_matching_day(moment):
+                moment = (moment + timedelta(days=1)).replace(hour=0,
+                        minute=0)
+            elif moment.hour not in self._hours:
+                moment = (moment + timedelta(hours=1)).replace(minute=0)
+            elif moment.minute not in self._minutes:
+                moment += timedelta(minutes=1)
+            else:
+                return time.mktime(moment.timetuple())
+        raise ValueError('cron expression "{}" never fires'.format(
+                self.expression))
+
+    def _is_matching_day(self, moment):
+        day_matches = moment.day in self._days
+        # isoweekday() counts from Monday = 1 to Sunday = 7.
+        weekday_matches = moment.isoweekday() % 7 in self._weekdays
+        # Like cron, match either if both are restricted.
+        if not self._days.is_wildcard and not self._weekdays.is_wildcard:
+            return day_matches or weekday_matches
+        return day_matches and weekday_matches
+
+    def for_json(self):
+        return {'cron': self.expression}
+
+
+def schedule_from_json(schedule):
+    if 'cron' in schedule:
+        return CronSchedule(schedule['cron'])
+    if 'interval' in schedule:
+        return IntervalSchedule(schedule['interval'],
+                schedule.get('start', 0))
+    raise ValueError('schedule needs either "cron" or "interval"')
+
+
+class Program(object):
+    """Jobs for `sprinkler_ids` of `priority`, queued whenever `schedule`
+    fires.  With an `overlap`, they run as a sequence in the given order
+    instead of being queued all at once."""
+    def __init__(self, program_id, name, schedule, sprinkler_ids, duration,
+            priority=0, paused=False, overlap=None):
+        self.program_id = program_id
+        self.name = name
+        self.schedule = schedule
+        self.sprinkler_ids = sprinkler_ids
+        self.duration = duration
+        self.priority = priority
+        self.paused = paused
+        self.overlap = overlap
+        self.next_fire_time = None
+        self.last_fire_time = None
+        self.timer = None
+
+    def for_json(self):
+        return {
+            'program_id': self.program_id,
+            'name': self.name,
+            'schedule': self.schedule.for_json(),
+            'sprinkler_ids': self.sprinkler_ids,
+            'duration': self.duration,
+            'high_priority': self.high_priority,
+            'priority': self.priority,
+            'paused': self.paused,
+            'overlap': self.overlap,
+            'next_fire_time': self.next_fire_time,
+            'last_fire_time': self.last_fire_time,
+        }
+
+    @property
+    def high_priority(self):
+        return self.priority > 0
+
+
+class ProgramScheduler(object):
+    """Queues the jobs of the programs in `job_queue` whenever they fire."""
+    def __init__(self, scheduler, job_queue, sprinkler_ctrl):
+        self._scheduler = scheduler
+        self._job_queue = job_queue
+        self._sprinkler_ctrl = sprinkler_ctrl
+        self._programs = {}
+        self._last_program_id = 0
+        self._listeners = []
+
+    def add_listener(self, listener):
+        """Registers `listener()` to be called whenever programs are added,
+        changed or removed."""
+        self._listeners.append(listener)
+
+    def _notify(self):
+        for listener in list(self._listeners):
+            listener()
+
+    def add_program(self, name, schedule, sprinkler_ids, duration,
+            high_priority=False, paused=False, overlap=None, priority=None):
+        """Adds a program.  The priority of its jobs defaults to 1 for
+        programs of high priority and to 0 otherwise."""
+        if priority is None:
+            priority = 1 if high_priority else 0
+        return self._add_program(self._last_program_id + 1, name, schedule,
+                sprinkler_ids, duration, priority, paused, overlap)
+
+    def _add_program(self, program_id, name, schedule, sprinkler_ids,
+            duration, priority, paused, overlap):
+        if not sprinkler_ids:
+            raise RuntimeError('program needs at least one sprinkler')
+        for sprinkler_id in sprinkler_ids:
+            if not self._sprinkler_ctrl.is_valid(sprinkler_id):
+                raise RuntimeError('Invalid sprinkler id {}'.format(
+                        sprinkler_id))
+        if duration is None or duration <= 0:
+            raise RuntimeError('Invalid duration "{}", ' \
+                    'needs to be greater than 0'.format(duration))
+        if overlap is not None and not 0 <= overlap < duration:
+            raise RuntimeError('Invalid overlap "{}", needs to be at ' \
+                    'least 0 and shorter than the duration'.format(overlap))
+        try:
+            priority = int(priority)
+        except (TypeError, ValueError):
+            raise RuntimeError('Invalid priority "{}", needs to be an ' \
+                    'integer'.format(priority))
+
+        program = Program(program_id, name, schedule, list(sprinkler_ids),
+                duration, priority, paused, overlap)
+        self._last_program_id = max(self._last_program_id, program_id)
+        self._programs[program_id] = program
+        if not paused:
+            self._arm(program)
+        self._notify()
+        return program
+
+    def remove_program(self, program_id):
+        program = self._programs.pop(program_id)
+        self._disarm(program)
+        self._notify()
+        return program
+
+    def pause_program(self, program_id):
+        program = self._programs[program_id]
+        program.paused = True
+        self._disarm(program)
+        self._notify()
+        return program
+
+    def resume_program(self, program_id):
+        program = self._programs[program_id]
+        if program.paused:
+            program.paused = False
+            self._arm(program)
+            self._notify()
+        return program
+
+    def get_program(self, program_id):
+        return self._programs.get(program_id)
+
+    def list_programs(self):
+        return [self._programs[program_id] \
+                for program_id in sorted(self._programs)]
+
+    def _arm(self, program):
+        now = self._scheduler.seconds()
+        program.next_fire_time = program.schedule.next_fire_time(now)
+        program.timer = self._scheduler.call_later(
+                program.next_fire_time - now, self._fire, program)
+
+    def _disarm(self, program):
+        if program.timer is not None:
+            program.timer.cancel()
+            program.timer = None
+        program.next_fire_time = None
+
+    def _fire(self, program):
+        program.timer = None
+        program.last_fire_time = self._scheduler.seconds()
+        print('program {} ({}) fires'.format(program.program_id,
+                program.name))
+        try:
+            if program.overlap is None:
+                self._job_queue.add_jobs((sprinkler_id, program.duration,
+                        program.priority) \
+                        for sprinkler_id in program.sprinkler_ids)
+            else:
+                self._job_queue.add_sequence(((sprinkler_id,
+                        program.duration) \
+                        for sprinkler_id in program.sprinkler_ids),
+                        program.priority, program.overlap)
+        except RuntimeError as e:
+            print('queueing the jobs of program {} failed: {}'.format(
+                    program.program_id, e))
+        # Fire times that were missed, e.g. while the reactor was blocked,
+        # are skipped.
+        self._arm(program)
+
+    def snapshot(self):
+        """Returns all programs in a JSON serialisable form."""
+        return [dict((key, value) for key, value \
+                in program.for_json().items() \
+                if key not in ('next_fire_time', 'last_fire_time')) \
+                for program in self.list_programs()]
+
+    def restore(self, state):
+        """Adds the programs recorded by snapshot()."""
+        for program_state in state:
+            # Snapshots taken before there were integer priorities only
+            # record high_priority.
+            priority = program_state.get('priority',
+                    1 if program_state['high_priority'] else 0)
+            try:
+                self._add_program(program_state['program_id'],
+                        program_state['name'],
+                        schedule_from_json(program_state['schedule']),
+                        program_state['sprinkler_ids'],
+                        program_state['duration'],
+                        priority,
+                        program_state['paused'],
+                        program_state.get('overlap'))
+            except (RuntimeError, ValueError) as e:
+                print('dropping program {}: {}'.format(
+                        program_state['program_id'], e))
@@ -0,0 +1,106 @@
+# vim:set ts=4 sw=4 et:
+from __future__ import (absolute_import, division, print_function,
+        unicode_literals)
+import itertools
+from twisted.python import log
+from pba.core.lazy_heap import LazyHeap
+
+
+class ScheduledCall(object):
+    """Handle for a callback registered with a TimerScheduler."""
+    def __init__(self, scheduler, callback, args, kwargs):
+        self._scheduler = scheduler
+        self.callback = callback
+        self.args = args
+        self.kwargs = kwargs
+        self.deadline = None
+        self._entry = None
+
+    @property
+    def active(self):
+        return self._entry is not None
+
+    def cancel(self):
+        """Cancels the call.  Cancelling an inactive call is a no-op."""
+        self._scheduler._unschedule(self)
+
+    def reschedule(self, delay):
+        """Moves the deadline to `delay` seconds from now."""
+        self._scheduler._unschedule(self)
+        self._scheduler._schedule(self, self._scheduler.seconds() + delay)
+
+    def _fire(self):
+        self.callback(*self.args, **self.kwargs)
+
+
+class TimerScheduler(object):
+    """Keeps all deadlines in a single heap and only ever has one
+    clock.callLater() pending, for the earliest deadline.  Cancelled and
+    rescheduled calls are removed lazily, see LazyHeap.
+    """
+    def __init__(self, clock):
+        self._clock = clock
+        self._heap = LazyHeap()
+        self._sequence = itertools.count()
+        self._delayed_call = None
+        self._firing = False
+
+    def seconds(self):
+        return self._clock.seconds()
+
+    def call_later(self, delay, callback, *args, **kwargs):
+        call = ScheduledCall(self, callback, args, kwargs)
+        self._schedule(call, self.seconds() + delay)
+        return call
+
+    def __len__(self):
+        return len(self._heap)
+
+    def _schedule(self, call, deadline):
+        call.deadline = deadline
+        call._entry = [deadline, next(self._sequence), call]
+        self._heap.push(call._entry)
+        self._update_timer()
+
+    def _unschedule(self, call):
+        if call._entry is None:
+            return
+        self._heap.remove(call._entry)
+        call._entry = None
+        self._update_timer()
+
+    def _update_timer(self):
+        if self._firing:
+            return
+        entry = self._heap.peek()
+        if entry is None:
+            if self._delayed_call is not None:
+                self._delayed_call.cancel()
+                self._delayed_call = None
+            return
+
+        deadline = entry[0]
+        delay = max(0, deadline - self.seconds())
+        if self._delayed_call is None:
+            self._delayed_call = self._clock.callLater(delay, self._fire)
+        elif self._delayed_call.getTime() != deadline:
+            self._delayed_call.reset(delay)
+
+    def _fire(self):
+        self._delayed_call = None
+        self._firing = True
+        try:
+            now = self.seconds()
+            entry = self._heap.peek()
+            while entry is not None and entry[0] <= now:
+                call = self._heap.pop()[2]
+                call._entry = None
+                try:
+                    call._fire()
+                except:
+                    log.err(None, 'scheduled call {!r} failed'.format(
+                            call.callback))
+                entry = self._heap.peek()
+        finally:
+            self._firing = False
+        self._update_timer()
@@ -0,0 +1,73 @@
+# vim:set ts=4 sw=4 et:
+from __future__ import (absolute_import, division, print_function,
+        unicode_literals)
+from array import array
+
+
+class SlidingWindowSum(object):
+    """Running sum of the values recorded during the last `window` seconds.
+
+    Values are accumulated in a ring of fixed-size time slots, so memory is
+    bounded and both recording and querying take amortised constant time,
+    independent of how many values were recorded.  A slot is only dropped
+    once all of its values are older than the window, so the sum may
+    include values up to one slot length too old, but never misses any.
+    """
+    def __init__(self, window, num_slots=60):
+        self.window = window
+        self._slot_length = window / num_slots
+        self._slots = array(str('d'), [0.0] * (num_slots + 1))
+        self._newest_slot = None
+        self._total = 0.0
+
+    def add(self, timestamp, value):
+        self._advance(timestamp)
+        slot = self._slot_for(timestamp)
+        if slot <= self._newest_slot - len(self._slots):
+            return
+        self._slots[slot % len(self._slots)] += value
+        self._total += value
+
+    def total(self, now):
+        self._advance(now)
+        return max(0.0, self._total)
+
+    def _slot_for(self, timestamp):
+        return int(timestamp // self._slot_length)
+
+    def _advance(self, now):
+        slot = self._slot_for(now)
+        if self._newest_slot is None:
+            self._newest_slot = slot
+            return
+        if slot <= self._newest_slot:
+            return
+        num_slots = len(self._slots)
+        if slot - self._newest_slot >= num_slots:
+            self._clear()
+        else:
+            for expired_slot in range(self._newest_slot + 1, slot + 1):
+                idx = expired_slot % num_slots
+                self._total -= self._slots[idx]
+                self._slots[idx] = 0.0
+        self._newest_slot = slot
+
+    def _clear(self):
+        for idx in range(len(self._slots)):
+            self._slots[idx] = 0.0
+        self._total = 0.0
+
+    def snapshot(self):
+        return {
+            'window': self.window,
+            'newest_slot': self._newest_slot,
+            'slots': self._slots.tolist(),
+        }
+
+    def restore(self, state):
+        if state['window'] != self.window \
+                or len(state['slots']) != len(self._slots):
+            raise ValueError('incompatible sliding window state')
+        self._newest_slot = state['newest_slot']
+        self._slots = array(str('d'), state['slots'])
+        self._total = sum(self._slots)
@@ -0,0 +1,102 @@
+# vim:set ts=4 sw=4 et:
+from __future__ import (absolute_import, division, print_function,
+        unicode_literals)
+from bisect import bisect_left, bisect_right
+from itertools import takewhile
+
+
+class SortedIds(object):
+    """Sorted set of ids that supports range queries by cursor and prefix,
+    taking time proportional to the number of ids returned.
+
+    The ids are kept in sorted buckets of at most BUCKET_SIZE ids, so that
+    adding or removing an id bisects the bucket maxima and only shifts the
+    ids of one bucket, rather than all ids.
+    """
+    BUCKET_SIZE = 512
+
+    def __init__(self, ids=()):
+        ids = sorted(set(ids))
+        half = self.BUCKET_SIZE // 2
+        self._buckets = [ids[idx:idx + half] \
+                for idx in range(0, len(ids), half)]
+        self._maxes = [bucket[-1] for bucket in self._buckets]
+        self._len = len(ids)
+
+    def add(self, id_):
+        if not self._buckets:
+            self._buckets.append([id_])
+            self._maxes.append(id_)
+            self._len = 1
+            return
+        # Ids beyond the last maximum go into the last bucket.
+        bucket_idx = min(bisect_left(self._maxes, id_),
+                len(self._buckets) - 1)
+        bucket = self._buckets[bucket_idx]
+        idx = bisect_left(bucket, id_)
+        if idx < len(bucket) and bucket[idx] == id_:
+            return
+        bucket.insert(idx, id_)
+        self._maxes[bucket_idx] = bucket[-1]
+        self._len += 1
+        if len(bucket) > self.BUCKET_SIZE:
+            half = len(bucket) // 2
+            self._buckets.insert(bucket_idx + 1, bucket[half:])
+            self._maxes.insert(bucket_idx + 1, bucket[-1])
+            del bucket[half:]
+            self._maxes[bucket_idx] = bucket[-1]
+
+    def remove(self, id_):
+        bucket_idx, idx = self._locate(id_)
+        if bucket_idx is None:
+            return
+        bucket = self._buckets[bucket_idx]
+        del bucket[idx]
+        self._len -= 1
+        if bucket:
+            self._maxes[bucket_idx] = bucket[-1]
+        else:
+            del self._buckets[bucket_idx]
+            del self._maxes[bucket_idx]
+
+    def _locate(self, id_):
+        """Returns the bucket index and the index of `id_` in the bucket,
+        or (None, None)."""
+        bucket_idx = bisect_left(self._maxes, id_)
+        if bucket_idx < len(self._buckets):
+            bucket = self._buckets[bucket_idx]
+            idx = bisect_left(bucket, id_)
+            if bucket[idx] == id_:
+                return bucket_idx, idx
+        return None, None
+
+    def __contains__(self, id_):
+        return self._locate(id_)[0] is not None
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        if not self._buckets:
+            return iter(())
+        return self._iter_from(self._buckets[0][0], bisect_left)
+
+    def _iter_from(self, id_, bisect):
+        # Each bucket is looked up again from the last id yielded, so that
+        # the ids can be changed between two ids yielded.
+        while True:
+            bucket_idx = bisect(self._maxes, id_)
+            if bucket_idx == len(self._buckets):
+                return
+            bucket = self._buckets[bucket_idx]
+            for id_ in bucket[bisect(bucket, id_):]:
+                yield id_
+            bisect = bisect_right
+
+    def iter_range(self, after=None, prefix=''):
+        """Yields the ids greater than `after` that start with `prefix`."""
+        if after is not None and after >= prefix:
+            ids = self._iter_from(after, bisect_right)
+        else:
+            ids = self._iter_from(prefix, bisect_left)
+        return takewhile(lambda id_: id_.startswith(prefix), ids)
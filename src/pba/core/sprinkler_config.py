@@ -1,6 +1,7 @@
 # vim:set ts=4 sw=4 et:
 from __future__ import (absolute_import, division, print_function,
         unicode_literals)
+from collections import OrderedDict, namedtuple
 import logging
 from distutils.util import strtobool
 
@@ -8,8 +9,9 @@ log = logging.getLogger(__name__)
 
 
 class TestSprinkler(object):
-    def __init__(self, sprinkler_id):
+    def __init__(self, sprinkler_id, flow_rate=None):
         self.sprinkler_id = sprinkler_id
+        self.flow_rate = flow_rate
 
     def __str__(self):
         return 'test sprinkler {}'.format(self.sprinkler_id)
@@ -29,18 +31,23 @@ class TestSprinkler(object):
 
 
 class GpioSprinkler(object):
-    def __init__(self, sprinkler_id, gpio_port):
+    def __init__(self, sprinkler_id, gpio_port, flow_rate=None):
         self.sprinkler_id = sprinkler_id
         self._gpio_port = gpio_port
+        self.flow_rate = flow_rate
 
     def __str__(self):
         return 'gpio sprinkler {} on {}'.format(self.sprinkler_id, self._gpio_port)
 
     def turn_on(self):
-        self._gpio_port.turn_on()
+        return self._gpio_port.turn_on()
 
     def turn_off(self):
-        self._gpio_port.turn_off()
+        return self._gpio_port.turn_off()
+
+    @property
+    def gpio_port(self):
+        return self._gpio_port
 
     @property
     def is_setup(self):
@@ -51,20 +58,147 @@ class GpioSprinkler(object):
         self._gpio_port.export()
 
 
+def parse_sprinkler_options(details):
+    """Removes the trailing name=value options from details and returns
+    them."""
+    options = {}
+    while details and '=' in details[-1]:
+        name, value = details.pop().split('=', 1)
+        options[name] = value
+    return options
+
+
+SprinklerSpec = namedtuple('SprinklerSpec',
+        ['sprinkler_type', 'gpio_address', 'gpio_inverted', 'flow_rate'])
+
+
+def parse_sprinkler_spec(sprinkler_name, value):
+    details = value.split()
+    sprinkler_type = details.pop(0)
+    options = parse_sprinkler_options(details)
+    flow_rate = None
+    if 'flow' in options:
+        flow_rate = float(options.pop('flow'))
+    if options:
+        raise RuntimeError(
+                'unknown options {0} for sprinkler "{1}"'.format(
+                ', '.join(sorted(options)), sprinkler_name))
+    if sprinkler_type == 'dummy':
+        return SprinklerSpec(sprinkler_type, None, None, flow_rate)
+    elif sprinkler_type == 'gpio':
+        gpio_address = int(details.pop(0))
+        gpio_inverted = bool(strtobool(details.pop(0)))
+        return SprinklerSpec(sprinkler_type, gpio_address, gpio_inverted,
+                flow_rate)
+    raise RuntimeError(
+            'unknown sprinkler type "{0}" for sprinkler "{1}"'.format(
+            sprinkler_type, sprinkler_name))
+
+
+def parse_sprinkler_specs(config):
+    """Returns the SprinklerSpecs of the [sprinklers] section by
+    sprinkler name."""
+    return OrderedDict((sprinkler_name,
+            parse_sprinkler_spec(sprinkler_name, value)) \
+            for sprinkler_name, value in config.items('sprinklers'))
+
+
+def create_sprinkler(sprinkler_name, spec, gpio_ctrl):
+    if spec.sprinkler_type == 'dummy':
+        return TestSprinkler(sprinkler_name, spec.flow_rate)
+    return GpioSprinkler(sprinkler_name,
+            gpio_ctrl.get_outgoing_port(spec.gpio_address,
+                    spec.gpio_inverted),
+            spec.flow_rate)
+
+
 def load_sprinklers(config, gpio_ctrl, add_sprinkler):
-    for sprinkler_name, value in config.items('sprinklers'):
-        details = value.split()
-        sprinkler_type = details.pop(0)
+    for sprinkler_name, spec in parse_sprinkler_specs(config).items():
         log.info('adding sprinkler {0} of type {1}'.format(sprinkler_name,
-                sprinkler_type))
-        if sprinkler_type == 'dummy':
-            add_sprinkler(sprinkler_name, TestSprinkler(sprinkler_name))
-        elif sprinkler_type == 'gpio':
-            gpio_address = int(details.pop(0))
-            gpio_inverted = bool(strtobool(details.pop(0)))
-            add_sprinkler(sprinkler_name, GpioSprinkler(
-                    sprinkler_name, gpio_ctrl.get_outgoing_port(gpio_address, gpio_inverted)))
-        else:
-            raise RuntimeError(
-                    'unknown sprinkler type "{0}" for sprinkler "{1}"'.format(
-                    sprinkler_type, sprinkler_name))
+                spec.sprinkler_type))
+        add_sprinkler(sprinkler_name, create_sprinkler(sprinkler_name, spec,
+                gpio_ctrl))
+
+
+def setup_sprinklers(sprinklers, gpio_ctrl):
+    """Sets up all sprinklers that are not set up yet, exporting their GPIO
+    ports at once.  Returns the sprinklers that were set up."""
+    gpio_sprinklers = OrderedDict()
+    set_up = []
+    for sprinkler in sprinklers:
+        if isinstance(sprinkler, GpioSprinkler):
+            gpio_sprinklers[sprinkler.gpio_port] = sprinkler
+        elif not sprinkler.is_setup:
+            sprinkler.setup()
+            set_up.append(sprinkler)
+    if not gpio_sprinklers:
+        return set_up
+    for port in gpio_ctrl.export_ports(list(gpio_sprinklers)):
+        set_up.append(gpio_sprinklers[port])
+    return set_up
+
+
+class SprinklerZones(object):
+    """The sprinklers of the [sprinklers] section, kept in sync with the
+    sprinkler controller while the daemon is running.
+
+    reload() only touches the sprinklers whose configuration changed.
+    Jobs of sprinklers that are removed or wired differently are cancelled,
+    while those of all other sprinklers keep running.  GPIO ports are only
+    set up for new wiring.  `flow_rates` is updated in place.
+    """
+    def __init__(self, gpio_ctrl, sprinkler_ctrl):
+        self._gpio_ctrl = gpio_ctrl
+        self._sprinkler_ctrl = sprinkler_ctrl
+        self._job_queue = None
+        self._specs = OrderedDict()
+        self._sprinklers = {}
+        self.flow_rates = {}
+
+    def attach(self, job_queue):
+        """Sets the queue whose jobs are cancelled on reloads."""
+        self._job_queue = job_queue
+
+    def load(self, config):
+        """Adds the configured sprinklers.  Their GPIO ports are expected
+        to be set up already, see gpio-config."""
+        self._apply(parse_sprinkler_specs(config), setup=False)
+
+    def reload(self, config):
+        """Applies the changes of the configured sprinklers.  Returns the
+        names of the added, removed and changed sprinklers.  The running
+        configuration is left alone if the new one is invalid."""
+        return self._apply(parse_sprinkler_specs(config), setup=True)
+
+    def _apply(self, specs, setup):
+        added = [name for name in specs if name not in self._specs]
+        removed = [name for name in self._specs if name not in specs]
+        changed = [name for name in specs \
+                if name in self._specs and specs[name] != self._specs[name]]
+        rewired = [name for name in changed \
+                if specs[name][:3] != self._specs[name][:3]]
+
+        sprinklers = dict((name, create_sprinkler(name, specs[name],
+                self._gpio_ctrl)) for name in added + rewired)
+        if setup:
+            setup_sprinklers(list(sprinklers.values()), self._gpio_ctrl)
+
+        if self._job_queue is not None and (removed or rewired):
+            self._job_queue.remove_jobs(sprinkler_ids=removed + rewired)
+        for name in removed:
+            log.info('removing sprinkler {0}'.format(name))
+            self._sprinkler_ctrl.remove_sprinkler(name)
+            del self._sprinklers[name]
+            del self.flow_rates[name]
+        for name in changed:
+            if name not in sprinklers:
+                self._sprinklers[name].flow_rate = specs[name].flow_rate
+        for name in added + rewired:
+            log.info('adding sprinkler {0} of type {1}'.format(name,
+                    specs[name].sprinkler_type))
+            self._sprinkler_ctrl.add_sprinkler(name, sprinklers[name])
+            self._sprinklers[name] = sprinklers[name]
+        for name in added + changed:
+            self.flow_rates[name] = specs[name].flow_rate
+        self._specs = specs
+        return {'added': added, 'removed': removed, 'changed': changed}
@@ -0,0 +1,142 @@
+# vim:set ts=4 sw=4 et:
+"""Opt-in tracing of commands from the HTTP request to the valve.
+
+A trace collects high resolution timestamps at the stages a command passes
+through.  The trace of the command that is being processed is kept per
+thread, so stamp points deep down in the core (the interceptor chain, the
+GPIO writes) pick it up without it being passed along explicitly.  Traces
+are kept in a bounded ring buffer and only while tracing is enabled.
+"""
+from __future__ import (absolute_import, division, print_function,
+        unicode_literals)
+from collections import deque
+from contextlib import contextmanager
+from itertools import count
+import threading
+from timeit import default_timer
+
+
+def percentile_of(sorted_values, percentile):
+    idx = int(round(percentile / 100 * (len(sorted_values) - 1)))
+    return sorted_values[idx]
+
+
+class Trace(object):
+    def __init__(self, trace_id, name, start_time=None):
+        self.trace_id = trace_id
+        self.name = name
+        self.job_id = None
+        if start_time is None:
+            start_time = default_timer()
+        self.stamps = [(name, start_time)]
+
+    def stamp(self, stage):
+        self.stamps.append((stage, default_timer()))
+
+    def iter_stage_latencies(self):
+        """Yields the stages with the time passed since the previous
+        stamp."""
+        stamps = list(self.stamps)
+        for (_, previous), (stage, timestamp) in zip(stamps, stamps[1:]):
+            yield stage, timestamp - previous
+
+    def for_json(self):
+        start = self.stamps[0][1]
+        stages = []
+        for stage, latency in self.iter_stage_latencies():
+            stages.append({'stage': stage, 'latency_ms': latency * 1000})
+        return {
+            'trace_id': self.trace_id,
+            'name': self.name,
+            'job_id': self.job_id,
+            'total_ms': (self.stamps[-1][1] - start) * 1000,
+            'stages': stages,
+        }
+
+
+class Tracer(object):
+    BUFFER_SIZE = 1000
+
+    def __init__(self, enabled=False, buffer_size=BUFFER_SIZE):
+        self._local = threading.local()
+        self._trace_ids = count(1)
+        self.configure(enabled, buffer_size)
+
+    def configure(self, enabled, buffer_size=BUFFER_SIZE):
+        self.enabled = enabled
+        self._traces = deque(maxlen=buffer_size)
+
+    def start_trace(self, name):
+        """Returns a new trace, or None if tracing is disabled.  While this
+        thread handles a request, the trace is named after the request and
+        starts when the request arrived."""
+        if not self.enabled:
+            return None
+        request = getattr(self._local, 'request', None)
+        start_time = None
+        if request is not None:
+            name, start_time = request
+        trace = Trace(next(self._trace_ids), name, start_time)
+        self._traces.append(trace)
+        return trace
+
+    @contextmanager
+    def request(self, name):
+        """Marks the handling of a request by this thread.  Traces are only
+        started for the jobs the request actually queues."""
+        previous_request = getattr(self._local, 'request', None)
+        self._local.request = (name, default_timer())
+        try:
+            yield
+        finally:
+            self._local.request = previous_request
+
+    @property
+    def current_trace(self):
+        return getattr(self._local, 'trace', None)
+
+    @contextmanager
+    def activate(self, trace):
+        """Makes `trace` the current trace of this thread."""
+        previous_trace = self.current_trace
+        self._local.trace = trace
+        try:
+            yield trace
+        finally:
+            self._local.trace = previous_trace
+
+    def call_with(self, trace, func, *args, **kwargs):
+        """Calls func with `trace` as the current trace, e.g. in another
+        thread."""
+        with self.activate(trace):
+            return func(*args, **kwargs)
+
+    def stamp(self, stage):
+        """Stamps the current trace, if there is one."""
+        trace = self.current_trace
+        if trace is not None:
+            trace.stamp(stage)
+
+    def list_traces(self):
+        """Returns the buffered traces, newest first."""
+        return list(reversed(self._traces))
+
+    def stage_summary(self):
+        """Returns the latency percentiles of each stage over the buffered
+        traces."""
+        latencies = {}
+        for trace in list(self._traces):
+            for stage, latency in trace.iter_stage_latencies():
+                latencies.setdefault(stage, []).append(latency)
+        summary = {}
+        for stage, stage_latencies in latencies.items():
+            stage_latencies.sort()
+            summary[stage] = dict(('p{}_ms'.format(percentile),
+                    percentile_of(stage_latencies, percentile) * 1000) \
+                    for percentile in (50, 90, 99))
+            summary[stage]['max_ms'] = stage_latencies[-1] * 1000
+            summary[stage]['count'] = len(stage_latencies)
+        return summary
+
+
+TRACER = Tracer()
@@ -0,0 +1,50 @@
+# vim:set ts=4 sw=4 et:
+from __future__ import (absolute_import, division, print_function,
+        unicode_literals)
+from twisted.internet import task
+from twisted.trial import unittest
+from twisted.web import http
+from pba.client.federation import Federation, FederatedCancelJobsResource, \
+    FederatedJobsResource, FederatedSequencesResource
+from pba.test.test_web import post
+
+
+class PostValidationTest(unittest.TestCase):
+    """Malformed requests are rejected before any shard is asked."""
+    def setUp(self):
+        self.federation = Federation([], task.Clock())
+
+    def assert_bad_request(self, resource, body, error):
+        request, response = post(resource, body)
+
+        self.assertEqual(request.responseCode, http.BAD_REQUEST)
+        self.assertEqual(response, {'error': error})
+
+    def test_jobs(self):
+        jobs = FederatedJobsResource(self.federation)
+        self.assert_bad_request(jobs, b'[{',
+                'request body needs to be valid JSON')
+        self.assert_bad_request(jobs, [{'sprinkler_id': 'c1',
+                'duration': 60}, ['c2']], 'job needs to be a JSON object')
+        self.assert_bad_request(jobs, {'duration': 60},
+                'sprinkler_id needs to be a string')
+
+    def test_cancel(self):
+        cancel = FederatedCancelJobsResource(self.federation)
+        self.assert_bad_request(cancel, b'{]',
+                'request body needs to be valid JSON')
+        self.assert_bad_request(cancel, [1],
+                'request body needs to be a JSON object')
+        self.assert_bad_request(cancel, {'job_ids': ['1']},
+                'job_ids needs to be a list of integers')
+        self.assert_bad_request(cancel, {'sprinkler_ids': 'c1'},
+                'sprinkler_ids needs to be a JSON array')
+
+    def test_sequence(self):
+        sequences = FederatedSequencesResource(self.federation)
+        self.assert_bad_request(sequences, b'',
+                'request body needs to be valid JSON')
+        self.assert_bad_request(sequences, {'steps': [{'duration': 60}]},
+                'sprinkler_id needs to be a string')
+        self.assert_bad_request(sequences, {'steps': {}},
+                'steps needs to be a JSON array')
@@ -0,0 +1,49 @@
+# vim:set ts=4 sw=4 et:
+from __future__ import (absolute_import, division, print_function,
+        unicode_literals)
+import threading
+from twisted.internet import defer, reactor
+from twisted.trial import unittest
+from pba.core.gpio import GpioWorker
+
+
+class GpioWorkerTest(unittest.TestCase):
+    def setUp(self):
+        self.worker = GpioWorker(reactor, max_threads=4)
+        # Not start(), which stops the worker on reactor shutdown.
+        self.worker._pool.start()
+        self.addCleanup(self.worker.stop)
+
+    def test_commands_for_a_port_run_in_order(self):
+        calls = []
+        d = defer.gatherResults([self.worker.submit('p1', calls.append, idx) \
+                for idx in range(20)])
+        d.addCallback(lambda _: self.assertEqual(calls, list(range(20))))
+        return d
+
+    def test_hanging_port_does_not_hold_up_other_ports(self):
+        release = threading.Event()
+        self.addCleanup(release.set)
+        calls = []
+        hanging = self.worker.submit('p1', release.wait, 10)
+        queued = self.worker.submit('p1', calls.append, 'p1')
+
+        def check(_):
+            self.assertEqual(calls, ['p2'])
+            self.assertFalse(hanging.called)
+            self.assertFalse(queued.called)
+            release.set()
+            return defer.gatherResults([hanging, queued])
+
+        d = self.worker.submit('p2', calls.append, 'p2')
+        d.addCallback(check)
+        d.addCallback(lambda _: self.assertEqual(calls, ['p2', 'p1']))
+        return d
+
+    def test_failure_does_not_stop_the_queue(self):
+        calls = []
+        failed = self.worker.submit('p1', int, 'x')
+        d = self.worker.submit('p1', calls.append, 'p1')
+        d.addCallback(lambda _: self.assertEqual(calls, ['p1']))
+        return defer.gatherResults([self.assertFailure(failed, ValueError),
+                d])
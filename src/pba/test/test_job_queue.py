@@ -0,0 +1,207 @@
+# vim:set ts=4 sw=4 et:
+from __future__ import (absolute_import, division, print_function,
+        unicode_literals)
+from twisted.internet import task
+from twisted.trial import unittest
+from pba.core.controller import SprinklerController
+from pba.core.job_queue import FlowBudgetJobPolicy, \
+    MaxActiveSprinklerJobPolicy, SprinklerJobQueue
+from pba.core.sprinkler_config import TestSprinkler
+
+SPRINKLER_IDS = ('c1', 'c2', 'c3', 'c4')
+
+
+def create_sprinkler_ctrl():
+    sprinkler_ctrl = SprinklerController()
+    for sprinkler_id in SPRINKLER_IDS:
+        sprinkler_ctrl.add_sprinkler(sprinkler_id,
+                TestSprinkler(sprinkler_id))
+    return sprinkler_ctrl
+
+
+def create_job_queue(clock, queue_policy=None, sprinkler_ctrl=None):
+    if sprinkler_ctrl is None:
+        sprinkler_ctrl = create_sprinkler_ctrl()
+    if queue_policy is None:
+        queue_policy = MaxActiveSprinklerJobPolicy(1, 1)
+    return SprinklerJobQueue(clock, sprinkler_ctrl, queue_policy)
+
+
+class RemoveWaitingJobTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.job_queue = create_job_queue(self.clock)
+        self.events = []
+        self.job_queue.add_listener(lambda events: self.events.extend(
+                (event, job.for_json()) for event, job in events))
+
+    def test_cancelled_job_reports_its_status(self):
+        self.job_queue.add('c1', 60)
+        job = self.job_queue.add('c2', 60)
+        self.clock.advance(10)
+        del self.events[:]
+
+        removed_job = self.job_queue.remove_waiting_job(job.job_id)
+
+        self.assertIs(removed_job, job)
+        self.assertEqual(job.status, job.JOB_CANCELLED)
+        self.assertEqual(job.stop_time, 10)
+        self.assertEqual(self.events, [('cancelled', job.for_json())])
+        self.assertEqual(self.events[0][1]['status'], 'cancelled')
+        self.assertFalse(self.job_queue.is_job_waiting(job.job_id))
+
+
+class AddJobsTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.job_queue = create_job_queue(self.clock)
+
+    def test_adds_all_jobs(self):
+        jobs = self.job_queue.add_jobs([('c1', 60, 0), ('c2', 60, 1),
+                ('c3', 60, '2')])
+
+        self.assertEqual([job.priority for job in jobs], [0, 1, 2])
+        self.assertEqual(sorted(job.job_id \
+                for job in self.job_queue.list_jobs()), [1, 2, 3])
+
+    def assert_nothing_added(self, jobs):
+        self.assertRaises(RuntimeError, self.job_queue.add_jobs, jobs)
+        self.assertEqual(self.job_queue.list_jobs(), [])
+        self.assertEqual(self.job_queue.last_job_id, 0)
+
+    def test_invalid_sprinkler_adds_nothing(self):
+        self.assert_nothing_added([('c1', 60, 0), ('c9', 60, 0)])
+
+    def test_invalid_duration_adds_nothing(self):
+        self.assert_nothing_added([('c1', 60, 0), ('c2', 0, 0)])
+
+    def test_invalid_priority_adds_nothing(self):
+        self.assert_nothing_added([('c1', 60, 0), ('c2', 60, 'high')])
+        self.assert_nothing_added([('c1', 60, 0), ('c2', 60, None)])
+
+
+class FlowBudgetTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.job_queue = create_job_queue(self.clock, FlowBudgetJobPolicy(
+                {'c1': 6, 'c2': 8, 'c3': 3, 'c4': 3}, 10))
+
+    def get_active_sprinkler_ids(self):
+        return sorted(job.sprinkler_id \
+                for job in self.job_queue.list_active_jobs())
+
+    def test_admits_jobs_within_the_capacity(self):
+        self.job_queue.add('c1', 60)
+        self.job_queue.add('c3', 60)
+        self.job_queue.add('c4', 60)
+
+        self.assertEqual(self.get_active_sprinkler_ids(), ['c1', 'c3'])
+
+    def test_backfills_jobs_that_do_not_delay_the_blocked_job(self):
+        self.job_queue.add('c1', 60)
+        blocked_job = self.job_queue.add('c2', 60)
+        # Fits into the free flow, but would still use flow the blocked job
+        # needs when c1 ends.
+        long_job = self.job_queue.add('c3', 300)
+        short_job = self.job_queue.add('c4', 30)
+
+        self.assertEqual(self.get_active_sprinkler_ids(), ['c1', 'c4'])
+
+        self.clock.advance(30)
+        self.assertEqual(short_job.status, short_job.JOB_FINISHED)
+        self.assertEqual(self.get_active_sprinkler_ids(), ['c1'])
+
+        self.clock.advance(30)
+        self.assertEqual(blocked_job.status, blocked_job.JOB_ACTIVE)
+        self.assertEqual(blocked_job.start_time, 60)
+        self.assertEqual(long_job.status, long_job.JOB_WAITING)
+
+
+class SequenceTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.job_queue = create_job_queue(self.clock,
+                MaxActiveSprinklerJobPolicy(2, 2))
+
+    def test_steps_run_one_after_the_other(self):
+        sequence = self.job_queue.add_sequence([('c1', 60), ('c2', 60)])
+        first_job = sequence.current_job
+
+        self.clock.advance(60)
+
+        second_job = sequence.current_job
+        self.assertEqual(first_job.status, first_job.JOB_FINISHED)
+        self.assertEqual((second_job.sprinkler_id, second_job.start_time),
+                ('c2', 60))
+        self.clock.advance(60)
+        self.assertEqual(self.job_queue.list_sequences(), [])
+
+    def test_handover_overlaps_the_steps(self):
+        sequence = self.job_queue.add_sequence([('c1', 60), ('c2', 60)],
+                overlap=10)
+        first_job = sequence.current_job
+
+        self.clock.advance(50)
+
+        second_job = sequence.current_job
+        self.assertEqual(second_job.status, second_job.JOB_ACTIVE)
+        self.assertEqual(second_job.start_time, 50)
+        self.assertEqual(first_job.status, first_job.JOB_ACTIVE)
+        self.clock.advance(10)
+        self.assertEqual(first_job.status, first_job.JOB_FINISHED)
+
+    def test_cancel_sequence_during_handover(self):
+        sequence = self.job_queue.add_sequence([('c1', 60), ('c2', 60),
+                ('c3', 60)], overlap=10)
+        self.clock.advance(55)
+
+        cancelled_jobs = self.job_queue.remove_jobs(
+                sequence_ids=[sequence.sequence_id])
+
+        self.assertEqual([job.sprinkler_id for job in cancelled_jobs],
+                ['c1', 'c2'])
+        self.assertEqual(self.job_queue.list_jobs(), [])
+        self.assertEqual(self.job_queue.list_sequences(), [])
+        self.clock.advance(120)
+        self.assertEqual(self.job_queue.list_jobs(), [])
+
+    def test_cancel_sequence_after_cancelling_a_waiting_step(self):
+        other_job = self.job_queue.add('c4', 600)
+        self.job_queue.add('c3', 600)
+        sequence = self.job_queue.add_sequence([('c1', 60), ('c2', 60),
+                ('c3', 60)])
+        first_job = sequence.current_job
+
+        self.job_queue.remove_waiting_job(first_job.job_id)
+        second_job = sequence.current_job
+        self.assertEqual(second_job.status, second_job.JOB_WAITING)
+
+        cancelled_jobs = self.job_queue.remove_jobs(
+                sequence_ids=[sequence.sequence_id, sequence.sequence_id])
+
+        self.assertEqual(cancelled_jobs, [second_job])
+        self.assertEqual(second_job.status, second_job.JOB_CANCELLED)
+        self.assertEqual([job.job_id for job in self.job_queue.list_jobs()],
+                [other_job.job_id, other_job.job_id + 1])
+        self.assertEqual(self.job_queue.list_sequences(), [])
+
+    def test_handover_stays_within_the_flow_budget(self):
+        job_queue = create_job_queue(self.clock, FlowBudgetJobPolicy(
+                {'c1': 6, 'c2': 6, 'c3': 4}, 10))
+        sequence = job_queue.add_sequence([('c1', 60), ('c2', 60),
+                ('c3', 60)], overlap=10)
+
+        self.clock.advance(50)
+        second_job = sequence.current_job
+        self.assertEqual(second_job.status, second_job.JOB_WAITING)
+
+        self.clock.advance(10)
+        self.assertEqual(second_job.status, second_job.JOB_ACTIVE)
+        self.assertEqual(second_job.start_time, 60)
+
+        # c2 and c3 fit together.
+        self.clock.advance(50)
+        third_job = sequence.current_job
+        self.assertEqual((third_job.sprinkler_id, third_job.status),
+                ('c3', third_job.JOB_ACTIVE))
+        self.assertEqual(second_job.status, second_job.JOB_ACTIVE)
@@ -0,0 +1,59 @@
+# vim:set ts=4 sw=4 et:
+from __future__ import (absolute_import, division, print_function,
+        unicode_literals)
+from twisted.internet import task
+from twisted.trial import unittest
+from pba.core.journal import JobJournal
+from pba.test.test_job_queue import create_job_queue
+
+
+class JobJournalTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.path = self.mktemp()
+
+    def _write_journal(self):
+        job_queue = create_job_queue(self.clock)
+        journal = JobJournal(self.clock, self.path)
+        journal.attach(job_queue)
+        job_queue.add('c1', 60)
+        job_queue.add('c2', 60, priority=2)
+        self.clock.advance(journal.COMMIT_DELAY)
+        journal.close()
+
+    def test_recover_replays_jobs(self):
+        self._write_journal()
+
+        last_job_id, job_states = JobJournal(self.clock, self.path).recover()
+
+        self.assertEqual(last_job_id, 2)
+        self.assertEqual([(job_state['job_id'], job_state['sprinkler_id'],
+                job_state['priority'], job_state['start_time']) \
+                for job_state in job_states],
+                [(1, 'c1', 0, 0), (2, 'c2', 2, None)])
+
+    def test_recover_ignores_torn_record(self):
+        self._write_journal()
+        with open(self.path, 'ab') as fp:
+            fp.write(b'{"event": "queued", "job": {"job_id": 3, "spri')
+
+        journal = JobJournal(self.clock, self.path)
+        last_job_id, job_states = journal.recover()
+
+        self.assertEqual(last_job_id, 2)
+        self.assertEqual([job_state['job_id'] for job_state in job_states],
+                [1, 2])
+
+        # Journaling starts over with a snapshot, so that new records are
+        # not appended to the torn one.
+        job_queue = create_job_queue(self.clock)
+        job_queue.restore_jobs(last_job_id, job_states)
+        journal.attach(job_queue)
+        job_queue.add('c3', 60)
+        self.clock.advance(journal.COMMIT_DELAY)
+        journal.close()
+
+        last_job_id, job_states = JobJournal(self.clock, self.path).recover()
+        self.assertEqual(last_job_id, 3)
+        self.assertEqual([job_state['job_id'] for job_state in job_states],
+                [1, 2, 3])
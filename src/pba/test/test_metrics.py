@@ -0,0 +1,27 @@
+# vim:set ts=4 sw=4 et:
+from __future__ import (absolute_import, division, print_function,
+        unicode_literals)
+import threading
+from twisted.trial import unittest
+from pba.core.metrics import Histogram
+
+
+class HistogramTest(unittest.TestCase):
+    def test_observations_from_threads_are_all_counted(self):
+        histogram = Histogram('test_seconds', 'Test', ('port',),
+                buckets=(1, 2))
+
+        def observe():
+            for _ in range(10000):
+                histogram.labels('p1').observe(1)
+
+        threads = [threading.Thread(target=observe) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(histogram.labels('p1').snapshot(),
+                ([40000, 0, 0], 40000.0))
+        self.assertIn('test_seconds_count{port="p1"} 40000',
+                histogram.expose())
@@ -0,0 +1,51 @@
+# vim:set ts=4 sw=4 et:
+from __future__ import (absolute_import, division, print_function,
+        unicode_literals)
+import random
+from twisted.trial import unittest
+from pba.core.sorted_ids import SortedIds
+
+
+class SmallSortedIds(SortedIds):
+    BUCKET_SIZE = 4
+
+
+class SortedIdsTest(unittest.TestCase):
+    def test_matches_a_sorted_set(self):
+        rng = random.Random(0)
+        ids = SmallSortedIds(range(0, 40, 3))
+        expected = set(range(0, 40, 3))
+        for _ in range(2000):
+            id_ = rng.randrange(100)
+            if rng.random() < 0.5:
+                ids.add(id_)
+                expected.add(id_)
+            else:
+                ids.remove(id_)
+                expected.discard(id_)
+            self.assertEqual(list(ids), sorted(expected))
+        self.assertEqual(len(ids), len(expected))
+        self.assertEqual([id_ in ids for id_ in range(100)],
+                [id_ in expected for id_ in range(100)])
+
+    def test_iter_range(self):
+        ids = SmallSortedIds(['a1', 'a2', 'b1', 'b2', 'b3', 'b4', 'b5', 'c1'])
+
+        self.assertEqual(list(ids.iter_range(prefix='b')),
+                ['b1', 'b2', 'b3', 'b4', 'b5'])
+        self.assertEqual(list(ids.iter_range('b2', 'b')), ['b3', 'b4', 'b5'])
+        self.assertEqual(list(ids.iter_range('a', 'b')),
+                ['b1', 'b2', 'b3', 'b4', 'b5'])
+        self.assertEqual(list(ids.iter_range('b5')), ['c1'])
+
+    def test_changes_while_iterating(self):
+        ids = SmallSortedIds(range(20))
+        seen = []
+        for id_ in ids:
+            seen.append(id_)
+            if id_ == 5:
+                for removed_id in range(6, 15):
+                    ids.remove(removed_id)
+                ids.add(100)
+
+        self.assertEqual(seen, [0, 1, 2, 3, 4, 5, 15, 16, 17, 18, 19, 100])
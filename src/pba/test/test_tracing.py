@@ -0,0 +1,40 @@
+# vim:set ts=4 sw=4 et:
+from __future__ import (absolute_import, division, print_function,
+        unicode_literals)
+from twisted.internet import task
+from twisted.trial import unittest
+from pba.core.job_queue import MaxActiveSprinklerJobPolicy
+from pba.core.tracing import TRACER
+from pba.test.test_job_queue import create_job_queue
+
+
+class RequestTraceTest(unittest.TestCase):
+    def setUp(self):
+        TRACER.configure(True)
+        self.addCleanup(TRACER.configure, False)
+        self.job_queue = create_job_queue(task.Clock(),
+                MaxActiveSprinklerJobPolicy(1, 1))
+
+    def test_bulk_request_traces_each_job_from_its_arrival(self):
+        with TRACER.request('POST /jobs'):
+            jobs = self.job_queue.add_jobs([('c1', 60, 0), ('c2', 60, 0)])
+
+        traces = sorted(TRACER.list_traces(),
+                key=lambda trace: trace.job_id)
+        self.assertEqual([(trace.name, trace.job_id) for trace in traces],
+                [('POST /jobs', jobs[0].job_id),
+                        ('POST /jobs', jobs[1].job_id)])
+        # Both start with the arrival of the request.
+        self.assertEqual(traces[0].stamps[0], traces[1].stamps[0])
+        for trace in traces:
+            self.assertEqual(trace.stamps[1][0], 'queued')
+
+    def test_request_without_new_jobs_is_not_traced(self):
+        job = self.job_queue.add('c1', 60)
+        # Empties the buffer.
+        TRACER.configure(True)
+
+        with TRACER.request('POST /courts'):
+            job.duration = 120
+
+        self.assertEqual(TRACER.list_traces(), [])
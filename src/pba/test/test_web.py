@@ -0,0 +1,279 @@
+# vim:set ts=4 sw=4 et:
+from __future__ import (absolute_import, division, print_function,
+        unicode_literals)
+from io import BytesIO
+import json
+import os
+from twisted.internet import task
+from twisted.trial import unittest
+from twisted.web import http, resource, server
+from twisted.web.test.requesthelper import DummyChannel, DummyRequest
+from pba.client.web import HTTP_REQUEST_LATENCY, CancelJobsResource, \
+    CourtResource, InstrumentedRequest, JobsResource, ProgramResource, \
+    ProgramsResource, SequencesResource, create_site
+from pba.core.programs import IntervalSchedule, ProgramScheduler
+from pba.core.scheduler import TimerScheduler
+from pba.test.test_job_queue import create_job_queue, \
+    create_sprinkler_ctrl
+
+
+def get(resource, path, headers=None):
+    request = DummyRequest(path.split(b'/'))
+    for name, value in (headers or {}).items():
+        request.requestHeaders.setRawHeaders(name, [value])
+    child = resource.getChildWithDefault(request.postpath.pop(0), request)
+    return request, child.render(request)
+
+
+def post(resource, body):
+    """Posts `body`, which is encoded as JSON unless it is bytes."""
+    if not isinstance(body, bytes):
+        body = json.dumps(body).encode('utf-8')
+    request = DummyRequest([b''])
+    request.method = b'POST'
+    request.content = BytesIO(body)
+    return request, json.loads(resource.render(request))
+
+
+class JobListingTest(unittest.TestCase):
+    def setUp(self):
+        self.job_queue = create_job_queue(task.Clock())
+        # Enough jobs for several chunks, started in another order than
+        # their job ids.
+        self.job_queue.add_jobs([('c{}'.format(idx % 4 + 1), 60, idx % 3) \
+                for idx in range(250)])
+        self.resource = JobsResource(self.job_queue)
+
+    def list_jobs(self, **args):
+        request = DummyRequest([b''])
+        request.path = b'/jobs'
+        request.args = dict((name.encode('ascii'), [value.encode('ascii')]) \
+                for name, value in args.items())
+        body = self.resource.render(request)
+        if body == server.NOT_DONE_YET:
+            self.assertTrue(request.finished)
+            body = b''.join(request.written)
+        return request, json.loads(body)
+
+    def test_lists_the_jobs_in_their_order(self):
+        _, jobs = self.list_jobs()
+
+        self.assertEqual(jobs, [job.for_json() \
+                for job in self.job_queue.list_jobs()])
+
+    def test_pages_are_ordered_by_job_id(self):
+        job_ids = []
+        cursor = None
+        while True:
+            args = {'limit': '120'}
+            if cursor is not None:
+                args['cursor'] = cursor
+            request, jobs = self.list_jobs(**args)
+            job_ids.extend(job['job_id'] for job in jobs)
+            link = request.responseHeaders.getRawHeaders(b'Link')
+            if link is None:
+                break
+            cursor = '{}'.format(jobs[-1]['job_id'])
+
+        self.assertEqual(job_ids, list(range(1, 251)))
+
+    def test_removed_jobs_are_left_out(self):
+        job_ids = self.job_queue.iter_waiting_job_ids(100)
+        self.assertEqual(next(job_ids), 101)
+        self.job_queue.remove_jobs(job_ids=list(range(102, 200)))
+        new_job = self.job_queue.add('c1', 60)
+
+        self.assertEqual(list(job_ids), list(range(200, 251))
+                + [new_job.job_id])
+        self.assertEqual(list(self.job_queue.iter_waiting_job_ids(150)),
+                list(range(200, 251)) + [new_job.job_id])
+
+
+class PostValidationTest(unittest.TestCase):
+    def setUp(self):
+        self.job_queue = create_job_queue(task.Clock())
+
+    def assert_bad_request(self, resource, body, error):
+        request, response = post(resource, body)
+
+        self.assertEqual(request.responseCode, http.BAD_REQUEST)
+        self.assertEqual(response, {'error': error})
+        self.assertEqual(self.job_queue.list_jobs(), [])
+
+    def test_jobs(self):
+        jobs = JobsResource(self.job_queue)
+        self.assert_bad_request(jobs, b'{"sprinkler_id": ',
+                'request body needs to be valid JSON')
+        self.assert_bad_request(jobs, [{'sprinkler_id': 'c1',
+                'duration': 60}, 'c2'], 'job needs to be a JSON object')
+        self.assert_bad_request(jobs, [{'sprinkler_id': 'c1',
+                'duration': 60}, {'sprinkler_id': 'c2'}],
+                'duration needs to be a number greater than 0')
+        self.assert_bad_request(jobs, {'duration': 60},
+                'sprinkler_id needs to be a string')
+        self.assert_bad_request(jobs, {'sprinkler_id': 'c1', 'duration': 60,
+                'priority': [1]}, 'priority needs to be an integer')
+
+        _, response = post(jobs, [{'sprinkler_id': 'c1', 'duration': 60,
+                'priority': 2}])
+        self.assertEqual(response[0]['priority'], 2)
+
+    def test_court(self):
+        court = CourtResource('c1', self.job_queue)
+        self.assert_bad_request(court, b'[',
+                'request body needs to be valid JSON')
+        self.assert_bad_request(court, [60],
+                'request body needs to be a JSON object')
+        self.assert_bad_request(court, {'duration': '60'},
+                'duration needs to be a number greater than 0')
+
+    def test_cancel(self):
+        cancel = CancelJobsResource(self.job_queue)
+        self.assert_bad_request(cancel, b'',
+                'request body needs to be valid JSON')
+        self.assert_bad_request(cancel, {'job_ids': 1},
+                'job_ids needs to be a JSON array')
+        self.assert_bad_request(cancel, {'sprinkler_ids': [['c1']]},
+                'sprinkler_ids needs to be a list of ids')
+
+    def test_sequence(self):
+        sequences = SequencesResource(self.job_queue)
+        self.assert_bad_request(sequences, b'{',
+                'request body needs to be valid JSON')
+        self.assert_bad_request(sequences, {},
+                'steps needs to be a JSON array')
+        self.assert_bad_request(sequences, {'steps': [{'sprinkler_id': 'c1',
+                'duration': 60}, 60]}, 'step needs to be a JSON object')
+        self.assert_bad_request(sequences, {'steps': [{'sprinkler_id': 'c1',
+                'duration': 60}], 'overlap': '5'},
+                'overlap needs to be a number')
+
+
+class ProgramResourceTest(unittest.TestCase):
+    def setUp(self):
+        clock = task.Clock()
+        sprinkler_ctrl = create_sprinkler_ctrl()
+        self.program_scheduler = ProgramScheduler(TimerScheduler(clock),
+                create_job_queue(clock, sprinkler_ctrl=sprinkler_ctrl),
+                sprinkler_ctrl)
+        program = self.program_scheduler.add_program('nightly',
+                IntervalSchedule(3600), ['c1'], 60)
+        self.resource = ProgramResource(self.program_scheduler,
+                program.program_id)
+
+    def test_pause(self):
+        _, program = post(self.resource, {'paused': True})
+
+        self.assertTrue(program['paused'])
+        self.assertTrue(self.program_scheduler.list_programs()[0].paused)
+
+    def test_missing_paused_is_rejected(self):
+        request, response = post(self.resource, {})
+
+        self.assertEqual(request.responseCode, http.BAD_REQUEST)
+        self.assertEqual(response,
+                {'error': 'paused needs to be true or false'})
+
+
+class ProgramsResourceTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        sprinkler_ctrl = create_sprinkler_ctrl()
+        self.job_queue = create_job_queue(self.clock,
+                sprinkler_ctrl=sprinkler_ctrl)
+        self.program_scheduler = ProgramScheduler(TimerScheduler(self.clock),
+                self.job_queue, sprinkler_ctrl)
+        self.resource = ProgramsResource(self.program_scheduler)
+
+    def add_program(self, **new_program):
+        new_program.update(schedule={'interval': 3600},
+                sprinkler_ids=['c1'], duration=60)
+        return post(self.resource, new_program)
+
+    def test_queues_jobs_of_the_priority(self):
+        _, program = self.add_program(priority=3)
+
+        self.assertEqual((program['priority'], program['high_priority']),
+                (3, True))
+        self.clock.advance(3600)
+        self.assertEqual([job.priority for job in self.job_queue.list_jobs()],
+                [3])
+
+    def test_high_priority_is_priority_1(self):
+        _, program = self.add_program(high_priority=True)
+
+        self.assertEqual(program['priority'], 1)
+
+    def test_invalid_priority_is_rejected(self):
+        request, response = self.add_program(priority='high')
+
+        self.assertEqual(request.responseCode, http.BAD_REQUEST)
+        self.assertEqual(response,
+                {'error': 'priority needs to be an integer'})
+        self.assertEqual(self.program_scheduler.list_programs(), [])
+
+    def test_restores_the_priority(self):
+        self.add_program(priority=3)
+        state = self.program_scheduler.snapshot()
+        # Snapshots taken before integer priorities.
+        legacy_state = [dict(state[0], program_id=2, high_priority=True)]
+        del legacy_state[0]['priority']
+
+        self.program_scheduler.remove_program(1)
+        self.program_scheduler.restore(state + legacy_state)
+
+        self.assertEqual([program.priority for program \
+                in self.program_scheduler.list_programs()], [3, 1])
+
+
+class CreateSiteTest(unittest.TestCase):
+    def test_compresses_static_files_on_the_given_clock(self):
+        www_root = self.mktemp()
+        os.mkdir(www_root)
+        with open(os.path.join(www_root, 'index.html'), 'wb') as fp:
+            fp.write(b'<html>' + b'pba ' * 1000 + b'</html>')
+        clock = task.Clock()
+        site = create_site(create_job_queue(clock), create_sprinkler_ctrl(),
+                clock, www_root=www_root)
+
+        # A task.Clock has no threads, so the files are compressed at once.
+        request, body = get(site.resource, b'',
+                {b'Accept-Encoding': b'gzip'})
+
+        self.assertEqual(request.responseHeaders.getRawHeaders(
+                b'Content-Encoding'), [b'gzip'])
+        self.assertTrue(len(body) < 1000)
+
+
+class InstrumentedRequestTest(unittest.TestCase):
+    class PlainResource(resource.Resource):
+        isLeaf = True
+
+        def render_GET(self, request):
+            return b'plain'
+
+    class StreamingResource(resource.Resource):
+        isLeaf = True
+        streaming = True
+
+        def render_GET(self, request):
+            return server.NOT_DONE_YET
+
+    def render(self, resrc):
+        request = InstrumentedRequest(DummyChannel(), False)
+        request.method = b'GET'
+        request.clientproto = b'HTTP/1.1'
+        request.render(resrc)
+        if not request.finished:
+            request.finish()
+        counts, _ = HTTP_REQUEST_LATENCY.labels(
+                resrc.__class__.__name__).snapshot()
+        return sum(counts)
+
+    def test_records_the_latency(self):
+        num_requests = self.render(self.PlainResource())
+
+        self.assertEqual(self.render(self.PlainResource()), num_requests + 1)
+
+    def test_does_not_record_streams(self):
+        self.assertEqual(self.render(self.StreamingResource()), 0)
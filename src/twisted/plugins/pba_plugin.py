@@ -2,16 +2,20 @@
 from __future__ import (absolute_import, division, print_function,
         unicode_literals)
 from ConfigParser import SafeConfigParser
+from functools import partial
 import logging.config
+import signal
 from zope.interface import implements
 from twisted.python import usage
 from twisted.plugin import IPlugin
 from twisted.application.service import (IServiceMaker, Service)
 from twisted.python.log import PythonLoggingObserver
-from twisted.application.internet import TCPServer  # @UnresolvedImport
+from twisted.application.internet import TCPServer, UNIXServer  # @UnresolvedImport
+from twisted.internet import reactor
 from pba.core.logging import LogObserverInjectingMultiService
-from pba.core import daemon
-from pba.client.web import create_site
+
+# The daemon itself is only imported in makeService(), so that twistd can
+# list its plugins without importing it.
 
 
 class IrrigationControllerServiceOptions(usage.Options):
@@ -23,13 +27,43 @@ class IrrigationControllerServiceOptions(usage.Options):
 
 
 class StopSprinklersService(Service):
-    def __init__(self, job_queue):
+    def __init__(self, job_queue, job_journal=None):
         self._job_queue = job_queue
+        self._job_journal = job_journal
 
     def stopService(self):
+        # Close the journal first, so that the jobs cancelled here are
+        # restored on the next start.
+        if self._job_journal is not None:
+            self._job_journal.close()
         self._job_queue.remove_all_jobs()
 
 
+class ReloadOnHangupService(Service):
+    """Calls `reload()` whenever the daemon receives SIGHUP."""
+    def __init__(self, reload):
+        self._reload = reload
+        self._previous_handler = None
+
+    def startService(self):
+        Service.startService(self)
+        self._previous_handler = signal.signal(signal.SIGHUP,
+                self._on_hangup)
+
+    def stopService(self):
+        signal.signal(signal.SIGHUP, self._previous_handler)
+        return Service.stopService(self)
+
+    def _on_hangup(self, signum, frame):
+        reactor.callFromThread(self._reload_safely)
+
+    def _reload_safely(self):
+        try:
+            self._reload()
+        except RuntimeError as e:
+            print(e)
+
+
 class IrrigationControllerServiceMaker(object):
     implements(IServiceMaker, IPlugin)
     tapname = "pba"
@@ -43,15 +77,50 @@ class IrrigationControllerServiceMaker(object):
         logging.config.fileConfig(config_file_name)
         config = SafeConfigParser()
         config.read(config_file_name)
-        job_queue, sprinkler_ctrl = daemon.main(config)
-        site = create_site(job_queue, sprinkler_ctrl)
-
         multi_service = LogObserverInjectingMultiService(
                 observer=PythonLoggingObserver().emit)
-        http_service = TCPServer(http_port_nr, site)
+
+        if config.has_section('federation'):
+            from pba.client.federation import create_federation_site
+            site = create_federation_site(
+                    config.get('federation', 'shards').split())
+            multi_service.addService(TCPServer(http_port_nr, site))
+            return multi_service
+
+        from pba.core import daemon
+        from pba.client.web import create_site
+
+        job_queue, sprinkler_ctrl, sprinkler_zones = daemon.main(config)
+        job_journal = daemon.load_job_journal(config, job_queue)
+        program_scheduler = daemon.load_programs(config, job_queue,
+                sprinkler_ctrl)
+        reload_sprinklers = partial(daemon.reload_sprinklers,
+                config_file_name, sprinkler_zones)
+        site = create_site(job_queue, sprinkler_ctrl,
+                program_scheduler=program_scheduler,
+                reload_sprinklers=reload_sprinklers)
+
+        if config.has_option('shard', 'http_socket'):
+            # Shards are only reached through the front-end.
+            http_service = UNIXServer(config.get('shard', 'http_socket'),
+                    site, mode=0o660, wantPID=True)
+        else:
+            http_service = TCPServer(http_port_nr, site)
         multi_service.addService(http_service)
 
-        stop_sprinklers = StopSprinklersService(job_queue)
+        if config.has_option('command_socket', 'path'):
+            from pba.client.command_socket import CommandFactory
+            mode = 0o660
+            if config.has_option('command_socket', 'mode'):
+                mode = int(config.get('command_socket', 'mode'), 8)
+            command_service = UNIXServer(config.get('command_socket', 'path'),
+                    CommandFactory(job_queue, sprinkler_ctrl), mode=mode,
+                    wantPID=True)
+            multi_service.addService(command_service)
+
+        multi_service.addService(ReloadOnHangupService(reload_sprinklers))
+
+        stop_sprinklers = StopSprinklersService(job_queue, job_journal)
         multi_service.addService(stop_sprinklers)
 
         return multi_service